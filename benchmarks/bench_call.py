@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Python-side cost of a CmdWrapper call (the process is not started).
+
+Measures how many CmdProc per second a CmdWrapper prepares with a large
+environment and a large input (what CmdWrapper.__call__ does before
+CmdProc.run()).
+
+"""
+
+import sys
+import os
+import argparse
+from time import monotonic
+from cmdwrapper import CmdWrapper
+from cmdwrapper.cmdproc import CmdProc
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+def calls_per_second(wrapper, count, **cmd_proc_kwargs):
+    """Prepare 'count' CmdProc with the wrapper."""
+    # pylint: disable=protected-access
+    start = monotonic()
+    for num in range(count):
+        CmdProc(**wrapper._cmd_proc_kwargs_for(('arg', str(num)),
+                                               cmd_proc_kwargs))
+    return count / (monotonic() - start)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000,
+                        help='number of calls per case')
+    parser.add_argument('--env-vars', type=int, default=200,
+                        help='number of environment variables')
+    parser.add_argument('--input-kb', type=int, default=64,
+                        help='size of the input')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update(('VAR{}'.format(num), 'x' * 64)
+               for num in range(args.env_vars))
+
+    cases = [('minimal', CmdWrapper('stat'), {}),
+             ('env', CmdWrapper('stat', args=['-c', '%s'], env=env,
+                                timeout=10), {}),
+             ('env+input', CmdWrapper('stat', env=env,
+                                      input=b'x' * args.input_kb * 1024), {}),
+             ('per-call kwargs', CmdWrapper('stat', env=env),
+              {'cwd': '/', 'timeout': 5})]
+
+    for name, wrapper, cmd_proc_kwargs in cases:
+        print('{:16} {:10.0f} calls/s'
+              .format(name, calls_per_second(wrapper, args.count,
+                                             **cmd_proc_kwargs)))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Per-command overhead: CmdSession vs a new 'bash -c' per command."""
+
+import sys
+import argparse
+from time import monotonic
+from cmdwrapper import CmdWrapper
+from cmdwrapper.cmdsession import CmdSession
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+def per_command(run, count, command):
+    """Return the average time (seconds) of run(command)."""
+    start = monotonic()
+    for _ in range(count):
+        run(command)
+    return (monotonic() - start) / count
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000,
+                        help='number of commands per case')
+    parser.add_argument('--cmd', default='echo hello',
+                        help='the shell command to run')
+    args = parser.parse_args()
+
+    bash = CmdWrapper('bash', args=['-c'])
+    with CmdSession() as session:
+        for name, run in (('bash -c', lambda cmd: bash(cmd).wait()),
+                          ('CmdSession', session.run)):
+            print('{:12} {:8.3f} ms/command'
+                  .format(name, per_command(run, args.count, args.cmd) *
+                          1000))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Spawns per second of CmdProc with the spawn backends and a CmdLauncher.
+
+The parent process first allocates a large heap ('--heap-mb') to show how
+the cost of a spawn depends on the size of the parent (the launcher is
+started before the allocation).
+
+"""
+
+import sys
+import argparse
+from time import monotonic
+from cmdwrapper.cmdproc import CmdProc
+from cmdwrapper.cmdspawn import SPAWN_BACKENDS
+try:
+    from cmdwrapper.cmdlauncher import CmdLauncher
+except ImportError:     # Python < 3.9
+    CmdLauncher = None
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+def spawns_per_second(spawn, count, cmd):
+    """Run 'cmd' 'count' times with the 'spawn' backend."""
+    start = monotonic()
+    for _ in range(count):
+        CmdProc(cmd, spawn=spawn).wait()
+    return count / (monotonic() - start)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--heap-mb', type=int, default=1024,
+                        help='size of the resident heap of the parent')
+    parser.add_argument('--count', type=int, default=1000,
+                        help='number of spawns per backend')
+    parser.add_argument('--cmd', default='true', help='the command to run')
+    args = parser.parse_args()
+
+    launcher = None if CmdLauncher is None else CmdLauncher()
+
+    # touch every page: the heap has to be resident
+    heap = bytearray(args.heap_mb * 1024 ** 2)
+    for pos in range(0, len(heap), 4096):
+        heap[pos] = 1
+
+    for name, spawn in [(spawn, spawn) for spawn in SPAWN_BACKENDS] + \
+            ([] if launcher is None else [('launcher', launcher)]):
+        print('{:12} {:8.0f} spawns/s (heap: {} MB)'
+              .format(name, spawns_per_second(spawn, args.count, args.cmd),
+                      args.heap_mb))
+
+    if launcher is not None:
+        launcher.close()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""The benchmark suite of cmdwrapper (the results are written as JSON).
+
+Cases: calls per second of CmdWrapper on 'true', capture throughput of
+CmdProc.wait(), cost of CmdOutput.lines/firstline on large outputs,
+concurrency scaling of CmdRunning, the overhead of the timeouts and the
+cost of the environment (a dict per call or a shared CmdEnv).
+
+Each case is repeated and the best value is kept. To compare two versions:
+
+$ PYTHONPATH=. benchmarks/bench_suite.py --output old.json
+$ git checkout ...
+$ PYTHONPATH=. benchmarks/bench_suite.py --compare old.json
+
+"""
+
+import sys
+import os
+import json
+import socket
+import argparse
+import platform
+from time import monotonic, time
+from subprocess import TimeoutExpired
+from cmdwrapper import CmdWrapper, CmdRunning, CmdProcError, CmdEnv
+from cmdwrapper.cmdproc import CmdProc
+from cmdwrapper.cmdoutput import CmdOutput
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+MEGABYTE = 1024 * 1024
+
+
+def best_of(repeat, func):
+    """Return the shortest duration (seconds) of func() in 'repeat' runs."""
+    durations = []
+    for _ in range(repeat):
+        start = monotonic()
+        func()
+        durations.append(monotonic() - start)
+    return min(durations)
+
+
+def result(name, value, unit, higher_is_better=True):
+    """Return a result (a JSON object)."""
+    return {'name': name, 'value': value, 'unit': unit,
+            'higher_is_better': higher_is_better}
+
+
+def bench_calls(args):
+    """Calls per second of CmdWrapper('true')()."""
+    true = CmdWrapper('true')
+
+    def calls():
+        """Run 'true' args.count times."""
+        for _ in range(args.count):
+            true().wait()
+
+    return [result('calls/true', args.count / best_of(args.repeat, calls),
+                   'calls/s')]
+
+
+def bench_capture(args):
+    """Throughput of CmdProc.wait() capturing stdout."""
+    results = []
+    for size in args.sizes:
+        cmd = ['head', '-c', str(size * MEGABYTE), '/dev/zero']
+        duration = best_of(args.repeat, lambda: CmdProc(cmd).wait())
+        results.append(result('capture/{}MB'.format(size), size / duration,
+                              'MB/s'))
+    return results
+
+
+def bench_lines(args):
+    """Cost of CmdOutput.lines and CmdOutput.firstline."""
+    proc = CmdProc(['seq', '1', str(args.lines)])
+    proc.wait()
+    data = proc.stdout
+
+    cases = (('firstline', lambda output: output.firstline),
+             ('lines[0]', lambda output: output.lines[0]),
+             ('len(lines)', lambda output: len(output.lines)),
+             ('lines[-1]', lambda output: output.lines[-1]),
+             ('list(lines)', lambda output: list(output.lines)))
+
+    results = []
+    for name, func in cases:
+        duration = best_of(args.repeat, lambda: func(CmdOutput(data)))
+        results.append(result('lines/{}'.format(name), duration * 1000, 'ms',
+                              higher_is_better=False))
+    return results
+
+
+def bench_concurrency(args):
+    """Wall time of N CmdRunning('sleep') started at the same time."""
+    sleep = CmdWrapper('sleep')
+    results = []
+    for num in args.parallel:
+        def parallel():
+            """Start 'num' processes, wait for all of them."""
+            runnings = [sleep(str(args.sleep)) for _ in range(num)]
+            for running in runnings:
+                running.wait()
+
+        # what is added to the duration of one process
+        overhead = best_of(args.repeat, parallel) - args.sleep
+        results.append(result('concurrency/{}'.format(num), overhead * 1000,
+                              'ms', higher_is_better=False))
+    return results
+
+
+def bench_timeout(args):
+    """Cost of a timeout on a call, delay to kill an expired process."""
+    def calls(**kwargs):
+        """Run 'true' args.count times."""
+        for _ in range(args.count):
+            CmdRunning(CmdProc('true', **kwargs)).wait()
+
+    without = best_of(args.repeat, calls)
+    with_timeout = best_of(args.repeat, lambda: calls(timeout=60))
+
+    def expire():
+        """Run a process that exceeds its timeout."""
+        proc = CmdProc(['sleep', '10'], timeout=1)
+        try:
+            proc.wait()
+        except TimeoutExpired:
+            proc.kill()
+
+    # compare the two calls (the difference is smaller than the noise)
+    return [result('timeout/call-without', without / args.count * 1000000,
+                   'us', higher_is_better=False),
+            result('timeout/call-with', with_timeout / args.count * 1000000,
+                   'us', higher_is_better=False),
+            result('timeout/kill-delay', (best_of(1, expire) - 1) * 1000,
+                   'ms', higher_is_better=False)]
+
+
+def bench_env(args):
+    """Calls per second of 'true' with os.environ + 3 variables."""
+    extra = {'LC_ALL': 'C', 'TZ': 'UTC', 'BENCH': '1'}
+    true = CmdWrapper('true')
+
+    def calls(env_for_call):
+        """Run 'true' args.count times."""
+        for _ in range(args.count):
+            true(env=env_for_call()).wait()
+
+    env = CmdEnv(overrides=extra)
+    return [result('env/dict', args.count / best_of(
+        args.repeat, lambda: calls(lambda: dict(os.environ, **extra))),
+                   'calls/s'),
+            result('env/cmdenv', args.count / best_of(
+                args.repeat, lambda: calls(lambda: env)), 'calls/s')]
+
+
+CASES = {'calls': bench_calls,
+         'capture': bench_capture,
+         'lines': bench_lines,
+         'concurrency': bench_concurrency,
+         'timeout': bench_timeout,
+         'env': bench_env}
+
+
+def metadata():
+    """Return what identifies the version and the host."""
+    try:
+        revision = CmdWrapper('git', args=['describe', '--always', '--dirty'],
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              )().stdout.firstline
+    except (CmdProcError, OSError):
+        revision = None
+
+    return {'revision': revision,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'hostname': socket.gethostname(),
+            'cpu_count': os.cpu_count(),
+            'time': time()}
+
+
+def compare(old_report, new_report):
+    """Print the ratio new/old of each result (> 1 is better)."""
+    old_results = {item['name']: item for item in old_report['results']}
+    for item in new_report['results']:
+        old = old_results.get(item['name'])
+        if old is None or not old['value'] or not item['value']:
+            continue
+        ratio = item['value'] / old['value']
+        if not item['higher_is_better']:
+            ratio = 1 / ratio
+        print('{:28} {:12.2f} -> {:12.2f} {:6} {:6.2f}x'
+              .format(item['name'], old['value'], item['value'],
+                      item['unit'], ratio))
+
+
+def csv_ints(value):
+    """Parse '1,2,3'."""
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    """Run the benchmark suite."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='the cases to run (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each case (the best one is kept)')
+    parser.add_argument('--count', type=int, default=500,
+                        help='number of calls (calls, timeout, env)')
+    parser.add_argument('--sizes', type=csv_ints, default=[1, 100],
+                        help='captured sizes in MB (1,100,1024 for 1 GB)')
+    parser.add_argument('--lines', type=int, default=1000000,
+                        help='number of lines (lines)')
+    parser.add_argument('--parallel', type=csv_ints,
+                        default=[1, 2, 4, 8, 16, 32, 64],
+                        help='numbers of parallel processes (concurrency)')
+    parser.add_argument('--sleep', type=float, default=0.2,
+                        help='duration of the parallel processes')
+    parser.add_argument('--output', help='write the JSON report to a file')
+    parser.add_argument('--compare', help='compare with a JSON report')
+    args = parser.parse_args()
+
+    report = {'metadata': metadata(), 'results': []}
+    for name in args.cases.split(','):
+        report['results'] += CASES[name](args)
+
+    if args.output:
+        with open(args.output, 'w') as fhandle:
+            json.dump(report, fhandle, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fhandle:
+            compare(json.load(fhandle), report)
+    elif not args.output:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -11,29 +11,56 @@
 """Wrap any Linux command and run it as a Python method."""
 
 import sys
+import os
+import mmap
+from time import monotonic, sleep
 from copy import deepcopy
 from pprint import pformat
 from subprocess import PIPE, DEVNULL, STDOUT
 from cmdwrapper.cmdoutput import CmdOutput
-from cmdwrapper.cmdproc import CmdProc
-from cmdwrapper.cmdproc import CmdProcError    # noqa
+from cmdwrapper.cmdproc import CmdProc, BYTES_LIKE
+from cmdwrapper.cmdproc import CmdProcError, CmdProcTimeout    # noqa
+from cmdwrapper.cmdpoller import CmdReactor, run_many
+from cmdwrapper.cmdpipeline import CmdPipelineProc
+from cmdwrapper.cmdwhich import which
+from cmdwrapper.cmdcache import CmdCache
+from cmdwrapper.cmdcassette import CmdCassette
+from cmdwrapper.cmdenv import CmdEnv    # noqa
+from cmdwrapper.cmdretry import CmdRetry, CmdCircuitBreaker
+from cmdwrapper.cmdretry import CmdCircuitOpen    # noqa
+from cmdwrapper.cmdstats import CmdStats, CmdStatsCollector    # noqa
+from cmdwrapper.cmdhooks import CmdHooks    # noqa
+from cmdwrapper.cmdparse import iter_jsonl, iter_rows, iter_kv
 
 
-assert sys.version_info >= (3, 3), "The Python version need to be >= 3.3"
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
 
 
 # pylint: disable=too-few-public-methods
 class CmdResult(object):
     """The result of a command (stdout, stderr and return code)."""
 
-    def __init__(self, stdout, stderr, returncode):
-        """Init the CmdResult with stdout, stderr and returncode."""
-        assert isinstance(stdout, (bytes, str))
-        assert isinstance(stderr, (bytes, str))
+    # pylint: disable=too-many-arguments
+    def __init__(self, stdout, stderr, returncode, stats=None,
+                 encoding='utf-8', errors='ignore', attempts=1):
+        """Init the CmdResult with stdout, stderr and returncode.
+
+        stats is the resource usage of the process (CmdStats or None).
+        encoding and errors: how the output is decoded (see CmdOutput).
+        attempts: the number of times the command ran (see CmdRetry).
+
+        """
+        assert isinstance(stdout, (bytes, bytearray, memoryview, mmap.mmap,
+                                   str))
+        assert isinstance(stderr, (bytes, bytearray, memoryview, mmap.mmap,
+                                   str))
         assert isinstance(returncode, int)
-        self.stdout = CmdOutput(stdout)
-        self.stderr = CmdOutput(stderr)
+        assert isinstance(stats, (CmdStats, type(None)))
+        self.stdout = CmdOutput(stdout, encoding, errors)
+        self.stderr = CmdOutput(stderr, encoding, errors)
         self.returncode = returncode
+        self.stats = stats
+        self.attempts = attempts
 
     def __str__(self):
         """Return stdout."""
@@ -49,6 +76,12 @@ class CmdRunning(object):
         self.proc = cmd_proc
         self.proc.run()  # run the process automatically
 
+        # the retried calls (see CmdRetry): the number of attempts, the
+        # failures of the previous attempts and the delays between them
+        self.attempts = 1
+        self.failures = []
+        self.delays = []
+
     def wait(self):
         """Wait until the process is terminated.
 
@@ -69,13 +102,21 @@ class CmdRunning(object):
     def stdout(self):
         """Return stdout."""
         self.wait()
-        return CmdOutput(self.proc.stdout)
+        return CmdOutput(self.proc.stdout, self.proc.encoding,
+                         self.proc.errors)
 
     @property
     def stderr(self):
         """Return stderr."""
         self.wait()
-        return CmdOutput(self.proc.stderr)
+        return CmdOutput(self.proc.stderr, self.proc.encoding,
+                         self.proc.errors)
+
+    @property
+    def stats(self):
+        """Return the resource usage of the process (CmdStats)."""
+        self.wait()
+        return self.proc.stats
 
     @property
     def result(self):
@@ -83,24 +124,58 @@ class CmdRunning(object):
         self.wait()
         return CmdResult(stdout=self.proc.stdout,
                          stderr=self.proc.stderr,
-                         returncode=self.proc.returncode)
+                         returncode=self.proc.returncode,
+                         stats=self.proc.stats,
+                         encoding=self.proc.encoding,
+                         errors=self.proc.errors,
+                         attempts=self.attempts)
 
     def __iter__(self):
-        """Iter through stdout."""
-        # TODO: implement an stdout reader that can read from stdout while SSH
-        #       is running
-        for line in self.stdout.lines:
-            yield line
+        """Iter through stdout while the process is running.
+
+        The lines are yielded as soon as the command writes them and they are
+        not kept in memory (self.stdout only contains what was not consumed).
+
+        """
+        for line in self.proc.iter_lines():
+            if self.proc.encoding is None:
+                yield line
+            else:
+                yield line.decode(self.proc.encoding, self.proc.errors)
+
+    def iter_jsonl(self):
+        """Yield the JSON documents of stdout (JSON Lines) while it runs."""
+        return iter_jsonl(self)
+
+    def iter_rows(self, sep=None, header=True):
+        """Yield the rows of a table while it runs (see CmdOutput.columns)."""
+        return iter_rows(self, sep=sep, header=header)
+
+    def iter_kv(self, sep='='):
+        """Yield the (key, value) of the lines 'key=value' while it runs."""
+        return iter_kv(self, sep=sep)
 
 
 class CmdWrapper(object):
     """Wrap any Linux command and run it as a Python method."""
 
-    def __init__(self, cmd=None, args=None, **cmd_proc_kwargs):
+    # pylint: disable=too-many-arguments
+    def __init__(self, cmd=None, args=None, strict=False, cache=None,
+                 cassette=None, retry=None, breaker=None, **cmd_proc_kwargs):
         """Command + arguments to wrap.
 
         :cmd: the command.
         :args: the command's arguments.
+        :strict: raise CmdProcError now if the executable is not found
+                 (instead of an OSError on the first call).
+        :cache: a CmdCache. The results of the calls are cached (for the
+                commands that are idempotent only).
+        :cassette: a CmdCassette. The calls are recorded, or replayed
+                   without starting any process (see cmdwrapper.cmdcassette).
+        :retry: a CmdRetry. The calls that fail are retried (the call waits
+                until the command succeeds or the policy gives up).
+        :breaker: a CmdCircuitBreaker. No process is started after repeated
+                  failures: CmdCircuitOpen is raised.
         :**cmd_proc_kwargs: CmdProc class __init__ kwargs
                            (timeout, cwd, env, input, stdout, stderr...).
 
@@ -109,12 +184,12 @@ class CmdWrapper(object):
         >>> ssh('server', 'ls', '/')
 
         """
-        if cmd is not None:
-            assert isinstance(cmd, str)
-
-        # the internal variables
+        # the internal variables (the objects like CmdCapture, CmdEnv,
+        # CmdStatsCollector or CmdLauncher are shared, not copied)
         self._args = []
-        self._cmd_proc_kwargs = deepcopy(cmd_proc_kwargs)
+        self._cmd_proc_kwargs = dict(cmd_proc_kwargs)
+        if isinstance(self._cmd_proc_kwargs.get('env'), dict):
+            self._cmd_proc_kwargs['env'] = dict(self._cmd_proc_kwargs['env'])
 
         # setting the variables
         assert isinstance(cmd, (str, type(None)))
@@ -127,43 +202,291 @@ class CmdWrapper(object):
                 assert isinstance(item, str)
             self._args = list(args)
 
+        # checked once: the calls only add their arguments and their kwargs
+        CmdProc.check_options(**self._cmd_proc_kwargs)
+        self._cmd_proc_kwargs['checked'] = True
+        self._argv = ([] if cmd is None else [cmd]) + self._args
+
+        self._strict = strict
+        assert isinstance(cache, (CmdCache, type(None)))
+        self._cache = cache
+        assert isinstance(cassette, (CmdCassette, type(None)))
+        self._cassette = cassette
+        assert isinstance(retry, (CmdRetry, type(None)))
+        self._retry = retry
+        assert isinstance(breaker, (CmdCircuitBreaker, type(None)))
+        self._breaker = breaker
+        if strict and self._argv:
+            executable = which(self._argv[0], self._cmd_proc_kwargs.get('env'))
+            if executable is None or not os.access(executable, os.X_OK):
+                raise CmdProcError('command not found: {}'
+                                   .format(self._argv[0]))
+
     def __call__(self, *args, **cmd_proc_kwargs):
         """Run the command.
 
         >>> self('ssh', 'host')
 
         """
-        # command
-        cmd_args = [] if self._cmd is None else [self._cmd]
+        kwargs = self._cmd_proc_kwargs_for(args, cmd_proc_kwargs)
+        if self._cassette is not None:
+            key = self._cassette.key_for(kwargs)
+            if key is not None:
+                return self._cassette_running(key, kwargs)
 
-        # args
-        cmd_args = cmd_args + self._args + list(args)
+        if self._cache is not None:
+            key = self._cache.key_for(kwargs)
+            if key is not None:
+                return self._cached_running(key, kwargs)
 
-        # kwargs
-        kwargs = deepcopy(self._cmd_proc_kwargs)
-        kwargs.update(cmd_proc_kwargs)
+        if self._retry is not None or self._breaker is not None:
+            return self._retried_running(kwargs)
 
-        cmd_proc = CmdProc(cmd=cmd_args, **kwargs)
-        return CmdRunning(cmd_proc=cmd_proc)
+        return self._running(kwargs)
+
+    def map(self, args_list, max_workers=8, ordered=True, fail_fast=True,
+            **cmd_proc_kwargs):
+        """Run the command once per item of 'args_list' (tuples of args).
+
+        At most 'max_workers' processes are running at the same time and all
+        of them are handled by one thread (see cmdpoller.run_many()).
+
+        Yield a CmdResult() per item: in the order of 'args_list'
+        (ordered=True) or as soon as the process is completed.
+
+        :fail_fast: True: raise the first CmdProcError/TimeoutExpired (the
+                    other processes are killed). False: yield the results of
+                    the failed commands too.
+
+        The processes are started directly by the reactor: the wrapper must
+        not have a cache, a cassette, a retry policy or a circuit breaker
+        (call it in threads instead).
+
+        >>> ssh = CmdWrapper('ssh')
+        >>> for result in ssh.map([(host, 'uptime') for host in hosts]):
+        ...     print(result.stdout)
+
+        """
+        assert self._cache is None and self._cassette is None, \
+            'map() does not support the cache and the cassette'
+        assert self._retry is None and self._breaker is None, \
+            'map() does not support the retry policy and the circuit breaker'
+
+        cmd_procs = (CmdProc(**self._cmd_proc_kwargs_for(args,
+                                                         cmd_proc_kwargs))
+                     for args in args_list)
+
+        for cmd_proc in run_many(cmd_procs, max_workers=max_workers,
+                                 ordered=ordered, fail_fast=fail_fast):
+            yield CmdResult(stdout=cmd_proc.stdout,
+                            stderr=cmd_proc.stderr,
+                            returncode=cmd_proc.returncode,
+                            stats=cmd_proc.stats,
+                            encoding=cmd_proc.encoding,
+                            errors=cmd_proc.errors)
+
+    def _cmd_proc_kwargs_for(self, args, cmd_proc_kwargs):
+        """Return the CmdProc kwargs to run the command with 'args'.
+
+        The options of the wrapper are not copied (CmdProc does not modify
+        them): only the kwargs of the call are checked.
+
+        """
+        kwargs = self._cmd_proc_kwargs.copy()
+        if cmd_proc_kwargs:
+            CmdProc.check_options(**cmd_proc_kwargs)
+            kwargs.update(cmd_proc_kwargs)
+
+        # the retries, the cache and the cassettes handle bytes
+        if isinstance(kwargs.get('input'), BYTES_LIKE):
+            kwargs['input'] = bytes(kwargs['input'])
+        kwargs['cmd'] = self._argv + list(args)
+        return kwargs
 
     def __repr__(self):
         """Return the repr."""
         return pformat({'cmd': self._cmd, 'args': self._args,
-                        'cmd_proc_kwargs': self._cmd_proc_kwargs})
+                        'cmd_proc_kwargs': self._options()})
+
+    def _options(self):
+        """Return the CmdProc kwargs of the wrapper."""
+        kwargs = self._cmd_proc_kwargs.copy()
+        del kwargs['checked']
+        return kwargs
+
+    def _running(self, cmd_proc_kwargs):
+        """Return the CmdRunning() of a CmdProc(**cmd_proc_kwargs)."""
+        return CmdRunning(cmd_proc=CmdProc(**cmd_proc_kwargs))
+
+    def _cached_running(self, key, cmd_proc_kwargs):
+        """Return a CmdRunning() of the cached CmdResult (see CmdCache)."""
+        def run():
+            """Run the command, return (CmdResult, size)."""
+            proc = self._running(cmd_proc_kwargs).wait().proc
+            return (CmdResult(stdout=proc.stdout, stderr=proc.stderr,
+                              returncode=proc.returncode, stats=proc.stats,
+                              encoding=proc.encoding, errors=proc.errors),
+                    len(proc.stdout) + len(proc.stderr))
+
+        result = self._cache.get(key, run)
+        return CmdRunning(cmd_proc=CmdProc.completed(
+            stdout_data=result.stdout.bytes, stderr_data=result.stderr.bytes,
+            returncode=result.returncode, **cmd_proc_kwargs))
+
+    def _retried_running(self, cmd_proc_kwargs):
+        """Return the CmdRunning() of the first attempt that succeeds.
+
+        The attempts follow the CmdRetry and the CmdCircuitBreaker of the
+        wrapper. The last failure is raised when the policy gives up (its
+        attribute 'attempts' is the number of attempts). An input that is
+        read while the process runs (a file, an iterator) cannot be sent
+        twice: the command runs once.
+
+        """
+        retry = self._retry or CmdRetry(attempts=1)
+        input = cmd_proc_kwargs.get('input')
+        # pylint: disable=redefined-builtin
+        if not isinstance(input, (bytes, str, os.PathLike, type(None))):
+            retry = CmdRetry(attempts=1)
+
+        failures = []
+        delays = []
+        start = monotonic()
+        while True:
+            trial = self._breaker is not None and \
+                self._breaker.allow(' '.join(cmd_proc_kwargs['cmd']))
+
+            try:
+                running = self._running(cmd_proc_kwargs).wait()
+            except (CmdProcError, OSError) as err:
+                if self._breaker is not None:
+                    self._breaker.failure()
+                failures.append(err)
+                delay = retry.next_delay(err, len(failures),
+                                         monotonic() - start)
+                if delay is None:
+                    err.attempts = len(failures)
+                    raise
+                delays.append(delay)
+                sleep(delay)
+                continue
+            except BaseException:
+                # no outcome (KeyboardInterrupt...): the next call is the trial
+                if trial:
+                    self._breaker.release()
+                raise
+
+            if self._breaker is not None:
+                self._breaker.success()
+            running.attempts = len(failures) + 1
+            running.failures = failures
+            running.delays = delays
+            return running
+
+    def _cassette_running(self, key, cmd_proc_kwargs):
+        """Return a CmdRunning() of the call replayed by the cassette.
+
+        In record mode, the command runs first and its result is recorded
+        (CmdProcError is raised by the replayed process, like the real one).
+
+        """
+        if self._cassette.recording:
+            proc = self._running(cmd_proc_kwargs).proc
+            try:
+                proc.wait()
+            except CmdProcTimeout:
+                raise
+            except CmdProcError:
+                pass
+            entry = self._cassette.record(key, proc)
+        else:
+            entry = self._cassette.play(key)
+
+        return CmdRunning(cmd_proc=CmdProc.completed(
+            stdout_data=entry.stdout, stderr_data=entry.stderr,
+            returncode=entry.returncode, **cmd_proc_kwargs))
+
+    def __or__(self, other):
+        """Connect the stdout of this command to the stdin of 'other'.
+
+        >>> (find.bind('/data') | grep.bind('-v', 'tmp') | wc.bind('-l'))()
+
+        """
+        return CmdPipeline([self]) | other
 
     def copy(self, cmd=None, args=None, **cmd_proc_kwargs):
         """Copy the object."""
         cmd = cmd if cmd else self._cmd
         args = args if args else self._args
-        kwargs = deepcopy(self._cmd_proc_kwargs)
+        kwargs = {'strict': self._strict, 'cache': self._cache,
+                  'cassette': self._cassette, 'retry': self._retry,
+                  'breaker': self._breaker}
+        kwargs.update(self._options())
         kwargs.update(cmd_proc_kwargs)
-        return CmdWrapper(cmd=cmd, args=args, **kwargs)
+        return type(self)(cmd=cmd, args=args, **kwargs)
+
+    def bind(self, *args, **cmd_proc_kwargs):
+        """Return a copy of the object with more arguments (and kwargs).
+
+        >>> ls_root = CmdWrapper('ls').bind('/')
+
+        """
+        return self.copy(args=self._args + list(args), **cmd_proc_kwargs)
 
     def get(self, option):
         """Return an option's value (env, cwd, cmd, args, etc.)."""
         return self._cmd_proc_kwargs[option]
 
 
+class CmdPipeline(object):
+    """CmdWrapper instances connected with OS pipes (see CmdPipelineProc).
+
+    >>> find, grep = CmdWrapper('find'), CmdWrapper('grep')
+    >>> wc = CmdWrapper('wc')
+    >>> pipeline = find.bind('/data') | grep.bind('-v', 'tmp') | wc.bind('-l')
+    >>> pipeline(timeout=60).stdout.firstline
+
+    """
+
+    def __init__(self, wrappers):
+        """Init the pipeline with a list of CmdWrapper."""
+        assert isinstance(wrappers, list)
+        for wrapper in wrappers:
+            assert isinstance(wrapper, CmdWrapper)
+        self._wrappers = list(wrappers)
+
+    def __or__(self, other):
+        """Add a CmdWrapper (or the stages of a CmdPipeline) to the end."""
+        if isinstance(other, CmdPipeline):
+            return CmdPipeline(self._wrappers + other._wrappers)
+
+        return CmdPipeline(self._wrappers + [other])
+
+    def __call__(self, timeout=None, **cmd_proc_kwargs):
+        """Run the pipeline. Return a CmdRunning().
+
+        :timeout: the timeout of the whole pipeline.
+        :**cmd_proc_kwargs: 'input' is sent to the first command, 'stdout' is
+                            used by the last one and the other kwargs (cwd,
+                            env, stderr...) by all the commands.
+
+        """
+        stages = []
+        for num, wrapper in enumerate(self._wrappers):
+            # pylint: disable=protected-access
+            kwargs = wrapper._cmd_proc_kwargs_for((), cmd_proc_kwargs)
+            kwargs.pop('timeout', None)
+            if num > 0:
+                kwargs.pop('input', None)
+            stages.append(CmdProc(**kwargs))
+
+        return CmdRunning(cmd_proc=CmdPipelineProc(stages, timeout=timeout))
+
+    def __repr__(self):
+        """Return the repr."""
+        return ' | '.join(repr(wrapper) for wrapper in self._wrappers)
+
+
 # TODO: remove this class
 class LegacyCmdWrapper(object):
     """Wrap any Linux command and run it as a Python method."""
@@ -263,7 +586,7 @@ class LegacyCmdWrapper(object):
 
     def timeout(self, timeout):
         """The default timeout."""
-        assert isinstance(timeout, int)
+        assert isinstance(timeout, (int, float))
         self._cmd_proc_kwargs['timeout'] = timeout
         return self
 
@@ -281,14 +604,17 @@ class LegacyCmdWrapper(object):
 
     def input(self, content):
         """The stdin's content."""
-        assert isinstance(content, bytes)
-        self._cmd_proc_kwargs['input'] = content
+        assert isinstance(content, BYTES_LIKE)
+        self._cmd_proc_kwargs['input'] = bytes(content)
         return self
 
     def output(self, stdout=PIPE, stderr=PIPE):
-        """Modify the output. Values: PIPE, DEVNULL, STDOUT or None."""
-        assert stdout in (PIPE, DEVNULL, STDOUT, None)
-        assert stderr in (PIPE, DEVNULL, STDOUT, None)
+        """Modify the output. Values: PIPE, DEVNULL, STDOUT, None or a file.
+
+        A file is a path, a CmdRedirect, an open file or a file descriptor
+        (checked by CmdProc).
+
+        """
         self._cmd_proc_kwargs['stdout'] = stdout
         self._cmd_proc_kwargs['stderr'] = stderr
         return self
@@ -358,12 +684,219 @@ def main():
 
             running = bash('cat', input=b'HIWORLD')
             self.assertEqual(running.stdout.firstline, 'HIWORLD')
+            self.assertEqual(CmdWrapper('cat')(input=bytearray(b'abc'))
+                             .stdout.firstline, 'abc')
+            self.assertEqual(CmdWrapper('cat', input=memoryview(b'def'))()
+                             .stdout.firstline, 'def')
 
             cmd_result = running.result
             self.assertEqual(str(running.stdout), str(cmd_result.stdout))
             self.assertEqual(str(running.stderr), str(cmd_result.stderr))
             self.assertEqual(running.returncode, cmd_result.returncode)
 
+            results = bash.map([('echo {}'.format(num),)
+                                for num in range(20)], max_workers=4)
+            self.assertEqual([result.stdout.firstline for result in results],
+                             [str(num) for num in range(20)])
+
+            results = bash.map([('exit 0',), ('exit 3',)], fail_fast=False)
+            self.assertEqual([result.returncode for result in results],
+                             [0, 3])
+
+            with self.assertRaises(CmdProcError):
+                list(bash.map([('exit 0',), ('exit 3',)]))
+
+            with self.assertRaises(AssertionError):
+                list(bash.copy(retry=CmdRetry()).map([('exit 0',)]))
+
+            # the options are checked once and not copied for each call
+            self.assertIs(bash._cmd_proc_kwargs_for((), {})['env'],
+                          bash.get('env'))
+            running = bash('wc -l', input=(b'line\n' for _ in range(3)))
+            self.assertEqual(running.stdout.firstline, '3')
+            with self.assertRaises(AssertionError):
+                bash('true', timeout='1')
+
+            self.assertIsNotNone(CmdWrapper('ls', strict=True).bind('/'))
+            with self.assertRaises(CmdProcError):
+                CmdWrapper('xxx-rrr-cmdwrapper', strict=True)
+            with self.assertRaises(CmdProcError):
+                CmdWrapper('/xxx/rrr/cmdwrapper', strict=True)
+            with self.assertRaises(OSError):
+                CmdWrapper('xxx-rrr-cmdwrapper')()
+
+            pipeline = bash.bind('seq 1 100') \
+                | CmdWrapper('grep', args=['5']) | CmdWrapper('wc').bind('-l')
+            running = pipeline(timeout=5)
+            self.assertEqual(running.stdout.firstline, '19')
+            self.assertEqual(running.proc.returncodes, [0, 0, 0])
+
+            tr_upper = CmdWrapper('tr', args=['a-z', 'A-Z'])
+            running = (tr_upper | CmdPipeline([CmdWrapper('grep').bind('5')]))(
+                input=b'a5\nb\n5c\n')
+            self.assertEqual(list(running), ['A5', '5C'])
+
+    class TestCmdCache(unittest.TestCase):
+        """Testing CmdWrapper(cache=CmdCache())."""
+
+        def test_cache(self):
+            """Test: CmdWrapper(cache=CmdCache())."""
+            cache = CmdCache(ttl=30)
+            date = CmdWrapper('bash', args=['-c', 'date +%s%N; echo ERR >&2'],
+                              cache=cache)
+            first = date().stdout.firstline
+            self.assertEqual(date().stdout.firstline, first)
+            self.assertEqual(date.bind()().stdout.firstline, first)
+            self.assertIn('ERR', date().stderr.lines)
+            self.assertEqual(list(date()), [first])
+            self.assertEqual(date().returncode, 0)
+            self.assertEqual((cache.hits, cache.misses), (5, 1))
+
+            # the input is a part of the key
+            cat = CmdWrapper('cat', cache=cache)
+            self.assertEqual(cat(input=b'1').stdout.firstline, '1')
+            self.assertEqual(cat(input=b'2').stdout.firstline, '2')
+            self.assertEqual(cat(input=bytearray(b'2')).stdout.firstline, '2')
+            self.assertEqual((cache.hits, cache.misses), (6, 3))
+
+            cache.invalidate()
+            self.assertNotEqual(date().stdout.firstline, first)
+
+            # the errors are not cached
+            false = CmdWrapper('false', cache=cache)
+            for _ in range(2):
+                with self.assertRaises(CmdProcError):
+                    false().wait()
+            self.assertEqual(len(cache), 1)
+
+    class TestCmdCassette(unittest.TestCase):
+        """Testing CmdWrapper(cassette=CmdCassette())."""
+
+        def test_cassette(self):
+            """Test: record, then replay without processes."""
+            import tempfile
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'test.cassette')
+                with CmdCassette(path, mode='record') as cassette:
+                    bash = CmdWrapper('bash', args=['-c'], cassette=cassette)
+                    # the same call, recorded in order
+                    pids = [bash.copy()('echo $$').stdout.firstline
+                            for _ in range(3)]
+                    with self.assertRaises(CmdProcError):
+                        bash('echo ERR >&2; exit 2').wait()
+                    self.assertEqual(list(bash('seq 1 3')), ['1', '2', '3'])
+                    # not recorded: the input is an iterator
+                    bash('cat', input=iter([b'x'])).wait()
+
+                hooks = CmdHooks()
+                spawned = []
+                hooks.register('before_spawn', lambda cmd_proc, **info:
+                               spawned.append(cmd_proc))
+                with CmdCassette(path) as cassette:
+                    bash = CmdWrapper('bash', args=['-c'], cassette=cassette,
+                                      hooks=hooks)
+                    self.assertEqual([bash('echo $$').stdout.firstline
+                                      for _ in range(4)],
+                                     pids + pids[-1:])
+                    with self.assertRaises(CmdProcError) as context:
+                        bash('echo ERR >&2; exit 2').wait()
+                    self.assertIn('ERR', str(context.exception))
+                    running = bash('seq 1 3')
+                    self.assertEqual(running.stdout.lines, ['1', '2', '3'])
+                    self.assertEqual(running.result.returncode, 0)
+                    with self.assertRaises(CmdProcError):
+                        bash('echo not recorded')
+                    self.assertEqual(spawned, [])
+
+    class TestCmdRetry(unittest.TestCase):
+        """Testing CmdWrapper(retry=CmdRetry(), breaker=...)."""
+
+        def test_retry(self):
+            """Test: CmdWrapper(retry=CmdRetry())."""
+            import tempfile
+            with tempfile.TemporaryDirectory() as tmpdir:
+                # fails twice (index.lock), then succeeds
+                counter = os.path.join(tmpdir, 'counter')
+                flaky = CmdWrapper('bash', args=['-c', 'echo >> {0}; '
+                                                 '[ $(wc -l < {0}) -ge 3 ] || '
+                                                 '{{ echo index.lock >&2; '
+                                                 'exit 128; }}; echo OK'
+                                                 .format(counter)],
+                                   retry=CmdRetry(attempts=5, backoff=0.01,
+                                                  stderr=r'index\.lock'))
+                running = flaky()
+                self.assertEqual(running.stdout.firstline, 'OK')
+                self.assertEqual(running.attempts, 3)
+                self.assertEqual([err.cmd_proc.returncode
+                                  for err in running.failures], [128, 128])
+                self.assertEqual(len(running.delays), 2)
+                self.assertEqual(running.result.attempts, 3)
+
+            # the other failures are not retried
+            false = CmdWrapper('false', retry=CmdRetry(returncodes=[2]))
+            with self.assertRaises(CmdProcError) as context:
+                false()
+            self.assertEqual(context.exception.attempts, 1)
+
+            false = false.copy(retry=CmdRetry(attempts=3, backoff=0.01))
+            with self.assertRaises(CmdProcError) as context:
+                false()
+            self.assertEqual(context.exception.attempts, 3)
+
+            # the deadline stops the attempts
+            false = false.copy(retry=CmdRetry(attempts=100, backoff=0.05,
+                                              factor=1, jitter=False,
+                                              deadline=0.2))
+            with self.assertRaises(CmdProcError) as context:
+                false()
+            self.assertLess(context.exception.attempts, 6)
+
+            # an iterator cannot be sent twice
+            cat = CmdWrapper('bash', args=['-c', 'cat; exit 1'],
+                             retry=CmdRetry(backoff=0.01))
+            with self.assertRaises(CmdProcError) as context:
+                cat(input=iter([b'a']))
+            self.assertEqual(context.exception.attempts, 1)
+
+        def test_breaker(self):
+            """Test: CmdWrapper(breaker=CmdCircuitBreaker())."""
+            hooks = CmdHooks()
+            spawned = []
+            hooks.register('before_spawn', lambda cmd_proc, **info:
+                           spawned.append(cmd_proc))
+            breaker = CmdCircuitBreaker(failures=2, reset_after=60)
+            false = CmdWrapper('false', breaker=breaker, hooks=hooks)
+            for _ in range(2):
+                with self.assertRaises(CmdProcError):
+                    false()
+            with self.assertRaises(CmdCircuitOpen):
+                false()
+            self.assertEqual(len(spawned), 2)
+
+            # the breaker is shared by the copies, it stops the retries
+            with self.assertRaises(CmdCircuitOpen):
+                false.copy(retry=CmdRetry(backoff=0.01))()
+            self.assertEqual(breaker.state, 'open')
+
+            true = CmdWrapper('true', breaker=CmdCircuitBreaker())
+            self.assertEqual(true().returncode, 0)
+
+            # the trial is interrupted: the next call is the trial
+            def interrupted():
+                """Interrupt the call."""
+                yield b'x'
+                raise KeyboardInterrupt
+
+            breaker = CmdCircuitBreaker(failures=1, reset_after=0)
+            cat = CmdWrapper('cat', breaker=breaker)
+            with self.assertRaises(CmdProcError):
+                cat('/xxx/rrr/cmdwrapper')
+            with self.assertRaises(KeyboardInterrupt):
+                cat(input=interrupted())
+            self.assertEqual(breaker.state, 'half-open')
+            self.assertEqual(cat(input=b'1').stdout.firstline, '1')
+            self.assertEqual(breaker.state, 'closed')
+
     class TestCmdRunning(unittest.TestCase):
         """Testing the class CmdRunning."""
 
@@ -378,16 +911,118 @@ def main():
             running = CmdRunning(CmdProc('true'))
             self.assertEqual(running.returncode, 0)
 
-    ret = 0
+            running = CmdRunning(CmdProc('printf "1\\n2\\n3"'))
+            self.assertEqual(list(running), ['1', '2', '3'])
+            self.assertEqual(running.returncode, 0)
+
+            running = CmdRunning(CmdProc(['bash', '-c', 'for i in {1..30000}; '
+                                          'do :; done']))
+            self.assertGreater(running.stats.user_time, 0)
+            self.assertGreater(running.stats.max_rss, 0)
+            self.assertGreater(running.stats.wall_time, 0)
+            self.assertIs(running.result.stats, running.stats)
+
+            collector = CmdStatsCollector()
+            true = CmdWrapper('true', collector=collector)
+            for _ in range(5):
+                true().wait()
+            list(true.map([()] * 5))
+            (CmdWrapper('seq', args=['1', '10']) | CmdWrapper('wc'))(
+                collector=collector).wait()
+            summary = collector.summary()
+            self.assertEqual(summary['true']['count'], 10)
+            self.assertEqual(summary['seq']['count'], 1)
+            self.assertIn('p90', summary['true']['wall_time'])
+
+            # completed by a reactor (one thread for all the processes)
+            reactor = CmdReactor()
+            runnings = [CmdRunning(CmdProc(['echo', str(num)]))
+                        for num in range(5)]
+            for running in runnings:
+                reactor.register(running)
+            self.assertEqual(len(reactor.wait()), 5)
+            self.assertTrue(all(running.proc.wait() is False
+                                for running in runnings))
+            self.assertEqual([running.stdout.firstline
+                              for running in runnings],
+                             [str(num) for num in range(5)])
+            reactor.close()
+
+            # the parsers of the live output
+            bash = CmdWrapper('bash', args=['-c'])
+            self.assertEqual(list(bash('echo \'{"a": 1}\'; echo [2]')
+                                  .iter_jsonl()), [{'a': 1}, [2]])
+            self.assertEqual(list(bash('printf "A B\\n1 2\\n"')
+                                  .iter_rows()), [{'A': '1', 'B': '2'}])
+            self.assertEqual(dict(bash('echo X=1; echo Y=2').iter_kv()),
+                             {'X': '1', 'Y': '2'})
+            self.assertEqual(bash('echo X=1').stdout.kv(), {'X': '1'})
+
+            # the hooks are passed to each CmdProc
+            exits = []
+            hooks = CmdHooks()
+            hooks.register('on_exit', lambda cmd_proc, **info:
+                           exits.append(info['returncode']))
+            echo = CmdWrapper('echo', hooks=hooks)
+            echo('1').wait()
+            list(echo.map([('2',), ('3',)]))
+            self.assertEqual(exits, [0, 0, 0])
+
+        def test_encoding(self):
+            """Test: CmdWrapper(encoding=..., errors=...)."""
+            from cmdwrapper.cmdcapture import CmdCaptureText
+            printf = CmdWrapper('printf', args=['caf\\351\\n\\377'])
+            self.assertEqual(printf().stdout.output, 'caf\n')
+            self.assertEqual(printf(encoding='latin-1').stdout.lines,
+                             ['caf\u00e9', '\u00ff'])
+            self.assertEqual(list(printf(encoding='latin-1')),
+                             ['caf\u00e9', '\u00ff'])
+            self.assertEqual(list(printf(encoding=None)),
+                             [b'caf\xe9', b'\xff'])
+            self.assertEqual(printf(encoding=None).result.stdout.output,
+                             b'caf\xe9\n\xff')
+
+            # decoded while it is read
+            running = printf(encoding='latin-1',
+                             stdout_capture=CmdCaptureText())
+            self.assertEqual(running.wait().proc.stdout, 'caf\u00e9\n\u00ff')
+            self.assertEqual(running.stdout.bytes, b'caf\xe9\n\xff')
+            running = printf(errors='surrogateescape',
+                             stdout_capture=CmdCaptureText())
+            self.assertEqual(running.stdout.bytes, b'caf\xe9\n\xff')
+
+            # the text is replayed by the cache with the same encoding
+            cache = CmdCache()
+            printf = printf.copy(cache=cache, encoding='cp1252',
+                                 stdout_capture=CmdCaptureText())
+            for _ in range(2):
+                self.assertEqual(printf().stdout.firstline, 'caf\u00e9')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            with self.assertRaises(AssertionError):
+                CmdWrapper('true', encoding='nonexistent')
+            with self.assertRaises(AssertionError):
+                CmdWrapper('true', errors='nonexistent')
+
+    ret = True
 
     tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdResult)
-    ret |= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    ret &= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdCache)
+    ret &= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdCassette)
+    ret &= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdRetry)
+    ret &= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
 
     tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdRunning)
-    ret |= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    ret &= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
 
     tests = unittest.TestLoader().loadTestsFromTestCase(TestLegacyCmdWrapper)
-    ret |= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    ret &= unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
 
     sys.exit(int(not ret))
 
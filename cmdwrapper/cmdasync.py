@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Run the wrapped commands with asyncio (one event loop, no threads)."""
+
+import sys
+import logging
+import signal
+import asyncio
+from time import monotonic
+from cmdwrapper import CmdWrapper, CmdResult
+from cmdwrapper.cmdoutput import CmdOutput
+from cmdwrapper.cmdproc import CmdProc, CHUNK_SIZE, split_chunk, \
+    join_pending
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class AsyncCmdProc(CmdProc):
+    """Same as CmdProc, but built on top of the asyncio subprocesses.
+
+    The coroutines have their own names (async_run(), async_wait()...):
+    the methods of CmdProc are not overridden and still run the process
+    synchronously.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Init the process (same arguments as CmdProc)."""
+        super().__init__(*args, **kwargs)
+        self._tasks = []
+
+    async def async_run(self):
+        """Run the command (coroutine version of CmdProc.run())."""
+        # Avoid running the process 2 times
+        if self._proc is not None:
+            return False
+
+        if self._opts['cwd'] or self._opts['timeout']:
+            logging.debug('[RUN-OPTIONS] CWD:%s TIMEOUT:%s',
+                          str(self._opts['cwd']), str(self._opts['timeout']))
+
+        logging.debug('[RUN-CMD] %s', self._cmd_str)
+
+        # manage the stdin
+        stdin, stdin_file = self._open_input()
+
+        # Run the process
+        self._emit('before_spawn')
+        start_time = monotonic()
+        opened = [stdin_file]
+        try:
+            self._proc = await asyncio.create_subprocess_exec(
+                *self._cmd_list,
+                stdout=self._open_output(self._opts['stdout'], opened),
+                stderr=self._open_output(self._opts['stderr'], opened),
+                stdin=stdin,
+                cwd=self._opts['cwd'],
+                env=self._spawn_env(),
+                executable=self._executable(),
+                start_new_session=self._new_session)
+        except OSError as err:
+            self._emit('on_error', error=err)
+            raise
+        finally:
+            for fileobj in opened:
+                if fileobj is not None:
+                    fileobj.close()
+        self._emit('after_spawn', pid=self._proc.pid,
+                   spawn_time=monotonic() - start_time)
+
+        if self._opts['timeout'] is not None:
+            self._deadline = monotonic() + self._opts['timeout']
+
+        # stdin and stderr are handled in the background
+        if self._proc.stdin is not None:
+            self._tasks.append(asyncio.ensure_future(self._write_stdin()))
+
+        if self._proc.stderr is not None:
+            self._tasks.append(asyncio.ensure_future(self._read_stderr()))
+
+        return True
+
+    async def async_wait(self):
+        """Wait until the process is terminated (see CmdProc.wait())."""
+        if self._done:
+            # The process is stopped
+            return False
+
+        await self.async_run()
+
+        chunks = self._async_communicate()
+        async for chunk in chunks:
+            self._stdout_buffer.write(chunk)
+            if getattr(self._stdout_buffer, 'done', False):
+                await chunks.aclose()
+                self.stopped_early = True
+                await self._kill_group()
+                await self._cancel_tasks()
+                break
+
+        self._finish()
+        return True
+
+    async def async_iter_chunks(self):
+        """Yield the stdout chunks as soon as the command writes them.
+
+        Same behavior as CmdProc.iter_chunks().
+
+        """
+        if self._done:
+            return
+
+        await self.async_run()
+
+        async for chunk in self._async_communicate():
+            yield chunk
+
+        self._finish()
+
+    async def async_iter_lines(self):
+        """Yield the stdout lines (bytes, without the line endings)."""
+        pending = []
+        async for chunk in self.async_iter_chunks():
+            for line in split_chunk(pending, chunk):
+                yield line
+
+        if pending:
+            yield join_pending(pending)
+
+    async def _write_stdin(self):
+        """Write the input chunks to stdin, then close it."""
+        try:
+            for chunk in self._input_chunks:
+                self._proc.stdin.write(chunk)
+                await self._proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self._proc.stdin.close()
+
+    async def _read_stderr(self):
+        """Read stderr until EOF."""
+        while True:
+            data = await self._proc.stderr.read(CHUNK_SIZE)
+            if not data:
+                break
+            self._emit('on_output_chunk', stream='stderr', data=data)
+            self._stderr_buffer.write(data)
+
+    async def _async_communicate(self):
+        """Read stdout until EOF (yield the chunks), then wait the exit."""
+        proc = self._proc
+        try:
+            while proc.stdout is not None:
+                data = await asyncio.wait_for(proc.stdout.read(CHUNK_SIZE),
+                                              self._remaining())
+                if not data:
+                    break
+                self._emit('on_output_chunk', stream='stdout', data=data)
+                yield data
+
+            await asyncio.wait_for(asyncio.gather(proc.wait(), *self._tasks),
+                                   self._remaining())
+        except asyncio.TimeoutError:
+            self._emit('on_timeout', timeout=self._opts['timeout'])
+            await self._cancel_tasks()
+            await self._kill_group()
+            self._timeout_killed()
+
+    async def _cancel_tasks(self):
+        """Cancel the stdin/stderr tasks and wait until they are done."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _kill_group(self):
+        """Kill the process group: SIGTERM, SIGKILL after kill_grace."""
+        self._signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self._proc.wait(),
+                                   self._opts['kill_grace'])
+        except asyncio.TimeoutError:
+            pass
+        self._signal(signal.SIGKILL)
+        await self._proc.wait()
+
+
+class AsyncCmdRunning(object):
+    """A running process (asyncio version of CmdRunning).
+
+    The process starts the first time it is awaited or iterated.
+
+    >>> running = await AsyncCmdWrapper('ls')('/')
+    >>> running.stdout.lines
+
+    """
+
+    def __init__(self, cmd_proc):
+        """Init the process."""
+        assert isinstance(cmd_proc, AsyncCmdProc)
+        self.proc = cmd_proc
+
+    def __await__(self):
+        """Wait until the process is terminated. Return self."""
+        return self.wait().__await__()
+
+    async def wait(self):
+        """Wait until the process is terminated.
+
+        If the returncode != 0 an exception will be raised.
+        :Returns: self
+
+        """
+        await self.proc.async_wait()
+        return self
+
+    @property
+    def returncode(self):
+        """Return the exit code of the command (None if not awaited)."""
+        return self.proc.returncode
+
+    @property
+    def stdout(self):
+        """Return stdout."""
+        return CmdOutput(self.proc.stdout, self.proc.encoding,
+                         self.proc.errors)
+
+    @property
+    def stderr(self):
+        """Return stderr."""
+        return CmdOutput(self.proc.stderr, self.proc.encoding,
+                         self.proc.errors)
+
+    @property
+    def result(self):
+        """Return a CmdResult() instance (stdout, stderr and returncode)."""
+        return CmdResult(stdout=self.proc.stdout,
+                         stderr=self.proc.stderr,
+                         returncode=self.proc.returncode,
+                         stats=self.proc.stats,
+                         encoding=self.proc.encoding,
+                         errors=self.proc.errors)
+
+    async def __aiter__(self):
+        """Iterate through stdout while the process is running."""
+        async for line in self.proc.async_iter_lines():
+            if self.proc.encoding is None:
+                yield line
+            else:
+                yield line.decode(self.proc.encoding, self.proc.errors)
+
+
+class AsyncCmdWrapper(CmdWrapper):
+    """Wrap any Linux command and run it as a Python coroutine.
+
+    >>> ls = AsyncCmdWrapper('ls')
+    >>> running = await ls('/')
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, cmd=None, args=None, strict=False, cache=None,
+                 cassette=None, retry=None, breaker=None, **cmd_proc_kwargs):
+        """Command + arguments to wrap (see CmdWrapper).
+
+        cache, cassette, retry and breaker are not supported (they wait
+        synchronously): they must be None.
+
+        """
+        for name, value in (('cache', cache), ('cassette', cassette),
+                            ('retry', retry), ('breaker', breaker)):
+            assert value is None, \
+                "AsyncCmdWrapper does not support '{}'".format(name)
+        super().__init__(cmd=cmd, args=args, strict=strict,
+                         **cmd_proc_kwargs)
+
+    def _running(self, cmd_proc_kwargs):
+        """Return the AsyncCmdRunning()."""
+        return AsyncCmdRunning(cmd_proc=AsyncCmdProc(**cmd_proc_kwargs))
+
+
+def main():
+    """Test the class AsyncCmdWrapper."""
+    import unittest
+    from subprocess import TimeoutExpired
+    from cmdwrapper.cmdproc import CmdProcError
+
+    def run(coro):
+        """Run a coroutine in a new event loop."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    class TestAsyncCmdWrapper(unittest.TestCase):
+        """Testing the class AsyncCmdWrapper."""
+
+        def test_async_cmdwrapper(self):
+            """Test: AsyncCmdWrapper()."""
+            bash = AsyncCmdWrapper('bash', args=['-c'], cwd='/', timeout=5,
+                                   env={'TEST': 'HIWORLD'})
+
+            running = run(bash('echo $TEST; pwd; echo ERR >&2'))
+            self.assertEqual(running.stdout.lines, ['HIWORLD', '/'])
+            self.assertIn('ERR', running.stderr.lines)
+            self.assertEqual(running.returncode, 0)
+            self.assertIsInstance(running.result, CmdResult)
+
+            running = run(bash('cat', input=b'HIWORLD'))
+            self.assertEqual(running.stdout.firstline, 'HIWORLD')
+
+            running = run(bash('wc -l', input=(b'line\n' for _ in range(5))))
+            self.assertEqual(running.stdout.firstline, '5')
+
+            with self.assertRaises(CmdProcError):
+                run(bash('exit 3'))
+
+            with self.assertRaises(TimeoutExpired):
+                run(bash('sleep 10', timeout=1))
+
+        def test_async_cmdproc(self):
+            """Test: AsyncCmdProc coroutines and the sync methods."""
+            async def collect(proc):
+                """Collect the lines."""
+                return [line async for line in proc.async_iter_lines()]
+
+            proc = AsyncCmdProc(['printf', 'a\\nb'])
+            self.assertEqual(run(collect(proc)), [b'a', b'b'])
+            self.assertFalse(run(proc.async_wait()))
+
+            # the methods of CmdProc are not overridden
+            proc = AsyncCmdProc(['echo', 'SYNC'], timeout=5)
+            self.assertTrue(proc.wait())
+            self.assertEqual(proc.stdout, b'SYNC\n')
+            with self.assertRaises(TimeoutExpired):
+                AsyncCmdProc(['sleep', '10'], timeout=0.5,
+                             kill_grace=0).wait()
+
+        def test_async_iter(self):
+            """Test: async for line in AsyncCmdRunning()."""
+            async def collect():
+                """Collect the lines (the first one before the exit)."""
+                lines = []
+                running = AsyncCmdWrapper('bash')('-c', 'echo 1; sleep 5; '
+                                                  'echo 2')
+                async for line in running:
+                    lines.append((line, running.returncode))
+                return lines
+
+            self.assertEqual(run(collect()), [('1', None), ('2', None)])
+
+        def test_concurrency(self):
+            """Test: many commands on the same event loop."""
+            sleep = AsyncCmdWrapper('sleep')
+
+            async def concurrent():
+                """Run 20 sleeps concurrently."""
+                start = asyncio.get_event_loop().time()
+                await asyncio.gather(*[sleep('1') for _ in range(20)])
+                return asyncio.get_event_loop().time() - start
+
+            self.assertLess(run(concurrent()), 5)
+
+        def test_filter(self):
+            """Test: the capture policy stops the process."""
+            from cmdwrapper.cmdcapture import CmdCaptureFilter
+            seq = AsyncCmdWrapper('seq', args=['1', '1000000000'])
+            result = run(seq(stdout_capture=CmdCaptureFilter(r'^7', head=2)))
+            self.assertEqual(result.stdout.lines, ['7', '70'])
+
+            # the stderr task is done before the result is stored
+            bash = AsyncCmdWrapper('bash', args=['-c'], timeout=10)
+            result = run(bash('(sleep 10 &); seq 1 1000000000',
+                              stdout_capture=CmdCaptureFilter(r'^7', head=1)))
+            self.assertEqual(result.stdout.lines, ['7'])
+            self.assertTrue(all(task.done() for task in result.proc._tasks))
+
+        def test_unsupported(self):
+            """Test: the options that wait synchronously are rejected."""
+            from cmdwrapper import CmdCache, CmdRetry
+            with self.assertRaises(AssertionError):
+                AsyncCmdWrapper('ls', cache=CmdCache())
+            with self.assertRaises(AssertionError):
+                AsyncCmdWrapper('ls', retry=CmdRetry())
+            self.assertIsInstance(AsyncCmdWrapper('ls').copy(timeout=1),
+                                  AsyncCmdWrapper)
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestAsyncCmdWrapper)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Cache the results of the commands that are idempotent (read-only)."""
+
+import sys
+import os
+import hashlib
+import threading
+from time import monotonic
+from collections import OrderedDict
+from subprocess import PIPE, DEVNULL, STDOUT
+from cmdwrapper.cmdenv import CmdEnv, env_digest
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class _CmdCacheEntry(object):
+    """A cached value."""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, value, size, expires, mtimes):
+        """Init the entry."""
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.mtimes = mtimes
+
+
+class _CmdCacheFlight(object):
+    """A value that is being computed (the other callers wait for it)."""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        """Init the flight."""
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CmdCache(object):
+    """A cache of CmdResult (LRU + TTL + byte budget), shared by threads.
+
+    >>> lsblk = CmdWrapper('lsblk', args=['-J'], cache=CmdCache(ttl=30))
+    >>> lsblk().stdout     # runs lsblk
+    >>> lsblk().stdout     # from the cache (during 30 seconds)
+
+    The key is the argv, cwd, env, stdout/stderr and the hash of the input
+    (the commands that read a file or an iterator are not cached). Only the
+    commands that succeed (returncode 0) are cached.
+
+    When identical calls are made at the same time by several threads, only
+    one process is started (single-flight): the other threads wait for its
+    result (or its exception).
+
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, ttl=None, max_entries=None, max_bytes=None,
+                 depends=None):
+        """Init the cache.
+
+        :ttl: the entries expire after 'ttl' seconds (None = never).
+        :max_entries: the maximum number of entries (LRU eviction).
+        :max_bytes: the maximum size of the cached outputs (LRU eviction).
+        :depends: a list of paths. The entries are invalidated when the
+                  mtime of one of these files changes (/var/lib/dpkg/status
+                  for 'dpkg -l', for example).
+
+        """
+        assert isinstance(ttl, (int, float, type(None)))
+        assert isinstance(max_entries, (int, type(None)))
+        assert isinstance(max_bytes, (int, type(None)))
+        assert isinstance(depends, (list, type(None)))
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.depends = list(depends or [])
+
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """Return the number of entries."""
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """Return the size of the cached values (bytes)."""
+        return self._size
+
+    @staticmethod
+    def key_for(cmd_proc_kwargs):
+        """Return the cache key of CmdProc kwargs (None = not cacheable).
+
+        The environment is compared with its digest: the digest of a CmdEnv
+        is computed once, a dict is hashed on each call.
+
+        """
+        input = cmd_proc_kwargs.get('input')
+        # pylint: disable=redefined-builtin
+        if isinstance(input, bytes):
+            input = hashlib.sha256(input).hexdigest()
+        elif input is not None:
+            return None
+
+        # the output written to a file (side effect) is not cached
+        for name in ('stdout', 'stderr'):
+            if cmd_proc_kwargs.get(name, PIPE) not in (PIPE, DEVNULL, STDOUT,
+                                                       None):
+                return None
+            capture = cmd_proc_kwargs.get(name + '_capture')
+            if capture is not None and not capture.cacheable:
+                return None
+
+        cmd = cmd_proc_kwargs['cmd']
+        env = cmd_proc_kwargs.get('env')
+        if isinstance(env, CmdEnv):
+            env = env.digest()
+        elif env is not None:
+            env = env_digest(env)
+        return (cmd if isinstance(cmd, str) else tuple(cmd),
+                cmd_proc_kwargs.get('cwd'),
+                env,
+                cmd_proc_kwargs.get('stdout', PIPE),
+                cmd_proc_kwargs.get('stderr', PIPE),
+                # the capture policies can filter the output
+                repr(cmd_proc_kwargs.get('stdout_capture')),
+                repr(cmd_proc_kwargs.get('stderr_capture')),
+                cmd_proc_kwargs.get('encoding', 'utf-8'),
+                cmd_proc_kwargs.get('errors', 'ignore'),
+                input)
+
+    def get(self, key, compute):
+        """Return the value of 'key'. compute() is called if it is missing.
+
+        compute() returns (value, size). If it raises an exception, nothing
+        is cached and the exception is raised to all the waiting callers.
+
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry.value
+
+            self.misses += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _CmdCacheFlight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        # the mtimes are read before: a change during compute() invalidates
+        mtimes = self._mtimes()
+        try:
+            flight.value, size = compute()
+        except BaseException as err:
+            flight.error = err
+            raise
+        else:
+            with self._lock:
+                self._store(key, flight.value, size, mtimes)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+        return flight.value
+
+    def invalidate(self, key=None):
+        """Remove an entry (or all the entries if key is None)."""
+        with self._lock:
+            keys = list(self._entries) if key is None else [key]
+            for item in keys:
+                self._remove(item)
+
+    def _lookup(self, key):
+        """Return the entry if it is still valid (and mark it as used)."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if (entry.expires is not None and monotonic() >= entry.expires) or \
+                entry.mtimes != self._mtimes():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, value, size, mtimes):
+        """Add an entry, evict the least recently used ones."""
+        self._remove(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        self._entries[key] = _CmdCacheEntry(value, size, expires, mtimes)
+        self._size += size
+
+        while (self.max_entries is not None and
+               len(self._entries) > self.max_entries) or \
+                (self.max_bytes is not None and self._size > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """Remove an entry (if it exists)."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _mtimes(self):
+        """Return the mtimes of the dependencies (None = missing file)."""
+        mtimes = []
+        for path in self.depends:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+
+def main():
+    """Test the class CmdCache."""
+    import unittest
+    from cmdwrapper.cmdcapture import CmdCaptureFilter, CmdCaptureTee
+    import tempfile
+    from time import sleep
+
+    class TestCmdCache(unittest.TestCase):
+        """Testing the class CmdCache."""
+
+        def test_cmdcache(self):
+            """Test: CmdCache()."""
+            cache = CmdCache(max_entries=2)
+            self.assertEqual(cache.get('a', lambda: ('A', 1)), 'A')
+            self.assertEqual(cache.get('a', lambda: ('X', 1)), 'A')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            cache.get('b', lambda: ('B', 1))
+            cache.get('a', lambda: ('X', 1))   # 'b' is the LRU now
+            cache.get('c', lambda: ('C', 1))
+            self.assertEqual(list(cache._entries), ['a', 'c'])
+
+            cache.invalidate('a')
+            self.assertEqual(cache.get('a', lambda: ('A2', 1)), 'A2')
+            cache.invalidate()
+            self.assertEqual((len(cache), cache.size), (0, 0))
+
+            with self.assertRaises(ValueError):
+                cache.get('err', lambda: int('x'))
+            self.assertEqual(len(cache), 0)
+
+        def test_max_bytes_ttl(self):
+            """Test: CmdCache(max_bytes=..., ttl=...)."""
+            cache = CmdCache(max_bytes=10, ttl=0.5)
+            cache.get('a', lambda: ('A', 6))
+            cache.get('b', lambda: ('B', 6))
+            self.assertEqual(list(cache._entries), ['b'])
+            cache.get('c', lambda: ('C', 11))
+            self.assertEqual((list(cache._entries), cache.size), (['b'], 6))
+
+            sleep(0.6)
+            self.assertEqual(cache.get('b', lambda: ('B2', 1)), 'B2')
+
+        def test_depends(self):
+            """Test: CmdCache(depends=[...])."""
+            with tempfile.NamedTemporaryFile() as fhandle:
+                cache = CmdCache(depends=[fhandle.name])
+                cache.get('a', lambda: ('A', 1))
+                self.assertEqual(cache.get('a', lambda: ('X', 1)), 'A')
+                os.utime(fhandle.name, ns=(0, 0))
+                self.assertEqual(cache.get('a', lambda: ('A2', 1)), 'A2')
+
+        def test_single_flight(self):
+            """Test: the concurrent calls compute the value once."""
+            cache = CmdCache()
+            calls = []
+
+            def compute():
+                """Slow computation."""
+                calls.append(1)
+                sleep(0.3)
+                return 'A', 1
+
+            results = []
+            threads = [threading.Thread(
+                target=lambda: results.append(cache.get('a', compute)))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(results, ['A'] * 10)
+            self.assertEqual(len(calls), 1)
+
+        def test_key_for(self):
+            """Test: CmdCache.key_for()."""
+            key = CmdCache.key_for({'cmd': ['ls'], 'env': {'A': '1'},
+                                    'input': b'data'})
+            self.assertEqual(key, CmdCache.key_for({'cmd': ['ls'],
+                                                    'env': {'A': '1'},
+                                                    'input': b'data'}))
+            self.assertNotEqual(key, CmdCache.key_for({'cmd': ['ls'],
+                                                       'env': {'A': '2'},
+                                                       'input': b'data'}))
+            self.assertEqual(key, CmdCache.key_for({'cmd': ['ls'],
+                                                    'env': CmdEnv({'A': '1'}),
+                                                    'input': b'data'}))
+            self.assertIsNone(CmdCache.key_for({'cmd': ['ls'],
+                                                'input': iter([b'a'])}))
+            self.assertNotEqual(
+                CmdCache.key_for({'cmd': ['ls']}),
+                CmdCache.key_for({'cmd': ['ls'],
+                                  'stdout_capture': CmdCaptureFilter('a')}))
+            self.assertIsNone(CmdCache.key_for({'cmd': ['ls'],
+                                                'stdout': 'ls.txt'}))
+            self.assertIsNone(
+                CmdCache.key_for({'cmd': ['ls'],
+                                  'stderr_capture': CmdCaptureTee('x')}))
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdCache)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
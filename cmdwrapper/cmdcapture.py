@@ -0,0 +1,689 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""How the output of a command (stdout or stderr) is captured."""
+
+import os
+import re
+import sys
+import mmap
+import codecs
+import tempfile
+from collections import deque
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class CmdCapture(object):
+    """Capture policy: keep the whole output in memory (the default).
+
+    A policy is only a configuration. open() returns a new buffer for each
+    process and the buffer implements write(data), getvalue(), close() and
+    the attribute 'skipped' (number of bytes that were not kept). If the
+    buffer has the attribute 'done' and it becomes True, the rest of the
+    output is not needed: the process is stopped (see CmdCaptureFilter).
+
+    >>> CmdWrapper('journalctl', stdout_capture=CmdCaptureTail(1024 ** 2))
+
+    """
+
+    # False: the policy has side effects (CmdCache does not cache the call)
+    cacheable = True
+
+    def open(self):
+        """Return a new buffer."""
+        return _MemoryBuffer()
+
+    def __repr__(self):
+        """Return the repr."""
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(key, value)
+                                         for key, value
+                                         in sorted(vars(self).items())))
+
+
+class CmdCaptureTail(CmdCapture):
+    """Capture policy: keep only the last bytes and/or lines (ring buffer)."""
+
+    def __init__(self, max_bytes=None, max_lines=None):
+        """Keep the last 'max_bytes' bytes and the last 'max_lines' lines."""
+        assert isinstance(max_bytes, (int, type(None)))
+        assert isinstance(max_lines, (int, type(None)))
+        assert max_bytes is not None or max_lines is not None
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+
+    def open(self):
+        """Return a new buffer."""
+        return _TailBuffer(self.max_bytes, self.max_lines)
+
+
+class CmdCaptureHeadTail(CmdCapture):
+    """Capture policy: keep the first 'head' and the last 'tail' bytes."""
+
+    def __init__(self, head, tail):
+        """Keep the first 'head' bytes and the last 'tail' bytes."""
+        assert isinstance(head, int) and isinstance(tail, int)
+        self.head = head
+        self.tail = tail
+
+    def open(self):
+        """Return a new buffer."""
+        return _HeadTailBuffer(self.head, self.tail)
+
+
+class CmdCaptureSpill(CmdCapture):
+    """Capture policy: spill to a temporary file after 'threshold' bytes.
+
+    The output is then returned as a read-only mmap (see CmdOutput), the
+    pages are loaded by the kernel only when they are read.
+
+    """
+
+    def __init__(self, threshold, dir=None):
+        """Write to a temporary file in 'dir' after 'threshold' bytes."""
+        # pylint: disable=redefined-builtin
+        assert isinstance(threshold, int)
+        assert isinstance(dir, (str, type(None)))
+        self.threshold = threshold
+        self.dir = dir
+
+    def open(self):
+        """Return a new buffer."""
+        return _SpillBuffer(self.threshold, self.dir)
+
+
+class CmdCaptureFilter(CmdCapture):
+    """Capture policy: keep only the lines that match (like grep).
+
+    The lines are filtered while the output is read. The process is stopped
+    as soon as the rest of its output is not needed ('head' lines were kept
+    or a line matched 'until'): CmdProcError is not raised and
+    cmd_proc.stopped_early is True.
+
+    >>> journalctl = CmdWrapper('journalctl', args=['-b'])
+    >>> journalctl(stdout_capture=CmdCaptureFilter(r'error', head=10))
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, pattern=None, predicate=None, head=None, tail=None,
+                 until=None):
+        """Init the filter.
+
+        :pattern: keep the lines where this regex is found (bytes or str,
+                  compiled or not: a str regex is encoded to UTF-8).
+        :predicate: keep the lines where predicate(line) is True (the line
+                    is bytes, without the newline).
+        :head: stop after the first 'head' kept lines.
+        :tail: keep only the last 'tail' kept lines.
+        :until: stop after the first line where this regex is found (this
+                line is kept if it matches the filter).
+
+        """
+        assert isinstance(head, (int, type(None)))
+        assert isinstance(tail, (int, type(None)))
+        assert predicate is None or callable(predicate)
+        self.pattern = _compile(pattern)
+        self.predicate = predicate
+        self.head = head
+        self.tail = tail
+        self.until = _compile(until)
+
+    def open(self):
+        """Return a new buffer."""
+        return _FilterBuffer(self)
+
+
+class CmdCaptureTee(CmdCapture):
+    """Capture policy: write the output to a file, keep its tail in memory.
+
+    The whole output is in the file, CmdOutput and the error messages get
+    only the last bytes/lines (see CmdCaptureTail).
+
+    >>> make = CmdWrapper('make', stdout_capture=CmdCaptureTee('build.log'))
+
+    """
+
+    cacheable = False
+
+    def __init__(self, path, append=False, max_bytes=64 * 1024,
+                 max_lines=None):
+        """Write to 'path' (truncated, or appended if 'append' is True)."""
+        assert isinstance(path, (str, os.PathLike))
+        assert max_bytes is not None or max_lines is not None
+        self.path = path
+        self.append = append
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+
+    def open(self):
+        """Return a new buffer."""
+        return _TeeBuffer(self)
+
+
+class CmdCaptureText(CmdCapture):
+    """Capture policy: decode the output while it is read.
+
+    The chunks are decoded as they arrive (incremental decoder) and their
+    bytes are released: a large output is never in memory as bytes and as
+    text at the same time. The output is a str, decoded with the options
+    'encoding' and 'errors' of CmdProc.
+
+    >>> CmdWrapper('journalctl', encoding='latin-1',
+    ...            stdout_capture=CmdCaptureText())
+
+    """
+
+    def open(self, encoding='utf-8', errors='ignore'):
+        """Return a new buffer (encoding=None: the bytes are kept)."""
+        if encoding is None:
+            return _MemoryBuffer()
+        return _TextBuffer(encoding, errors)
+
+
+class CmdRedirect(object):
+    """A file where the output of the process is written (stdout/stderr).
+
+    The file is opened before the process is started and the process writes
+    to it directly: nothing is copied by Python. A path (str) is the same as
+    CmdRedirect(path): the file is truncated.
+
+    >>> CmdWrapper('make', stdout=CmdRedirect('build.log', append=True))
+
+    """
+
+    def __init__(self, path, append=False):
+        """Write to 'path' (truncated, or appended if 'append' is True)."""
+        assert isinstance(path, (str, os.PathLike))
+        self.path = path
+        self.append = append
+
+    def open(self):
+        """Open the file (the caller closes it)."""
+        return open(self.path, 'ab' if self.append else 'wb', buffering=0)
+
+    def __repr__(self):
+        """Return the repr."""
+        return 'CmdRedirect({!r}, append={!r})'.format(self.path,
+                                                       self.append)
+
+
+def _compile(pattern):
+    """Return a bytes regex (or None)."""
+    if pattern is None:
+        return None
+    if hasattr(pattern, 'search'):
+        if not isinstance(pattern.pattern, str):
+            return pattern
+        # a compiled str regex (the lines are bytes): same flags, except
+        # re.UNICODE which is not allowed with bytes
+        return re.compile(pattern.pattern.encode('utf-8'),
+                          pattern.flags & ~re.UNICODE)
+    if isinstance(pattern, str):
+        pattern = pattern.encode('utf-8')
+    return re.compile(pattern)
+
+
+def _block_regex(regex):
+    """Return a regex that finds in a block of lines what 'regex' finds.
+
+    None is returned if the regex depends on the start/end of the string or
+    on look-around assertions (the block cannot be checked at once).
+
+    """
+    if regex is None or any(item in regex.pattern
+                            for item in (b'\\A', b'\\Z', b'(?')):
+        return None
+    return re.compile(regex.pattern, regex.flags | re.MULTILINE)
+
+
+class _MemoryBuffer(object):
+    """Keep everything in memory."""
+
+    def __init__(self):
+        """Init the buffer."""
+        self._chunks = []
+        self.skipped = 0
+
+    def write(self, data):
+        """Add data to the buffer."""
+        self._chunks.append(data)
+
+    def getvalue(self):
+        """Return the content (bytes)."""
+        if len(self._chunks) != 1:
+            self._chunks = [b''.join(self._chunks)]
+        return self._chunks[0]
+
+    def close(self):
+        """Nothing to do."""
+
+
+class _TextBuffer(_MemoryBuffer):
+    """Decode the chunks, keep the text in memory."""
+
+    def __init__(self, encoding, errors):
+        """Init the buffer."""
+        super().__init__()
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors)
+
+    def write(self, data):
+        """Decode data (an incomplete character is kept by the decoder)."""
+        text = self._decoder.decode(data)
+        if text:
+            self._chunks.append(text)
+
+    def getvalue(self):
+        """Return the text (str)."""
+        text = self._decoder.decode(b'', final=True)
+        if text:
+            self._chunks.append(text)
+        self._decoder.reset()
+        if len(self._chunks) != 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0]
+
+
+class _TailBuffer(_MemoryBuffer):
+    """Keep the last bytes/lines."""
+
+    def __init__(self, max_bytes, max_lines):
+        """Init the buffer."""
+        super().__init__()
+        self._max_bytes = max_bytes
+        self._max_lines = max_lines
+        self._chunks = deque()  # (chunk, number of '\n')
+        self._size = 0
+        self._newlines = 0
+
+    def write(self, data):
+        """Add data, drop the chunks that are not needed anymore."""
+        data = bytes(data)
+        self._chunks.append((data, data.count(b'\n')))
+        self._size += len(data)
+        self._newlines += self._chunks[-1][1]
+
+        while len(self._chunks) > 1:
+            chunk, newlines = self._chunks[0]
+            if self._max_bytes is not None and \
+                    self._size - len(chunk) >= self._max_bytes:
+                pass
+            elif self._max_lines is not None and \
+                    self._newlines - newlines > self._max_lines:
+                pass
+            else:
+                break
+            self._chunks.popleft()
+            self._size -= len(chunk)
+            self._newlines -= newlines
+            self.skipped += len(chunk)
+
+    def getvalue(self):
+        """Return the last bytes/lines."""
+        data = b''.join(chunk for chunk, _ in self._chunks)
+        size = len(data)
+
+        if self._max_bytes is not None:
+            data = data[-self._max_bytes:] if self._max_bytes else b''
+
+        if self._max_lines is not None:
+            data = _tail_lines(data, self._max_lines)
+
+        self._chunks = deque([(data, data.count(b'\n'))])
+        self._size = len(data)
+        self._newlines = self._chunks[0][1]
+        self.skipped += size - len(data)
+        return data
+
+
+class _TeeBuffer(_TailBuffer):
+    """Write to a file and keep the last bytes/lines."""
+
+    def __init__(self, policy):
+        """Init the buffer (the file is created now)."""
+        super().__init__(policy.max_bytes, policy.max_lines)
+        # pylint: disable=consider-using-with
+        self._file = open(policy.path, 'ab' if policy.append else 'wb')
+
+    def write(self, data):
+        """Write data to the file and to the tail."""
+        self._file.write(data)
+        super().write(data)
+
+    def getvalue(self):
+        """Return the last bytes/lines (the file is flushed)."""
+        self._file.flush()
+        return super().getvalue()
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+
+class _HeadTailBuffer(object):
+    """Keep the first and the last bytes."""
+
+    def __init__(self, head, tail):
+        """Init the buffer."""
+        self._head_size = head
+        self._head = bytearray()
+        self._tail = _TailBuffer(tail, None)
+
+    @property
+    def skipped(self):
+        """Return the number of bytes that were not kept."""
+        return self._tail.skipped
+
+    def close(self):
+        """Nothing to do."""
+
+    def write(self, data):
+        """Fill the head, then the tail."""
+        missing = self._head_size - len(self._head)
+        if missing > 0:
+            self._head += data[:missing]
+            data = data[missing:]
+
+        if data:
+            self._tail.write(data)
+
+    def getvalue(self):
+        """Return the head + the tail."""
+        return bytes(self._head) + self._tail.getvalue()
+
+
+class _SpillBuffer(_MemoryBuffer):
+    """Keep the output in memory, then in a temporary file."""
+
+    def __init__(self, threshold, dirname):
+        """Init the buffer."""
+        super().__init__()
+        self._threshold = threshold
+        self._dirname = dirname
+        self._size = 0
+        self._file = None
+
+    def write(self, data):
+        """Add data to the buffer (or to the file)."""
+        self._size += len(data)
+        if self._file is None:
+            super().write(data)
+            if self._size <= self._threshold:
+                return
+
+            # spill what is in memory to a temporary file
+            # pylint: disable=consider-using-with
+            self._file = tempfile.TemporaryFile(dir=self._dirname)
+            data = super().getvalue()
+            self._chunks = []
+
+        self._file.write(data)
+
+    def getvalue(self):
+        """Return bytes (in memory) or a read-only mmap of the file."""
+        if self._file is None:
+            return super().getvalue()
+
+        self._file.flush()
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Close the temporary file (the mmap stays valid)."""
+        if self._file is not None:
+            self._file.close()
+
+
+class _FilterBuffer(object):
+    """Keep the lines that match the filter."""
+
+    def __init__(self, policy):
+        """Init the buffer."""
+        self._policy = policy
+        self._lines = [] if policy.tail is None else deque(maxlen=policy.tail)
+        self._pending = []      # the pieces of the incomplete last line
+        self._kept = 0
+        self.skipped = 0
+        self.done = False
+
+        # the blocks of lines without any match are skipped at once
+        self._quick = None
+        if policy.predicate is None and policy.pattern is not None:
+            self._quick = [_block_regex(policy.pattern)]
+            if policy.until is not None:
+                self._quick.append(_block_regex(policy.until))
+            if None in self._quick:
+                self._quick = None
+
+    def write(self, data):
+        """Filter the complete lines (the last one can be incomplete)."""
+        if self.done:
+            self.skipped += len(data)
+            return
+
+        # the incomplete line is only joined once it is complete
+        data = bytes(data)
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            if data:
+                self._pending.append(data)
+            return
+
+        self._pending.append(data[:end])
+        block = b''.join(self._pending)
+        self._pending = [data[end:]] if end < len(data) else []
+        if self._quick is not None and \
+                not any(regex.search(block) for regex in self._quick):
+            self.skipped += len(block)
+            return
+
+        lines = block.split(b'\n')
+        lines.pop()
+        for num, line in enumerate(lines):
+            self._add(line, b'\n')
+            if self.done:
+                self.skipped += sum(len(item) + 1 for item in lines[num + 1:])
+                self.skipped += sum(len(item) for item in self._pending)
+                self._pending = []
+                return
+
+    def _add(self, line, newline):
+        """Keep the line if it matches, check if the filter is done."""
+        policy = self._policy
+        if (policy.pattern is None or policy.pattern.search(line)) and \
+                (policy.predicate is None or policy.predicate(line)):
+            if policy.tail is not None and \
+                    len(self._lines) == policy.tail and self._lines:
+                self.skipped += len(self._lines[0])
+            self._lines.append(line + newline)
+            self._kept += 1
+        else:
+            self.skipped += len(line) + len(newline)
+
+        if (policy.head is not None and self._kept >= policy.head) or \
+                (policy.until is not None and policy.until.search(line)):
+            self.done = True
+
+    def getvalue(self):
+        """Return the lines that were kept."""
+        if self._pending and not self.done:
+            self._add(b''.join(self._pending), b'')
+        self._pending = []
+        return b''.join(self._lines)
+
+    def close(self):
+        """Nothing to do."""
+
+
+def _tail_lines(data, count):
+    """Return the last 'count' lines of data."""
+    pos = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(count):
+        pos = data.rfind(b'\n', 0, pos)
+        if pos < 0:
+            return data
+    return data[pos + 1:]
+
+
+def main():
+    """Test the capture policies."""
+    import unittest
+
+    def capture(policy, chunks):
+        """Write the chunks to a new buffer, return (value, buffer)."""
+        buf = policy.open()
+        for chunk in chunks:
+            buf.write(chunk)
+        return buf.getvalue(), buf
+
+    class TestCmdCapture(unittest.TestCase):
+        """Testing the capture policies."""
+
+        def test_cmdcapture(self):
+            """Test: CmdCapture()."""
+            value, buf = capture(CmdCapture(), [b'a', b'b'])
+            self.assertEqual(value, b'ab')
+            self.assertEqual(buf.skipped, 0)
+            self.assertIn('CmdCaptureTail(max_bytes=3, max_lines=None)',
+                          repr(CmdCaptureTail(max_bytes=3)))
+
+        def test_tail(self):
+            """Test: CmdCaptureTail()."""
+            chunks = [b'line %d\n' % num for num in range(1000)]
+            value, buf = capture(CmdCaptureTail(max_bytes=10), chunks)
+            self.assertEqual(value, b'\nline 999\n')
+            self.assertEqual(buf.skipped, len(b''.join(chunks)) - 10)
+            # pylint: disable=protected-access
+            self.assertLess(len(buf._chunks), 3)
+
+            value, _ = capture(CmdCaptureTail(max_lines=2), chunks)
+            self.assertEqual(value, b'line 998\nline 999\n')
+
+            value, _ = capture(CmdCaptureTail(max_lines=2), [b'a\nb\nc'])
+            self.assertEqual(value, b'b\nc')
+
+            value, _ = capture(CmdCaptureTail(max_lines=5), [b'a\nb'])
+            self.assertEqual(value, b'a\nb')
+
+            value, _ = capture(CmdCaptureTail(max_bytes=0), [b'a\nb'])
+            self.assertEqual(value, b'')
+
+        def test_head_tail(self):
+            """Test: CmdCaptureHeadTail()."""
+            value, buf = capture(CmdCaptureHeadTail(3, 2),
+                                 [b'12', b'3456', b'789'])
+            self.assertEqual(value, b'12389')
+            self.assertEqual(buf.skipped, 4)
+
+        def test_spill(self):
+            """Test: CmdCaptureSpill()."""
+            value, buf = capture(CmdCaptureSpill(10), [b'12345'])
+            self.assertEqual(value, b'12345')
+
+            value, buf = capture(CmdCaptureSpill(10), [b'123456', b'7890',
+                                                       b'abc'])
+            buf.close()
+            self.assertIsInstance(value, mmap.mmap)
+            self.assertEqual(value[:], b'1234567890abc')
+
+        def test_tee(self):
+            """Test: CmdCaptureTee()."""
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'out.log')
+                chunks = [b'line %d\n' % num for num in range(1000)]
+                value, buf = capture(CmdCaptureTee(path, max_lines=1), chunks)
+                buf.close()
+                self.assertEqual(value, b'line 999\n')
+                with open(path, 'rb') as fhandle:
+                    self.assertEqual(fhandle.read(), b''.join(chunks))
+
+                capture(CmdCaptureTee(path, append=True), [b'X'])[1].close()
+                with open(path, 'rb') as fhandle:
+                    self.assertEqual(fhandle.read()[-10:], b'line 999\nX')
+
+            self.assertFalse(CmdCaptureTee('x').cacheable)
+            self.assertTrue(CmdCaptureTail(1).cacheable)
+            self.assertEqual(repr(CmdRedirect('x', append=True)),
+                             "CmdRedirect('x', append=True)")
+
+        def test_text(self):
+            """Test: CmdCaptureText()."""
+            data = 'L\u00e9\n'.encode('utf-8') * 1000
+            chunks = [data[pos:pos + 7] for pos in range(0, len(data), 7)]
+            value, _ = capture(CmdCaptureText(), chunks)
+            self.assertEqual(value, 'L\u00e9\n' * 1000)
+
+            buf = CmdCaptureText().open('utf-8', 'strict')
+            buf.write(b'a\xc3')
+            with self.assertRaises(UnicodeDecodeError):
+                buf.getvalue()
+
+            buf = CmdCaptureText().open('utf-16', 'strict')
+            for char in 'ab'.encode('utf-16'):
+                buf.write(bytes([char]))
+            self.assertEqual(buf.getvalue(), 'ab')
+            self.assertEqual(CmdCaptureText().open(None).getvalue(), b'')
+
+        def test_filter(self):
+            """Test: CmdCaptureFilter()."""
+            chunks = [b'line %d\n' % num for num in range(1000)]
+            chunks = [b''.join(chunks[:500]), b''.join(chunks[500:]),
+                      b'last']
+            value, buf = capture(CmdCaptureFilter(r'7$'), chunks)
+            self.assertEqual(value.count(b'\n'), 100)
+            self.assertFalse(buf.done)
+            self.assertEqual(buf.skipped, len(b''.join(chunks)) - len(value))
+
+            value, buf = capture(CmdCaptureFilter(b'9', head=3), chunks)
+            self.assertEqual(value, b'line 9\nline 19\nline 29\n')
+            self.assertTrue(buf.done)
+            self.assertEqual(buf.skipped, len(b''.join(chunks)) - len(value))
+
+            value, buf = capture(CmdCaptureFilter(tail=2), chunks)
+            self.assertEqual(value, b'line 999\nlast')
+            self.assertEqual(buf.skipped, len(b''.join(chunks)) - len(value))
+
+            value, buf = capture(CmdCaptureFilter(
+                predicate=lambda line: line.endswith(b'5'),
+                until=r'^line 20'), [b'line 1', b'5\nline 2', b'0\nx\n'])
+            self.assertEqual(value, b'line 15\n')
+            self.assertTrue(buf.done)
+
+            # the regex cannot check the blocks at once
+            value, _ = capture(CmdCaptureFilter(r'\Aline 99[0-9]\Z'),
+                               chunks)
+            self.assertEqual(value.count(b'\n'), 10)
+
+            value, _ = capture(CmdCaptureFilter(r'l', until='999'),
+                               [b'a\nlast'])
+            self.assertEqual(value, b'last')
+
+            # a compiled str regex (the flags are kept)
+            value, _ = capture(CmdCaptureFilter(re.compile('^LINE 99[0-8]$',
+                                                           re.IGNORECASE),
+                                                until=re.compile('998')),
+                               chunks)
+            self.assertEqual(value.count(b'\n'), 9)
+
+            # a long line in many chunks
+            value, buf = capture(CmdCaptureFilter(b'END'),
+                                 [b'x' * 100] * 1000 + [b'END\nab', b'c'])
+            self.assertEqual(value, b'x' * 100000 + b'END\n')
+            self.assertEqual(buf.skipped, 3)
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdCapture)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Record the calls of the commands to a cassette, replay them later."""
+
+import sys
+import os
+import json
+import mmap
+import shlex
+import struct
+import hashlib
+import threading
+from time import sleep
+from subprocess import PIPE, DEVNULL, STDOUT
+from cmdwrapper.cmdproc import CmdProcError
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+# The file: header (magic + offset of the index), the outputs, the index
+# (JSON: {key: [[returncode, duration, offset, size, offset, size], ...]})
+_MAGIC = b'CMDCASS1'
+_HEADER = struct.Struct('<8sQ')
+
+
+class CmdCassetteEntry(object):
+    """A recorded call (the outputs are bytes read from the cassette)."""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, stdout, stderr, returncode, duration):
+        """Init the entry."""
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.duration = duration
+
+
+class CmdCassette(object):
+    """The recorded calls of the commands (to run tests without processes).
+
+    >>> with CmdCassette('tests.cassette', mode='record') as cassette:
+    ...     lsblk = CmdWrapper('lsblk', args=['-J'], cassette=cassette)
+    ...     lsblk().stdout.json()   # runs lsblk, records the call
+    >>> cassette = CmdCassette('tests.cassette')
+    >>> CmdWrapper('lsblk', args=['-J'], cassette=cassette)().stdout.json()
+
+    The key of a call is the argv, cwd, the environment variables that
+    differ from os.environ, the hash of the input and the output options.
+    The calls that have no key (the input is an iterator, the output is
+    written to a file...) are not recorded: they run as usual.
+
+    When the same call is recorded several times (date, for example), the
+    results are replayed in the same order (the last one is repeated).
+
+    The file is memory-mapped when it is replayed: only the outputs that are
+    replayed are read.
+
+    """
+
+    def __init__(self, path, mode='replay', latency=0):
+        """Open the cassette.
+
+        :path: the file of the cassette.
+        :mode: 'record' (the file is rewritten, the commands run) or
+               'replay' (no process is started: a call that was not
+               recorded raises CmdProcError).
+        :latency: replay: the call waits 'latency' x the recorded duration
+                  (1 reproduces the recorded latencies, for load tests).
+
+        """
+        assert mode in ('record', 'replay')
+        assert isinstance(latency, (int, float)) and latency >= 0
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+
+        self._index = {}
+        self._played = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._mmap = None
+        if mode == 'record':
+            # pylint: disable=consider-using-with
+            self._file = open(path, 'w+b')
+            self._file.write(_HEADER.pack(_MAGIC, 0))
+        else:
+            self._load()
+
+    @property
+    def recording(self):
+        """Return True if the calls are recorded."""
+        return self.mode == 'record'
+
+    def __len__(self):
+        """Return the number of recorded calls."""
+        return sum(len(entries) for entries in self._index.values())
+
+    @staticmethod
+    def key_for(cmd_proc_kwargs):
+        """Return the key of CmdProc kwargs (None = not recordable)."""
+        for name in ('stdout', 'stderr'):
+            if cmd_proc_kwargs.get(name, PIPE) not in (PIPE, DEVNULL, STDOUT,
+                                                       None):
+                return None
+            capture = cmd_proc_kwargs.get(name + '_capture')
+            if capture is not None and not capture.cacheable:
+                return None
+
+        input = cmd_proc_kwargs.get('input')
+        # pylint: disable=redefined-builtin
+        if isinstance(input, (str, os.PathLike)):
+            with open(input, 'rb') as fhandle:
+                input = fhandle.read()
+        if isinstance(input, bytes):
+            input = hashlib.sha256(input).hexdigest()
+        elif input is not None:
+            return None
+
+        cmd = cmd_proc_kwargs['cmd']
+        env = cmd_proc_kwargs.get('env')
+        if env is not None:
+            # the variables that are modified, added or removed (None)
+            env = {name: value for name, value in env.items()
+                   if os.environ.get(name) != value}
+            env.update({name: None for name in os.environ
+                        if name not in cmd_proc_kwargs['env']})
+
+        return json.dumps([shlex.split(cmd) if isinstance(cmd, str) else cmd,
+                           cmd_proc_kwargs.get('cwd'),
+                           env,
+                           input,
+                           cmd_proc_kwargs.get('stdout', PIPE),
+                           cmd_proc_kwargs.get('stderr', PIPE),
+                           repr(cmd_proc_kwargs.get('stdout_capture')),
+                           repr(cmd_proc_kwargs.get('stderr_capture')),
+                           cmd_proc_kwargs.get('encoding', 'utf-8'),
+                           cmd_proc_kwargs.get('errors', 'ignore')],
+                          sort_keys=True, separators=(',', ':'))
+
+    def record(self, key, cmd_proc):
+        """Record the result of a completed CmdProc. Return its entry."""
+        assert self.recording
+        duration = 0.0 if cmd_proc.stats is None \
+            else cmd_proc.stats.wall_time
+        stdout = self._bytes(cmd_proc, cmd_proc.stdout)
+        stderr = self._bytes(cmd_proc, cmd_proc.stderr)
+        with self._lock:
+            stdout_offset = self._file.tell()
+            self._file.write(stdout)
+            self._file.write(stderr)
+            self._index.setdefault(key, []).append(
+                [cmd_proc.returncode, duration, stdout_offset, len(stdout),
+                 stdout_offset + len(stdout), len(stderr)])
+        return CmdCassetteEntry(bytes(stdout), bytes(stderr),
+                                cmd_proc.returncode, duration)
+
+    def play(self, key):
+        """Return the next entry of 'key' (CmdProcError if it is missing).
+
+        The call waits the recorded duration x self.latency.
+
+        """
+        assert not self.recording
+        with self._lock:
+            entries = self._index.get(key)
+            if not entries:
+                raise CmdProcError('the call was not recorded in the '
+                                   'cassette {}: {}'.format(self.path, key))
+            num = self._played.get(key, 0)
+            self._played[key] = num + 1
+            returncode, duration, stdout_offset, stdout_size, \
+                stderr_offset, stderr_size = entries[min(num,
+                                                         len(entries) - 1)]
+            stdout = self._mmap[stdout_offset:stdout_offset + stdout_size]
+            stderr = self._mmap[stderr_offset:stderr_offset + stderr_size]
+
+        if self.latency:
+            sleep(duration * self.latency)
+        return CmdCassetteEntry(stdout, stderr, returncode, duration)
+
+    def rewind(self):
+        """Replay the recorded calls from the start."""
+        with self._lock:
+            self._played.clear()
+
+    def close(self):
+        """Write the index (record mode) and close the file."""
+        with self._lock:
+            if self._file is not None and self.recording:
+                offset = self._file.tell()
+                self._file.write(json.dumps(self._index,
+                                            separators=(',', ':'))
+                                 .encode('utf-8'))
+                self._file.seek(0)
+                self._file.write(_HEADER.pack(_MAGIC, offset))
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        """Return the cassette."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the cassette."""
+        self.close()
+
+    def _load(self):
+        """Map the file and read the index."""
+        # pylint: disable=consider-using-with
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, offset = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC or offset < _HEADER.size:
+            self.close()
+            raise ValueError('invalid or incomplete cassette: {}'
+                             .format(self.path))
+        self._index = json.loads(self._mmap[offset:].decode('utf-8'))
+
+    @staticmethod
+    def _bytes(cmd_proc, output):
+        """Return the output as bytes-like (str is encoded)."""
+        if isinstance(output, str):
+            return output.encode(cmd_proc.encoding or 'utf-8',
+                                 cmd_proc.errors)
+        return output
+
+
+def main():
+    """Test the cassette."""
+    import unittest
+    import tempfile
+    from time import monotonic
+    from cmdwrapper.cmdproc import CmdProc
+
+    def run(cassette, cmd, **kwargs):
+        """Record 'cmd' (it runs) or replay it. Return the entry."""
+        kwargs['cmd'] = cmd
+        key = cassette.key_for(kwargs)
+        if not cassette.recording:
+            return cassette.play(key)
+
+        cmd_proc = CmdProc(**kwargs)
+        try:
+            cmd_proc.wait()
+        except CmdProcError:
+            pass
+        return cassette.record(key, cmd_proc)
+
+    class TestCmdCassette(unittest.TestCase):
+        """Testing the class CmdCassette."""
+
+        def test_cassette(self):
+            """Test: record and replay."""
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'test.cassette')
+                with CmdCassette(path, mode='record') as cassette:
+                    run(cassette, ['echo', 'A'])
+                    run(cassette, ['bash', '-c', 'echo ERR >&2; sleep 0.2; '
+                                   'exit 3'])
+                    run(cassette, 'cat', input=b'1')
+                    run(cassette, 'cat', input=b'2')
+                    self.assertEqual(len(cassette), 4)
+
+                with CmdCassette(path) as cassette:
+                    self.assertEqual(len(cassette), 4)
+                    self.assertEqual(run(cassette, ['echo', 'A']).stdout,
+                                     b'A\n')
+                    self.assertEqual(run(cassette, 'echo A').stdout, b'A\n')
+                    self.assertEqual(run(cassette, 'cat', input=b'2').stdout,
+                                     b'2')
+
+                    start = monotonic()
+                    entry = run(cassette, ['bash', '-c', 'echo ERR >&2; '
+                                           'sleep 0.2; exit 3'])
+                    self.assertLess(monotonic() - start, 0.2)
+                    self.assertEqual((entry.stderr, entry.returncode),
+                                     (b'ERR\n', 3))
+                    self.assertGreaterEqual(entry.duration, 0.2)
+
+                    with self.assertRaises(CmdProcError):
+                        run(cassette, ['echo', 'B'])
+
+                # the recorded latencies
+                with CmdCassette(path, latency=1) as cassette:
+                    start = monotonic()
+                    run(cassette, ['bash', '-c', 'echo ERR >&2; sleep 0.2; '
+                                   'exit 3'])
+                    self.assertGreaterEqual(monotonic() - start, 0.2)
+
+                with open(path, 'wb') as fhandle:
+                    fhandle.write(_HEADER.pack(_MAGIC, 0))
+                with self.assertRaises(ValueError):
+                    CmdCassette(path)
+
+        def test_key_for(self):
+            """Test: CmdCassette.key_for()."""
+            env = dict(os.environ, CMDCASSETTE='1')
+            env.pop('PATH', None)
+            self.assertEqual(json.loads(CmdCassette.key_for(
+                {'cmd': ['ls'], 'env': env}))[2],
+                             {'CMDCASSETTE': '1', 'PATH': None})
+            self.assertIsNone(CmdCassette.key_for({'cmd': ['ls'],
+                                                   'input': iter([b'a'])}))
+            self.assertIsNone(CmdCassette.key_for({'cmd': ['ls'],
+                                                   'stdout': 'ls.txt'}))
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdCassette)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""The environment of the processes: a snapshot + overrides + unsets."""
+
+import sys
+import os
+import hashlib
+from collections.abc import Mapping
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class CmdEnv(Mapping):
+    """An environment overlay (the 'env' option of CmdProc/CmdWrapper).
+
+    The base is a snapshot of os.environ (or of another mapping), shared by
+    the overlays that are built on it: only the overrides and the unsets are
+    stored by each overlay (copy-on-write).
+
+    The environment is resolved and its variables are encoded to bytes
+    once, when it is first needed: the processes that are started with the
+    same CmdEnv do not resolve or encode it again. Popen and posix_spawn
+    still build their envp array ('NAME=value' strings) from this mapping
+    on each launch (they do not accept a prebuilt one). set() and unset()
+    invalidate the cache (the overlays already built on it are not
+    modified).
+
+    >>> env = CmdEnv(overrides={'LC_ALL': 'C'}, unset=['DISPLAY'])
+    >>> ls = CmdWrapper('ls', env=env)
+    >>> git = CmdWrapper('git', env=env.overlay(GIT_PAGER='cat'))
+
+    """
+
+    def __init__(self, base=None, overrides=None, unset=None):
+        """Init the overlay.
+
+        :base: a mapping (None: a snapshot of os.environ is taken now). If
+               it is a CmdEnv, its resolved environment is shared.
+        :overrides: the variables that are added or modified.
+        :unset: the variables that are removed.
+
+        """
+        assert isinstance(overrides, (dict, type(None)))
+        if isinstance(base, CmdEnv):
+            self._base = base._resolved()
+        else:
+            self._base = dict(os.environ if base is None else base)
+        self._overrides = dict(overrides or {})
+        self._unset = set(unset or ())
+        self._env = None
+        self._encoded = None
+        self._digest = None
+
+    def set(self, name, value):
+        """Add or modify the variable 'name'."""
+        assert isinstance(name, str) and isinstance(value, str)
+        self._overrides[name] = value
+        self._unset.discard(name)
+        self._invalidate()
+
+    def unset(self, name):
+        """Remove the variable 'name'."""
+        self._overrides.pop(name, None)
+        self._unset.add(name)
+        self._invalidate()
+
+    def overlay(self, **overrides):
+        """Return a new CmdEnv built on this one (its base is shared)."""
+        return CmdEnv(self, overrides=overrides)
+
+    def encoded(self):
+        """Return the environment encoded to bytes (cached).
+
+        The dict is shared: it must not be modified. It is a mapping of
+        bytes, not the envp array: Popen and posix_spawn build the array
+        from it on each launch.
+
+        """
+        if self._encoded is None:
+            self._encoded = {os.fsencode(name): os.fsencode(value)
+                             for name, value in self._resolved().items()}
+        return self._encoded
+
+    def digest(self):
+        """Return the SHA-256 of the environment (cached, see env_digest)."""
+        if self._digest is None:
+            self._digest = env_digest(self._resolved())
+        return self._digest
+
+    def snapshot(self):
+        """Return the environment (a dict shared with the overlays).
+
+        The dict must not be modified: use set() or overlay().
+
+        """
+        return self._resolved()
+
+    def __getitem__(self, name):
+        """Return the value of a variable."""
+        return self._resolved()[name]
+
+    def __iter__(self):
+        """Iterate through the names of the variables."""
+        return iter(self._resolved())
+
+    def __len__(self):
+        """Return the number of variables."""
+        return len(self._resolved())
+
+    def __repr__(self):
+        """Return the repr (the base is not shown)."""
+        return 'CmdEnv(overrides={!r}, unset={!r})' \
+            .format(self._overrides, sorted(self._unset))
+
+    def _resolved(self):
+        """Return the base + the overrides - the unsets (cached)."""
+        if self._env is None:
+            if not self._overrides and not self._unset:
+                self._env = self._base
+            else:
+                env = dict(self._base)
+                env.update(self._overrides)
+                for name in self._unset:
+                    env.pop(name, None)
+                self._env = env
+        return self._env
+
+    def _invalidate(self):
+        """Forget the resolved and encoded environment."""
+        self._env = None
+        self._encoded = None
+        self._digest = None
+
+
+def env_digest(env):
+    """Return the SHA-256 (hex) of the variables of a mapping.
+
+    The same variables give the same digest (the order does not matter):
+    it is used by CmdCache to compare the environments.
+
+    """
+    data = '\0'.join('{}={}'.format(name, value)
+                     for name, value in sorted(env.items()))
+    return hashlib.sha256(data.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def main():
+    """Test the environment overlays."""
+    import unittest
+
+    class TestCmdEnv(unittest.TestCase):
+        """Testing the class CmdEnv."""
+
+        def test_cmdenv(self):
+            """Test: CmdEnv()."""
+            env = CmdEnv({'A': '1', 'B': '2'}, overrides={'C': '3'},
+                         unset=['B'])
+            self.assertEqual(dict(env), {'A': '1', 'C': '3'})
+            self.assertEqual(env.encoded(), {b'A': b'1', b'C': b'3'})
+            self.assertIs(env.encoded(), env.encoded())
+
+            child = env.overlay(D='4')
+            # pylint: disable=protected-access
+            self.assertIs(child._base, env.snapshot())
+            self.assertEqual(dict(child), {'A': '1', 'C': '3', 'D': '4'})
+
+            # copy-on-write: the overlays built on it are not modified
+            encoded = env.encoded()
+            env.set('B', '5')
+            env.unset('A')
+            self.assertIsNot(env.encoded(), encoded)
+            self.assertEqual(dict(env), {'B': '5', 'C': '3'})
+            self.assertEqual(dict(child), {'A': '1', 'C': '3', 'D': '4'})
+            self.assertEqual(encoded, {b'A': b'1', b'C': b'3'})
+
+            # the digest is cached until the next modification
+            digest = env.digest()
+            self.assertIs(env.digest(), digest)
+            self.assertEqual(digest, env_digest({'C': '3', 'B': '5'}))
+            env.set('B', '6')
+            self.assertNotEqual(env.digest(), digest)
+
+            self.assertIn('PATH', CmdEnv())
+            self.assertIs(CmdEnv(env).snapshot(), env.snapshot())
+            self.assertEqual(repr(CmdEnv({}, unset=['X'])),
+                             "CmdEnv(overrides={}, unset=['X'])")
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdEnv)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
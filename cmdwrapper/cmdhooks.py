@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Callbacks called during the life of the processes (metrics, tracing)."""
+
+import sys
+import os
+import json
+import socket
+import logging
+import threading
+from time import monotonic, time
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class CmdHooks(object):
+    """A registry of callbacks, called by CmdProc(hooks=...).
+
+    The events and the arguments of their callbacks:
+    - before_spawn(cmd_proc)
+    - after_spawn(cmd_proc, pid, spawn_time)
+    - on_output_chunk(cmd_proc, stream, data): stream is 'stdout'/'stderr'
+    - on_exit(cmd_proc, returncode, duration)
+    - on_timeout(cmd_proc, timeout): followed by on_exit and on_error
+      (CmdProcTimeout) when the killed process is reaped
+    - on_error(cmd_proc, error): the process could not be started or its
+      returncode != 0 (CmdProcError)
+
+    >>> hooks = CmdHooks()
+    >>> hooks.register('on_exit', lambda proc, returncode, duration: ...)
+    >>> hooks.add(CmdChromeTrace('trace.json'))
+    >>> ls = CmdWrapper('ls', hooks=hooks)
+
+    The exceptions raised by the callbacks are logged and ignored.
+
+    """
+
+    EVENTS = ('before_spawn', 'after_spawn', 'on_output_chunk', 'on_exit',
+              'on_timeout', 'on_error')
+
+    def __init__(self):
+        """Init the registry (no callbacks)."""
+        self._callbacks = {event: [] for event in self.EVENTS}
+
+    def __bool__(self):
+        """Return True if at least one callback is registered."""
+        return any(self._callbacks.values())
+
+    def register(self, event, callback):
+        """Call callback() when 'event' happens."""
+        assert event in self._callbacks, 'unknown event: {}'.format(event)
+        assert callable(callback)
+        self._callbacks[event].append(callback)
+
+    def unregister(self, event, callback):
+        """Stop calling callback() when 'event' happens."""
+        self._callbacks[event].remove(callback)
+
+    def add(self, adapter):
+        """Register the methods of 'adapter' named like the events."""
+        for event in self.EVENTS:
+            callback = getattr(adapter, event, None)
+            if callback is not None:
+                self.register(event, callback)
+        return adapter
+
+    def wants(self, event):
+        """Return True if a callback is registered for 'event'."""
+        return bool(self._callbacks[event])
+
+    def emit(self, event, cmd_proc, **info):
+        """Call the callbacks of 'event'."""
+        for callback in self._callbacks[event]:
+            try:
+                callback(cmd_proc, **info)
+            except Exception:    # pylint: disable=broad-except
+                logging.exception('[HOOK-ERROR] %s: %r', event, callback)
+
+
+def _cmd_name(cmd_proc):
+    """Return the name of the command of cmd_proc (basename of argv[0])."""
+    # pylint: disable=protected-access
+    return os.path.basename(cmd_proc._cmd_list[0]) \
+        if cmd_proc._cmd_list else ''
+
+
+class CmdPrometheusExporter(object):
+    """Metrics in the Prometheus text format (to add to CmdHooks).
+
+    The metrics are labeled with the name of the command. They can be
+    written to a file (node_exporter's textfile collector: if 'path' is
+    set, the file is replaced when a command exits, at most every
+    'interval' seconds; close() writes the last metrics) or served on a
+    Unix socket (see serve()).
+
+    """
+
+    PREFIX = 'cmdwrapper'
+
+    def __init__(self, path=None, interval=5):
+        """Init the metrics (written to 'path' if it is not None)."""
+        assert isinstance(path, (str, type(None)))
+        assert isinstance(interval, (int, float)) and interval >= 0
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._counters = {}     # (metric, labels) -> value
+        self._running = {}      # command name -> number of processes
+        self._written = None    # when the file was written (monotonic)
+        self._timer = None      # the pending write
+
+    def _inc(self, metric, labels, value=1):
+        """Increment a counter."""
+        key = (metric, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def after_spawn(self, cmd_proc, pid, spawn_time):
+        """Count the started processes."""
+        # pylint: disable=unused-argument
+        name = _cmd_name(cmd_proc)
+        with self._lock:
+            self._inc('spawn_seconds_sum', (('cmd', name),), spawn_time)
+            self._inc('spawn_seconds_count', (('cmd', name),))
+            self._running[name] = self._running.get(name, 0) + 1
+
+    def on_output_chunk(self, cmd_proc, stream, data):
+        """Count the output bytes."""
+        with self._lock:
+            self._inc('output_bytes_total', (('cmd', _cmd_name(cmd_proc)),
+                                             ('stream', stream)), len(data))
+
+    def on_exit(self, cmd_proc, returncode, duration):
+        """Count the completed processes and their duration."""
+        name = _cmd_name(cmd_proc)
+        with self._lock:
+            self._inc('commands_total', (('cmd', name),
+                                         ('returncode', str(returncode))))
+            if duration is not None:
+                self._inc('duration_seconds_sum', (('cmd', name),), duration)
+                self._inc('duration_seconds_count', (('cmd', name),))
+            self._running[name] = max(0, self._running.get(name, 0) - 1)
+
+        if self.path is not None:
+            self._schedule()
+
+    def on_timeout(self, cmd_proc, timeout):
+        """Count the timeouts."""
+        # pylint: disable=unused-argument
+        with self._lock:
+            self._inc('timeouts_total', (('cmd', _cmd_name(cmd_proc)),))
+
+    def render(self):
+        """Return the metrics (Prometheus text format)."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            running = sorted(self._running.items())
+
+        lines = []
+        declared = set()
+        for (metric, labels), value in counters:
+            family = metric.rsplit('_', 1)[0] if metric.endswith(
+                ('_sum', '_count')) else metric
+            if family not in declared:
+                declared.add(family)
+                lines.append('# TYPE {}_{} {}'.format(
+                    self.PREFIX, family,
+                    'summary' if family != metric else 'counter'))
+            lines.append('{}_{}{} {}'.format(self.PREFIX, metric,
+                                             _labels(labels), value))
+
+        if running:
+            lines.append('# TYPE {}_running gauge'.format(self.PREFIX))
+        for name, value in running:
+            lines.append('{}_running{} {}'.format(self.PREFIX,
+                                                  _labels((('cmd', name),)),
+                                                  value))
+
+        return '\n'.join(lines) + '\n'
+
+    def _schedule(self):
+        """Write the file now, or later if it was written recently."""
+        with self._lock:
+            if self._timer is not None:
+                return      # the pending write will include the changes
+            delay = 0 if self._written is None \
+                else self._written + self.interval - monotonic()
+            if delay > 0:
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Write the metrics to self.path now (cancel the pending write)."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._written = monotonic()
+        if self.path is not None:
+            self.write(self.path)
+
+    def close(self):
+        """Write the last metrics to self.path."""
+        self.flush()
+
+    def write(self, path):
+        """Write the metrics to a file (atomically)."""
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with self._write_lock:
+            with open(tmp_path, 'w') as fhandle:
+                fhandle.write(self.render())
+            os.replace(tmp_path, path)
+
+    def serve(self, address):
+        """Send the metrics to each client of a Unix socket (a thread).
+
+        Return the listening socket (close it to stop serving).
+
+        """
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+        server.listen(8)
+
+        def accept():
+            """Answer the clients until the socket is closed."""
+            while True:
+                try:
+                    client, _ = server.accept()
+                except OSError:
+                    break
+                with client:
+                    client.sendall(self.render().encode('utf-8'))
+
+        threading.Thread(target=accept, daemon=True).start()
+        return server
+
+
+def _labels(labels):
+    """Return the Prometheus labels: {name="value",...}."""
+    return '{' + ','.join('{}="{}"'.format(
+        name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+class CmdChromeTrace(object):
+    """Write the processes as Chrome trace events (to add to CmdHooks).
+
+    Open the file with chrome://tracing or https://ui.perfetto.dev: each
+    process is a slice (a row per process) on the same timeline.
+
+    """
+
+    def __init__(self, path):
+        """Init the trace (written to 'path' by write()/close())."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._events = []
+        self._starts = {}
+        # the trace timestamps are microseconds since the epoch
+        self._offset = time() - monotonic()
+
+    def _timestamp(self, monotonic_time=None):
+        """Return a trace timestamp (microseconds)."""
+        if monotonic_time is None:
+            monotonic_time = monotonic()
+        return int((monotonic_time + self._offset) * 1000000)
+
+    def after_spawn(self, cmd_proc, pid, spawn_time):
+        """Remember when the process started."""
+        with self._lock:
+            self._starts[cmd_proc] = (monotonic() - spawn_time, pid)
+
+    def on_exit(self, cmd_proc, returncode, duration):
+        """Add the slice of the process."""
+        # pylint: disable=unused-argument
+        with self._lock:
+            start, pid = self._starts.pop(cmd_proc, (None, None))
+            if start is None:
+                return
+            self._events.append({
+                'name': _cmd_name(cmd_proc), 'cat': 'cmd', 'ph': 'X',
+                'ts': self._timestamp(start),
+                'dur': int((monotonic() - start) * 1000000),
+                'pid': os.getpid(), 'tid': pid,
+                # pylint: disable=protected-access
+                'args': {'cmd': cmd_proc._cmd_str, 'returncode': returncode}})
+
+    def on_timeout(self, cmd_proc, timeout):
+        """Add an instant event."""
+        with self._lock:
+            _, pid = self._starts.get(cmd_proc, (None, None))
+            self._events.append({'name': 'timeout', 'cat': 'cmd', 'ph': 'i',
+                                 's': 't', 'ts': self._timestamp(),
+                                 'pid': os.getpid(), 'tid': pid,
+                                 'args': {'timeout': timeout}})
+
+    @property
+    def events(self):
+        """Return the trace events."""
+        with self._lock:
+            return list(self._events)
+
+    def write(self):
+        """Write the trace (JSON) to self.path."""
+        with open(self.path, 'w') as fhandle:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, fhandle)
+
+    def close(self):
+        """Write the trace."""
+        self.write()
+
+
+def main():
+    """Test the class CmdHooks and the adapters."""
+    import unittest
+    import tempfile
+    from time import sleep
+
+    class FakeProc(object):
+        """A CmdProc-like object."""
+
+        # pylint: disable=too-few-public-methods
+        def __init__(self, cmd):
+            """Init the process."""
+            self._cmd_list = cmd.split()
+            self._cmd_str = cmd
+
+    class TestCmdHooks(unittest.TestCase):
+        """Testing the class CmdHooks and the adapters."""
+
+        def test_cmdhooks(self):
+            """Test: CmdHooks()."""
+            hooks = CmdHooks()
+            self.assertFalse(hooks)
+            calls = []
+
+            def on_exit(cmd_proc, **info):
+                """Store the call."""
+                calls.append((cmd_proc, info))
+
+            hooks.register('on_exit', on_exit)
+            hooks.register('on_exit', lambda cmd_proc, **info: 1 / 0)
+            self.assertTrue(hooks)
+            self.assertTrue(hooks.wants('on_exit'))
+            self.assertFalse(hooks.wants('on_timeout'))
+
+            with self.assertLogs(level='ERROR'):
+                hooks.emit('on_exit', 'proc', returncode=0, duration=1)
+            self.assertEqual(calls, [('proc', {'returncode': 0,
+                                               'duration': 1})])
+
+            hooks.unregister('on_exit', on_exit)
+            with self.assertLogs(level='ERROR'):
+                hooks.emit('on_exit', 'proc', returncode=0, duration=1)
+            self.assertEqual(len(calls), 1)
+
+            with self.assertRaises(AssertionError):
+                hooks.register('on_xxx', on_exit)
+
+        def test_prometheus(self):
+            """Test: CmdPrometheusExporter()."""
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'metrics.prom')
+                hooks = CmdHooks()
+                exporter = hooks.add(CmdPrometheusExporter(path=path))
+                proc = FakeProc('/bin/ls /')
+                hooks.emit('after_spawn', proc, pid=1, spawn_time=0.5)
+                hooks.emit('on_output_chunk', proc, stream='stdout',
+                           data=b'abc')
+                hooks.emit('on_timeout', proc, timeout=1)
+                hooks.emit('on_exit', proc, returncode=0, duration=2)
+
+                with open(path) as fhandle:
+                    metrics = fhandle.read()
+                self.assertEqual(metrics, exporter.render())
+                for line in ('# TYPE cmdwrapper_spawn_seconds summary',
+                             'cmdwrapper_spawn_seconds_sum{cmd="ls"} 0.5',
+                             'cmdwrapper_commands_total{cmd="ls",'
+                             'returncode="0"} 1',
+                             'cmdwrapper_duration_seconds_count{cmd="ls"} 1',
+                             'cmdwrapper_output_bytes_total{cmd="ls",'
+                             'stream="stdout"} 3',
+                             'cmdwrapper_timeouts_total{cmd="ls"} 1',
+                             'cmdwrapper_running{cmd="ls"} 0'):
+                    self.assertIn(line, metrics.splitlines())
+
+                # the next writes are throttled (one pending write)
+                for _ in range(10):
+                    hooks.emit('after_spawn', proc, pid=1, spawn_time=0.5)
+                    hooks.emit('on_exit', proc, returncode=1, duration=2)
+                with open(path) as fhandle:
+                    self.assertEqual(fhandle.read(), metrics)
+                exporter.close()
+                with open(path) as fhandle:
+                    metrics = fhandle.read()
+                self.assertEqual(metrics, exporter.render())
+                self.assertIn('cmdwrapper_commands_total{cmd="ls",'
+                              'returncode="1"} 10', metrics.splitlines())
+
+                exporter.interval = 0.1
+                hooks.emit('on_exit', proc, returncode=2, duration=2)
+                sleep(0.3)
+                with open(path) as fhandle:
+                    self.assertEqual(fhandle.read(), exporter.render())
+
+                address = os.path.join(tmpdir, 'metrics.sock')
+                server = exporter.serve(address)
+                with socket.socket(socket.AF_UNIX) as client:
+                    client.connect(address)
+                    data = b''
+                    while True:
+                        chunk = client.recv(4096)
+                        if not chunk:
+                            break
+                        data += chunk
+                server.close()
+                self.assertEqual(data.decode(), exporter.render())
+
+        def test_chrome_trace(self):
+            """Test: CmdChromeTrace()."""
+            with tempfile.TemporaryDirectory() as tmpdir:
+                hooks = CmdHooks()
+                trace = hooks.add(CmdChromeTrace(os.path.join(tmpdir,
+                                                              'trace.json')))
+                procs = [FakeProc('sleep 1'), FakeProc('ls')]
+                for num, proc in enumerate(procs):
+                    hooks.emit('after_spawn', proc, pid=num, spawn_time=0)
+                hooks.emit('on_timeout', procs[0], timeout=1)
+                for proc in procs:
+                    hooks.emit('on_exit', proc, returncode=0, duration=0)
+                hooks.emit('on_exit', FakeProc('x'), returncode=0,
+                           duration=0)
+                trace.close()
+
+                with open(trace.path) as fhandle:
+                    events = json.load(fhandle)['traceEvents']
+                self.assertEqual([(event['name'], event['ph'], event['tid'])
+                                  for event in events],
+                                 [('timeout', 'i', 0), ('sleep', 'X', 0),
+                                  ('ls', 'X', 1)])
+                self.assertEqual(events[1]['args']['cmd'], 'sleep 1')
+
+        def test_timeout(self):
+            """Test: on_exit is emitted when the timeout kills the process."""
+            from cmdwrapper.cmdproc import CmdProc, CmdProcTimeout
+            from cmdwrapper.cmdpoller import CmdReactor
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                hooks = CmdHooks()
+                exporter = hooks.add(CmdPrometheusExporter())
+                trace = hooks.add(CmdChromeTrace(os.path.join(tmpdir,
+                                                              'trace.json')))
+                errors = []
+                hooks.register('on_error',
+                               lambda cmd_proc, error: errors.append(error))
+
+                with self.assertRaises(CmdProcTimeout):
+                    CmdProc('sleep 10', timeout=0.2, hooks=hooks).wait()
+
+                # the same events when the reactor kills the process
+                reactor = CmdReactor()
+                reactor.register(CmdProc('sleep 10', timeout=0.2,
+                                         hooks=hooks))
+                while reactor:
+                    reactor.poll()
+                reactor.close()
+
+                metrics = exporter.render().splitlines()
+                self.assertIn('cmdwrapper_running{cmd="sleep"} 0', metrics)
+                self.assertIn('cmdwrapper_commands_total{cmd="sleep",'
+                              'returncode="-15"} 2', metrics)
+                self.assertIn('cmdwrapper_timeouts_total{cmd="sleep"} 2',
+                              metrics)
+                # pylint: disable=protected-access
+                self.assertEqual(trace._starts, {})
+                self.assertEqual([event['ph'] for event in trace.events],
+                                 ['i', 'X', 'i', 'X'])
+                self.assertEqual([type(error) for error in errors],
+                                 [CmdProcTimeout] * 2)
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdHooks)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Launch the commands from a small helper process (a fork server)."""
+
+import sys
+import os
+import json
+import socket
+import signal
+import threading
+import subprocess
+from subprocess import TimeoutExpired
+from cmdwrapper.cmdspawn import std_fds
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+# socket.send_fds() and socket.recv_fds() are new in Python 3.9
+if sys.version_info < (3, 9):
+    raise ImportError('cmdwrapper.cmdlauncher needs Python >= 3.9')
+
+# The maximum size of a message (command spec or reply)
+MESSAGE_MAX = 1024 ** 2
+
+
+class CmdLauncher(object):
+    """A small long-lived process that starts the commands for us.
+
+    Forking a process that has a large resident memory is slow (its page
+    tables are copied). The launcher is started once, while the parent is
+    still small, and each command spec (argv, env, cwd) is sent to it with
+    the stdin/stdout/stderr file descriptors (SCM_RIGHTS, Unix socket).
+
+    >>> launcher = CmdLauncher()
+    >>> stat = CmdWrapper('stat', spawn=launcher)
+    >>> stat('/etc/hosts').stdout.lines
+    >>> launcher.close()
+
+    """
+
+    def __init__(self):
+        """Start the launcher process."""
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_SEQPACKET)
+        package_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))
+        code = ('import sys; sys.path.insert(0, {!r}); '
+                'from cmdwrapper.cmdlauncher import serve; serve({})'
+                .format(package_dir, child_sock.fileno()))
+        try:
+            self._proc = subprocess.Popen([sys.executable, '-c', code],
+                                          stdin=subprocess.DEVNULL,
+                                          pass_fds=[child_sock.fileno()],
+                                          start_new_session=True)
+        except Exception:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+
+        self._sock = parent_sock
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        """Return the launcher."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the launcher."""
+        self.close()
+
+    @property
+    def pid(self):
+        """Return the pid of the launcher process."""
+        return self._proc.pid
+
+    def launch(self, args, stdin=None, stdout=None, stderr=None, cwd=None,
+               env=None, executable=None, setsid=False):
+        """Start a command. Return a CmdLaunchedProcess (Popen-like).
+
+        setsid=True starts the command in a new session (process group).
+        Like Popen, cwd=None and env=None are the current directory and
+        the environment of this process (not of the launcher).
+
+        """
+        # pylint: disable=too-many-arguments
+        if self._sock is None:
+            raise ValueError('the launcher is closed')
+
+        child_fds, parent_files, close_fds = std_fds(stdin, stdout, stderr)
+        targets = sorted(child_fds)
+        spec = json.dumps({'args': list(args), 'executable': executable,
+                           'cwd': os.getcwd() if cwd is None else cwd,
+                           'env': dict(os.environ if env is None else env),
+                           'setsid': setsid,
+                           'targets': targets}).encode('utf-8')
+
+        # one connection per command: the pid and the exit status come back
+        # through it
+        conn, remote_conn = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_SEQPACKET)
+        try:
+            with self._lock:
+                socket.send_fds(self._sock, [spec],
+                                [remote_conn.fileno()] +
+                                [child_fds[target] for target in targets])
+            remote_conn.close()
+            reply = _recv_json(conn)
+        except Exception:
+            conn.close()
+            remote_conn.close()
+            for fileobj in parent_files.values():
+                fileobj.close()
+            raise
+        finally:
+            for fd in close_fds:
+                os.close(fd)
+
+        if 'errno' in reply:
+            conn.close()
+            for fileobj in parent_files.values():
+                fileobj.close()
+            raise OSError(reply['errno'], reply['strerror'], args[0])
+
+        return CmdLaunchedProcess(args, reply['pid'], conn,
+                                  parent_files.get(0), parent_files.get(1),
+                                  parent_files.get(2))
+
+    def close(self):
+        """Stop the launcher.
+
+        The launcher exits when the commands it started are terminated.
+
+        """
+        if self._sock is None:
+            return
+
+        self._sock.close()
+        self._sock = None
+        self._proc.wait()
+
+
+class CmdLaunchedProcess(object):
+    """A process started by CmdLauncher (subset of Popen's API)."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, args, pid, conn, stdin=None, stdout=None, stderr=None):
+        """Init the process (see CmdLauncher.launch())."""
+        self.args = args
+        self.pid = pid
+        self.returncode = None
+        self.rusage = None
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self._conn = conn
+
+    def _read_status(self, timeout):
+        """Read the exit status sent by the launcher (if it is ready)."""
+        self._conn.settimeout(timeout)
+        try:
+            reply = _recv_json(self._conn)
+        except (socket.timeout, BlockingIOError):
+            return
+        except (ConnectionError, ValueError):
+            # the launcher was killed: the status is lost
+            reply = {'returncode': -signal.SIGKILL, 'rusage': None}
+
+        self._conn.close()
+        self.rusage = reply['rusage']
+        self.returncode = reply['returncode']
+
+    def poll(self):
+        """Check if the process is terminated. Return the returncode."""
+        if self.returncode is None:
+            self._read_status(0)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait until the process is terminated. Return the returncode."""
+        if self.returncode is None:
+            self._read_status(timeout)
+            if self.returncode is None:
+                raise TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        """Send a signal to the process (if it is running)."""
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        """Send SIGTERM."""
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        """Send SIGKILL."""
+        self.send_signal(signal.SIGKILL)
+
+
+def _recv_json(sock):
+    """Receive one JSON message. Raise ConnectionError on EOF."""
+    data = sock.recv(MESSAGE_MAX)
+    if not data:
+        raise ConnectionError('connection closed by the launcher')
+    return json.loads(data.decode('utf-8'))
+
+
+def _send_json(sock, message):
+    """Send one JSON message (ignore the closed connections)."""
+    try:
+        sock.send(json.dumps(message).encode('utf-8'))
+    except OSError:
+        pass
+
+
+def _reap(proc, conn):
+    """Wait for the exit of proc, send its status and its rusage."""
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    _send_json(conn, {'returncode': proc.returncode,
+                      'rusage': {'ru_utime': rusage.ru_utime,
+                                 'ru_stime': rusage.ru_stime,
+                                 'ru_maxrss': rusage.ru_maxrss}})
+    conn.close()
+
+
+def serve(fd):
+    """Run the main loop of the launcher process (read the command specs)."""
+    sock = socket.socket(fileno=fd)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        data, fds, _, _ = socket.recv_fds(sock, MESSAGE_MAX, 4)
+        if not data:
+            break   # the parent closed the launcher (or it died)
+
+        conn = socket.socket(fileno=fds[0])
+        spec = json.loads(data.decode('utf-8'))
+        std = dict(zip(spec['targets'], fds[1:]))
+        try:
+            proc = subprocess.Popen(spec['args'],
+                                    executable=spec['executable'],
+                                    cwd=spec['cwd'],
+                                    env=spec['env'], stdin=std.get(0),
+                                    stdout=std.get(1), stderr=std.get(2),
+                                    start_new_session=spec['setsid'])
+        except OSError as err:
+            _send_json(conn, {'errno': err.errno, 'strerror': err.strerror})
+            conn.close()
+            continue
+        finally:
+            for child_fd in fds[1:]:
+                os.close(child_fd)
+
+        _send_json(conn, {'pid': proc.pid})
+        threading.Thread(target=_reap, args=(proc, conn)).start()
+
+
+def main():
+    """Test the class CmdLauncher."""
+    import unittest
+    from subprocess import PIPE, STDOUT, DEVNULL
+
+    class TestCmdLauncher(unittest.TestCase):
+        """Testing the class CmdLauncher."""
+
+        def test_cmdlauncher(self):
+            """Test: CmdLauncher()."""
+            with CmdLauncher() as launcher:
+                proc = launcher.launch(['bash', '-c', 'cat; pwd; '
+                                        'echo $TEST >&2; exit 3'],
+                                       stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                                       cwd='/', env={'TEST': 'HIWORLD'})
+                self.assertNotEqual(proc.pid, launcher.pid)
+                proc.stdin.write(b'INPUT\n')
+                proc.stdin.close()
+                self.assertEqual(proc.stdout.read(), b'INPUT\n/\nHIWORLD\n')
+                proc.stdout.close()
+                self.assertEqual(proc.wait(), 3)
+                self.assertEqual(proc.poll(), 3)
+                self.assertIn('ru_utime', proc.rusage)
+                proc.kill()   # already terminated
+
+                proc = launcher.launch(['sleep', '10'], stdout=DEVNULL)
+                with self.assertRaises(TimeoutExpired):
+                    proc.wait(timeout=0.1)
+                self.assertIsNone(proc.poll())
+                proc.kill()
+                self.assertEqual(proc.wait(), -signal.SIGKILL)
+
+                with self.assertRaises(OSError):
+                    launcher.launch(['/xxx/rrr/cmdlauncher'], stdout=PIPE)
+
+                procs = [launcher.launch(['echo', str(num)], stdout=PIPE)
+                         for num in range(20)]
+                for num, proc in enumerate(procs):
+                    self.assertEqual(proc.stdout.read(),
+                                     '{}\n'.format(num).encode())
+                    proc.stdout.close()
+                    self.assertEqual(proc.wait(), 0)
+
+            with self.assertRaises(ValueError):
+                launcher.launch(['true'])
+
+        def test_current_state(self):
+            """Test: the current cwd and environment of the parent."""
+            cwd = os.getcwd()
+            with CmdLauncher() as launcher:
+                os.chdir('/tmp')
+                os.environ['CMDLAUNCHER_TEST'] = 'bar'
+                try:
+                    proc = launcher.launch(['bash', '-c', 'pwd; '
+                                            'echo $CMDLAUNCHER_TEST'],
+                                           stdout=PIPE)
+                    self.assertEqual(proc.stdout.read(), b'/tmp\nbar\n')
+                    proc.stdout.close()
+                    self.assertEqual(proc.wait(), 0)
+                finally:
+                    os.chdir(cwd)
+                    del os.environ['CMDLAUNCHER_TEST']
+
+        def test_cmdwrapper(self):
+            """Test: CmdWrapper(spawn=CmdLauncher())."""
+            from cmdwrapper import CmdWrapper
+            from cmdwrapper.cmdproc import CmdProcError
+
+            with CmdLauncher() as launcher:
+                bash = CmdWrapper('bash', args=['-c'], cwd='/', timeout=5,
+                                  env={'TEST': 'HIWORLD'}, spawn=launcher)
+                running = bash('echo $TEST; pwd; cat; echo ERR >&2',
+                               input=b'INPUT')
+                self.assertEqual(running.stdout.lines,
+                                 ['HIWORLD', '/', 'INPUT'])
+                self.assertIn('ERR', running.stderr.lines)
+                self.assertEqual(running.returncode, 0)
+
+                with self.assertRaises(CmdProcError):
+                    bash('exit 3').wait()
+
+                with self.assertRaises(TimeoutExpired):
+                    bash('sleep 10', timeout=1).wait()
+
+                results = list(bash.map([('echo {}'.format(num),)
+                                         for num in range(10)]))
+                self.assertEqual([result.stdout.firstline
+                                  for result in results],
+                                 [str(num) for num in range(10)])
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdLauncher)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -10,34 +10,212 @@
 #
 """The output of a command (stdout or stderr)."""
 
+import re
 import sys
+import json
+import mmap
+import codecs
+import locale
+from array import array
+from operator import methodcaller
+from collections.abc import Sequence
+from cmdwrapper.cmdparse import iter_jsonl, parse_columns, parse_kv
 
-assert sys.version_info >= (3, 3), "The Python version need to be >= 3.3"
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+# The lines are delimited with '\n' (a '\r' before it is removed too).
+# The positions of the '\n' are indexed by blocks (the first block is small
+# to find the first lines quickly)
+_SCAN_BLOCK_MIN = 4096
+_SCAN_BLOCK_MAX = 4 * 1024 * 1024
+_NEWLINE = {bytes: re.compile(b'\n'), str: re.compile('\n')}
+_MATCH_START = methodcaller('start')
+
+
+def find_encoding(encoding):
+    """Return the codec name of 'encoding' ('locale': the locale's one).
+
+    None (no decoding: bytes) is returned as it is. LookupError is raised if
+    the encoding is unknown.
+
+    """
+    if encoding is None:
+        return None
+    if encoding == 'locale':
+        encoding = locale.getpreferredencoding(False)
+    return codecs.lookup(encoding).name
+
+
+class CmdLines(Sequence):
+    """The lines of a CmdOutput (found and decoded on demand).
+
+    lines[i] only decodes the line i and the index of the line offsets is
+    built once, as far as needed: lines[0] does not read the whole output.
+
+    """
+
+    def __init__(self, cmd_output):
+        """Init the lines of 'cmd_output'."""
+        assert isinstance(cmd_output, CmdOutput)
+        self._output = cmd_output
+
+    def __len__(self):
+        """Return the number of lines."""
+        # pylint: disable=protected-access
+        return self._output._line_count()
+
+    def __getitem__(self, index):
+        """Return a line (or a list of lines if 'index' is a slice)."""
+        if isinstance(index, slice):
+            return [self[num] for num in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        # pylint: disable=protected-access
+        line = None if index < 0 else self._output._line(index)
+        if line is None:
+            raise IndexError('line index out of range')
+        return line
+
+    def __iter__(self):
+        """Iterate through the lines."""
+        index = 0
+        while True:
+            # pylint: disable=protected-access
+            line = self._output._line(index)
+            if line is None:
+                return
+            yield line
+            index += 1
+
+    def __eq__(self, other):
+        """Compare the lines with another sequence (list, tuple...)."""
+        if not isinstance(other, Sequence) or isinstance(other, (str,
+                                                                 bytes)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        """Return the repr (the list of lines)."""
+        return repr(list(self))
 
 
 class CmdOutput(object):
-    """The output of a command (stdout or stderr)."""
+    """The output of a command (stdout or stderr).
+
+    The output is stored as it is (bytes, bytearray, memoryview, mmap...)
+    and decoded only when a text representation is needed.
 
-    def __init__(self, output):
-        """Store the output internally."""
-        self._output = None
+    """
+
+    def __init__(self, output, encoding='utf-8', errors='ignore'):
+        """Store the output internally.
+
+        :encoding: the encoding of the output: a codec ('utf-8', 'latin-1'
+                   ...), 'locale' (the encoding of the locale) or None: no
+                   decoding, the lines and the output are bytes (str() is
+                   decoded from UTF-8, the invalid bytes are escaped).
+        :errors: what to do with the invalid bytes: 'ignore' (dropped),
+                 'strict' (UnicodeDecodeError), 'replace', 'surrogateescape'
+                 (kept: self.bytes returns them)...
+
+        """
+        self._encoding = find_encoding(encoding)
+        self._errors = errors
+        self._codec = None if self._encoding is None \
+            else codecs.lookup(self._encoding)
+        # True: the lines can be found in the bytes (ASCII compatible)
+        self._ascii_lines = self._codec is None or \
+            self._codec.encode('\n')[0] == b'\n'
+        self._raw = None
+        self._text = None
+        self._buffer = None
+        self._newlines = None
+        self._scan_pos = 0
+        self._scanned = False
+        self._count = None
+        self._parsed = None
         self.output = output
 
     @property
     def lines(self):
-        """Return the output as a list (each item is a line)."""
-        return self.output.splitlines()
+        """Return the output as a sequence (each item is a line).
+
+        A read-only CmdLines, not a list (list(lines) returns a list). The
+        lines are delimited with the newlines only (a carriage return before
+        a newline is removed): a bare carriage return does not split them.
+
+        """
+        return CmdLines(self)
 
     @property
     def firstline(self):
         """Return the first line of the output."""
-        if self.output != '':
-            return self.lines[0]
+        line = self._line(0)
+        if line is None:
+            return b'' if self._codec is None else ''
+        return line
+
+    @property
+    def bytes(self):
+        """Return the output's content (bytes, never decoded)."""
+        if self._raw is None:
+            self._raw = self._encode(self._text)
+        if not isinstance(self._raw, bytes):
+            return bytes(self._raw)
+        return self._raw
+
+    @property
+    def view(self):
+        """Return a memoryview of the output's content (no copy)."""
+        if self._raw is None:
+            self._raw = self._encode(self._text)
+        return memoryview(self._raw)
+
+    def json(self):
+        """Return the output parsed as JSON ('ip -j', 'lsblk -J'...).
+
+        The bytes are parsed (JSON is UTF-8): the invalid bytes raise
+        ValueError instead of being dropped by the 'errors' handler.
 
-        return ''
+        """
+        return self._cached(('json',), lambda: json.loads(self.bytes))
+
+    def jsonl(self):
+        """Yield the documents of a JSON Lines output (one per line).
+
+        The bytes lines are parsed like json() (nothing is cached).
+
+        """
+        return iter_jsonl(self.bytes.splitlines())
+
+    def columns(self, sep=None, header=True):
+        """Return the columns of a table ('ps', 'df'...).
+
+        header=True: {name: [values]}, header=False: a list of columns (see
+        cmdparse.parse_columns()).
+
+        """
+        return self._cached(('columns', sep, header),
+                            lambda: parse_columns(self.lines, sep=sep,
+                                                  header=header))
+
+    def kv(self, sep='='):
+        """Return the dict of the lines 'key=value' (see cmdparse)."""
+        return self._cached(('kv', sep),
+                            lambda: parse_kv(self.lines, sep=sep))
+
+    def _cached(self, key, parse):
+        """Return parse() (computed once: the same object is returned)."""
+        if key not in self._parsed:
+            self._parsed[key] = parse()
+        return self._parsed[key]
 
     def __str__(self):
         """Return the output."""
+        if self._codec is None:
+            return self.bytes.decode('utf-8', errors='backslashreplace')
         return self.output
 
     def __iter__(self):
@@ -47,21 +225,107 @@ class CmdOutput(object):
 
     @property
     def output(self):
-        """Return the output's content (string)."""
-        return self._output
+        """Return the output's content (string, bytes if encoding=None)."""
+        if self._codec is None:
+            return self.bytes
+        if self._text is None:
+            self._text = self._decode(self._raw)
+        return self._text
 
     @output.setter
     def output(self, output):
-        """Return an unified version of the output."""
+        """Store the content (the bytes are decoded on demand)."""
         if output is None:
             output = ''
         else:
-            assert isinstance(output, (bytes, str))
+            assert isinstance(output, (bytes, bytearray, memoryview,
+                                       mmap.mmap, str))
+
+        # the buffer where the lines are found
+        self._buffer = output
+        if isinstance(output, str):
+            self._raw = None
+            self._text = output
+        else:
+            self._raw = output
+            self._text = None
+            if not self._ascii_lines:
+                # UTF-16...: the '\n' are found in the text
+                self._text = self._buffer = self._decode(output)
+
+        # the index of the '\n' positions (built on demand)
+        self._newlines = array('Q')
+        self._scan_pos = 0
+        self._scanned = False
+        self._count = None
+        self._parsed = {}
+
+    def _decode(self, data):
+        """Decode bytes.
+
+        The codec reads the buffer (memoryview, mmap...) without a copy. With
+        latin-1, each byte is a character: the decoding is a simple copy.
+
+        """
+        return self._codec.decode(data, self._errors)[0]
+
+    def _encode(self, text):
+        """Encode the text (see self.bytes)."""
+        return text.encode(self._encoding or 'utf-8', self._errors)
 
-        if isinstance(output, bytes):
-            output = output.decode('utf-8', errors='ignore')
+    def _scan_until(self, index):
+        """Index the newline positions until the line 'index' (None: all)."""
+        regex = _NEWLINE[str if isinstance(self._buffer, str) else bytes]
+        block_size = _SCAN_BLOCK_MIN
+        while not self._scanned and \
+                (index is None or len(self._newlines) <= index):
+            start = self._scan_pos
+            end = min(start + block_size, len(self._buffer))
+            if start >= end:
+                self._scanned = True
+                break
 
-        self._output = output
+            self._newlines.extend(map(_MATCH_START,
+                                      regex.finditer(self._buffer, start,
+                                                     end)))
+            self._scan_pos = end
+            block_size = min(block_size * 4, _SCAN_BLOCK_MAX)
+
+    def _line_count(self):
+        """Return the number of lines."""
+        if self._count is None:
+            if hasattr(self._buffer, 'count'):
+                newline = '\n' if isinstance(self._buffer, str) else b'\n'
+                self._count = self._buffer.count(newline)
+            else:
+                self._scan_until(None)
+                self._count = len(self._newlines)
+
+            size = len(self._buffer)
+            if size and self._buffer[size - 1:size] not in (b'\n', '\n'):
+                self._count += 1  # the last line without '\n'
+        return self._count
+
+    def _line(self, index):
+        """Return the line 'index' (None if it does not exist)."""
+        self._scan_until(index)
+        if index > len(self._newlines):
+            return None
+
+        start = self._newlines[index - 1] + 1 if index > 0 else 0
+        if index < len(self._newlines):
+            end = self._newlines[index]
+        elif index == len(self._newlines) and start < len(self._buffer):
+            end = len(self._buffer)
+        else:
+            return None
+
+        line = self._buffer[start:end]
+        if isinstance(line, str):
+            return line.rstrip('\r')
+        if self._codec is None:
+            return bytes(line).rstrip(b'\r')
+        return self._decode(line).rstrip('\r')
 
 
 def main():
@@ -108,10 +372,106 @@ def main():
                 self.assertEqual(cmd_output.lines[1],
                                  second_line.decode('utf-8', errors='ignore'))
 
+            # big output: the lines are decoded on demand
+            cmd_output = CmdOutput(b'L\xc3\xa9\r\n' * 100000 + b'end')
+            self.assertEqual(cmd_output.firstline, 'L\u00e9')
+            # pylint: disable=protected-access
+            self.assertLess(len(cmd_output._newlines), 1000)
+            self.assertIsNone(cmd_output._text)
+            self.assertEqual(cmd_output.lines[-1], 'end')
+            self.assertEqual(len(cmd_output.lines), 100001)
+            self.assertEqual(cmd_output.lines[10:12], ['L\u00e9', 'L\u00e9'])
+            self.assertEqual(cmd_output.lines[99999:], ['L\u00e9', 'end'])
+            self.assertEqual(len(cmd_output.bytes), 500003)
+            self.assertIsNone(cmd_output._text)
+            with self.assertRaises(IndexError):
+                cmd_output.lines[100001]  # pylint: disable=pointless-statement
+
+            cmd_output = CmdOutput(b'a\nb\nc\n')
+            self.assertEqual(cmd_output.lines[-3], 'a')
+            with self.assertRaises(IndexError):
+                cmd_output.lines[-5]    # pylint: disable=pointless-statement
+
+            cmd_output = CmdOutput(memoryview(b'a\nb\n'))
+            self.assertEqual(cmd_output.lines, ['a', 'b'])
+            self.assertEqual(repr(cmd_output.lines), "['a', 'b']")
+            self.assertEqual(list(cmd_output.lines) + ['c'], ['a', 'b', 'c'])
+            self.assertEqual(CmdOutput(b'a\rb\r\nc').lines, ['a\rb', 'c'])
+            self.assertEqual(cmd_output.view.tobytes(), b'a\nb\n')
+            self.assertEqual(CmdOutput('a\nb').bytes, b'a\nb')
+
+            # the parsers
+            cmd_output = CmdOutput(b'{"a": [1, 2]}\n')
+            self.assertEqual(cmd_output.json(), {'a': [1, 2]})
+            self.assertIs(cmd_output.json(), cmd_output.json())
+            cmd_output = CmdOutput(memoryview(b'{"a": 1}\n\n{"a": 2}\n'))
+            self.assertEqual(list(cmd_output.jsonl()), [{'a': 1}, {'a': 2}])
+            self.assertEqual(CmdOutput('{"a": "\xe9"}').json(), {'a': '\xe9'})
+            for cmd_output in (CmdOutput(b'\xff{"a":1}'),
+                               CmdOutput(b'{"a":1}\n\xff{"a":1}')):
+                with self.assertRaises(ValueError):
+                    list(cmd_output.jsonl())
+            with self.assertRaises(ValueError):
+                CmdOutput(b'\xff{"a":1}').json()
+            cmd_output = CmdOutput(b'A  B\n1  2\n3  4 5\n')
+            self.assertEqual(cmd_output.columns(),
+                             {'A': ['1', '3'], 'B': ['2', '4 5']})
+            self.assertEqual(cmd_output.columns(header=False),
+                             [['A', '1', '3'], ['B', '2', '4'],
+                              [None, None, '5']])
+            self.assertEqual(CmdOutput('A=1\nB="2"').kv(),
+                             {'A': '1', 'B': '2'})
+            cmd_output.output = b'X=1'
+            self.assertEqual(cmd_output.kv(), {'X': '1'})
+            cmd_output = CmdOutput(b'A="1"\n# B=2\nC:D:3', encoding=None)
+            self.assertEqual(cmd_output.kv(), {b'A': b'1'})
+            self.assertEqual(cmd_output.columns(sep=':', header=False),
+                             [[b'A="1"', b'# B=2', b'C'], [None, None, b'D'],
+                              [None, None, b'3']])
+
             # test the case of an empty content
             cmd_output = CmdOutput('')
             cmd_output = CmdOutput(None)
             self.assertEqual(cmd_output.firstline, '')
+            self.assertEqual(len(cmd_output.lines), 0)
+
+        def test_encoding(self):
+            """Test: CmdOutput(encoding=..., errors=...)."""
+            data = b'caf\xe9\n\xff'
+            self.assertEqual(CmdOutput(data).output, 'caf\n')
+            self.assertEqual(CmdOutput(data, 'latin-1').lines,
+                             ['caf\u00e9', '\u00ff'])
+            self.assertEqual(CmdOutput(data, errors='replace').firstline,
+                             'caf\ufffd')
+            with self.assertRaises(UnicodeDecodeError):
+                _ = CmdOutput(data, errors='strict').output
+
+            # the invalid bytes are kept
+            cmd_output = CmdOutput(data, errors='surrogateescape')
+            self.assertEqual(CmdOutput(cmd_output.output,
+                                       errors='surrogateescape').bytes, data)
+
+            # mmap: decoded without a copy
+            buf = mmap.mmap(-1, len(data))
+            buf.write(data)
+            self.assertEqual(CmdOutput(buf, 'latin-1').output,
+                             'caf\u00e9\n\u00ff')
+
+            # raw bytes
+            cmd_output = CmdOutput(memoryview(data), encoding=None)
+            self.assertEqual(cmd_output.output, data)
+            self.assertEqual(cmd_output.lines, [b'caf\xe9', b'\xff'])
+            self.assertEqual(str(cmd_output), 'caf\\xe9\n\\xff')
+            self.assertEqual(CmdOutput(None, encoding=None).firstline, b'')
+
+            # the lines of UTF-16 are found in the text
+            cmd_output = CmdOutput('a\nb\u00e9\n'.encode('utf-16'),
+                                   'utf-16')
+            self.assertEqual(cmd_output.lines, ['a', 'b\u00e9'])
+            self.assertEqual(find_encoding('UTF8'), 'utf-8')
+            self.assertIsNotNone(find_encoding('locale'))
+            with self.assertRaises(LookupError):
+                find_encoding('nonexistent')
 
     tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdOutput)
     ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Parse the usual output formats (JSON Lines, columns, key=value)."""
+
+import sys
+import json
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+def _literal(text, line):
+    """Return 'text' encoded in UTF-8 when 'line' is bytes (encoding=None)."""
+    if isinstance(line, bytes) and isinstance(text, str):
+        return text.encode('utf-8')
+    return text
+
+
+def iter_jsonl(lines):
+    """Yield the JSON documents of the lines (the empty lines are skipped).
+
+    ValueError is raised by an invalid line.
+
+    """
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_rows(lines, sep=None, header=True):
+    """Yield the rows of a table (ps, df...).
+
+    :sep: the field separator (None: runs of spaces, like str.split()).
+    :header: True: the first line contains the names of the columns. The
+             rows are dicts and the last column gets the rest of the line
+             (the COMMAND of 'ps' can contain spaces). False: the rows are
+             lists of fields.
+
+    The lines can be bytes (encoding=None): a str 'sep' is encoded.
+
+    """
+    names = None
+    for line in lines:
+        if sep is None and not line.strip():
+            continue
+
+        line_sep = _literal(sep, line)
+        if not header:
+            yield line.split(line_sep)
+            continue
+
+        if names is None:
+            names = line.split(line_sep)
+            continue
+
+        fields = line.split(line_sep, len(names) - 1)
+        fields += [None] * (len(names) - len(fields))
+        yield dict(zip(names, fields))
+
+
+def parse_columns(lines, sep=None, header=True):
+    """Return the columns of a table (see iter_rows()).
+
+    header=True: {name: [values]}. header=False: a list of columns (the
+    missing fields of the short rows are None).
+
+    """
+    if header:
+        columns = None
+        for row in iter_rows(lines, sep=sep, header=True):
+            if columns is None:
+                columns = {name: [] for name in row}
+            for name, value in row.items():
+                columns[name].append(value)
+        return columns or {}
+
+    columns = []
+    for num, row in enumerate(iter_rows(lines, sep=sep, header=False)):
+        for _ in range(len(columns), len(row)):
+            columns.append([None] * num)
+        for index, column in enumerate(columns):
+            column.append(row[index] if index < len(row) else None)
+    return columns
+
+
+def iter_kv(lines, sep='='):
+    """Yield the (key, value) of the lines 'key=value'.
+
+    The spaces around the key and the value are removed, and the quotes
+    around the value too (/etc/os-release). The comments (#) and the lines
+    without 'sep' are skipped. The lines can be bytes (encoding=None).
+
+    """
+    for line in lines:
+        key, found, value = line.partition(_literal(sep, line))
+        key = key.strip()
+        if not found or not key or key.startswith(_literal('#', line)):
+            continue
+
+        value = value.strip()
+        quote = value[:1]
+        if len(value) >= 2 and value[-1:] == quote and \
+                quote in (_literal('"', line), _literal("'", line)):
+            value = value[1:-1]
+        yield key, value
+
+
+def parse_kv(lines, sep='='):
+    """Return the dict of the lines 'key=value' (see iter_kv())."""
+    return dict(iter_kv(lines, sep=sep))
+
+
+def main():
+    """Test the parsers."""
+    import unittest
+
+    class TestCmdParse(unittest.TestCase):
+        """Testing the parsers."""
+
+        def test_jsonl(self):
+            """Test: iter_jsonl()."""
+            self.assertEqual(list(iter_jsonl(['{"a": 1}', '', '[2]'])),
+                             [{'a': 1}, [2]])
+            with self.assertRaises(ValueError):
+                list(iter_jsonl(['{']))
+
+        def test_columns(self):
+            """Test: iter_rows() and parse_columns()."""
+            lines = ['  PID TTY          TIME CMD',
+                     '    1 ?        00:00:01 init --x',
+                     '   20 pts/0    00:00:00 bash',
+                     '']
+            self.assertEqual(list(iter_rows(lines))[0],
+                             {'PID': '1', 'TTY': '?', 'TIME': '00:00:01',
+                              'CMD': 'init --x'})
+            self.assertEqual(parse_columns(lines),
+                             {'PID': ['1', '20'], 'TTY': ['?', 'pts/0'],
+                              'TIME': ['00:00:01', '00:00:00'],
+                              'CMD': ['init --x', 'bash']})
+            self.assertEqual(parse_columns(['a:b:c', 'd'], sep=':',
+                                           header=False),
+                             [['a', 'd'], ['b', None], ['c', None]])
+            self.assertEqual(parse_columns(['a', 'b c'], header=False),
+                             [['a', 'b'], [None, 'c']])
+            self.assertEqual(parse_columns(['A B', '1']),
+                             {'A': ['1'], 'B': [None]})
+            self.assertEqual(parse_columns([]), {})
+
+            # the lines are bytes (encoding=None)
+            self.assertEqual(parse_columns([b'A:B', b'1:2'], sep=':'),
+                             {b'A': [b'1'], b'B': [b'2']})
+            self.assertEqual(parse_columns([b'A B', b'1 2 3']),
+                             {b'A': [b'1'], b'B': [b'2 3']})
+
+        def test_kv(self):
+            """Test: parse_kv()."""
+            lines = ['# comment', 'NAME="Debian GNU/Linux"', 'ID=debian',
+                     'EMPTY=', 'garbage', " QUOTE = 'x=1' "]
+            self.assertEqual(parse_kv(lines),
+                             {'NAME': 'Debian GNU/Linux', 'ID': 'debian',
+                              'EMPTY': '', 'QUOTE': 'x=1'})
+            self.assertEqual(parse_kv(['CPU(s):   4'], sep=':'),
+                             {'CPU(s)': '4'})
+
+            # the lines are bytes (encoding=None)
+            self.assertEqual(parse_kv([line.encode() for line in lines]),
+                             {b'NAME': b'Debian GNU/Linux', b'ID': b'debian',
+                              b'EMPTY': b'', b'QUOTE': b'x=1'})
+            self.assertEqual(parse_kv([b'CPU(s):   4'], sep=':'),
+                             {b'CPU(s)': b'4'})
+            self.assertEqual(parse_kv([b'A-"1"'], sep=b'-'), {b'A': b'1'})
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdParse)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
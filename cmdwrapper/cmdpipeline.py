@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Run processes connected with OS pipes (cmd1 | cmd2 | cmd3)."""
+
+import sys
+import logging
+from time import monotonic
+from subprocess import TimeoutExpired
+from cmdwrapper.cmdproc import CmdProc, CmdProcError, PIPE
+from cmdwrapper.cmdstats import CmdStats
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class _CmdPipelineProcess(object):
+    """The processes of a pipeline seen as one Popen() object."""
+
+    def __init__(self, popens):
+        """Store the Popen() of the stages."""
+        self._popens = popens
+
+    @property
+    def returncode(self):
+        """Return the last non-zero returncode of the stages, or 0.
+
+        Same as 'set -o pipefail' in bash. None is returned if one of the
+        processes is running.
+
+        """
+        returncodes = [popen.returncode for popen in self._popens]
+        if None in returncodes:
+            return None
+
+        for returncode in reversed(returncodes):
+            if returncode != 0:
+                return returncode
+
+        return 0
+
+    def poll(self):
+        """Check if all the processes are terminated."""
+        for popen in self._popens:
+            popen.poll()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait until all the processes are terminated."""
+        deadline = None if timeout is None else monotonic() + timeout
+        for popen in self._popens:
+            remaining = None if deadline is None \
+                else max(0, deadline - monotonic())
+            popen.wait(timeout=remaining)
+        return self.returncode
+
+    def kill(self):
+        """Kill the processes that are running."""
+        for popen in self._popens:
+            if popen.returncode is None:
+                popen.kill()
+
+
+class CmdPipelineProc(CmdProc):
+    """Run CmdProc stages connected with OS pipes (like a shell pipeline).
+
+    The stdout of each stage is connected to the stdin of the next one by
+    the kernel: the data never goes through Python. Only the stdout of the
+    last stage and the stderr of all the stages are read.
+
+    The returncode is the one of the last stage that failed (like 'set -o
+    pipefail' in bash) and CmdProcError is raised if it is != 0.
+
+    """
+
+    def __init__(self, stages, timeout=None):
+        """Init the pipeline.
+
+        :stages: a list of CmdProc (not running). Their timeout is ignored.
+        :timeout: the timeout of the whole pipeline.
+
+        The capture policies of the pipeline are the ones of the last stage.
+
+        """
+        assert isinstance(stages, list) and stages
+        cmd_list = []
+        for stage in stages:
+            assert isinstance(stage, CmdProc)
+            # pylint: disable=protected-access
+            cmd_list += (['|'] if cmd_list else []) + list(stage._cmd_list)
+
+        # pylint: disable=protected-access
+        super().__init__(cmd=cmd_list,
+                         stdout=stages[-1]._opts['stdout'],
+                         stderr=stages[-1]._opts['stderr'],
+                         input=stages[0]._opts['input'],
+                         timeout=timeout,
+                         stdout_capture=stages[-1]._opts['stdout_capture'],
+                         stderr_capture=stages[-1]._opts['stderr_capture'],
+                         encoding=stages[-1].encoding,
+                         errors=stages[-1].errors)
+        self._stages = stages
+
+    @property
+    def stages(self):
+        """Return the CmdProc of the stages."""
+        return list(self._stages)
+
+    @property
+    def returncodes(self):
+        """Return the returncode of each stage."""
+        return [stage.returncode for stage in self._stages]
+
+    def run(self):
+        """Run the stages connected with pipes."""
+        # Avoid running the process 2 times
+        if self._proc is not None:
+            return False
+
+        logging.debug('[RUN-PIPELINE] %s', self._cmd_str)
+
+        # pylint: disable=protected-access
+        self._start_time = monotonic()
+        previous = None
+        try:
+            for stage in self._stages:
+                if stage is not self._stages[-1]:
+                    stage._opts['stdout'] = PIPE
+
+                if previous is not None:
+                    stage._opts['input'] = previous._proc.stdout
+
+                # the pipeline's timeout kills the process groups
+                stage._new_session = self._new_session
+                stage.run()
+
+                # the pipe belongs to the two processes now
+                if previous is not None:
+                    previous._proc.stdout.close()
+                    previous._proc.stdout = None
+
+                previous = stage
+        except Exception:
+            for stage in self._stages:
+                if stage.kill():
+                    stage._proc.wait()
+            raise
+
+        self._proc = _CmdPipelineProcess([stage._proc
+                                          for stage in self._stages])
+        self._spawn_time = monotonic() - self._start_time
+
+        if self._opts['timeout'] is not None:
+            self._deadline = monotonic() + self._opts['timeout']
+
+        return True
+
+    def _io_fileobjs(self):
+        """Return the (fileobj, selector event) of the pipes still open."""
+        fileobjs = []
+        for stage in self._stages:
+            # pylint: disable=protected-access
+            fileobjs += stage._io_fileobjs()
+        return fileobjs
+
+    def _io_event(self, fileobj):
+        """Handle a pipe that is ready: its stage reads or writes it."""
+        for stage in self._stages:
+            # pylint: disable=protected-access
+            if fileobj in (stage._proc.stdin, stage._proc.stdout,
+                           stage._proc.stderr):
+                return stage._io_event(fileobj)
+
+        raise ValueError('unknown fileobj: {}'.format(fileobj))
+
+    def _poll_exit(self):
+        """Return the returncode if all the stages exited (or None)."""
+        for stage in self._stages:
+            # pylint: disable=protected-access
+            stage._poll_exit()
+        return self._proc.returncode
+
+    def _wait_exit(self, timeout=None):
+        """Wait until all the stages exit (raise TimeoutExpired)."""
+        deadline = None if timeout is None else monotonic() + timeout
+        for stage in self._stages:
+            remaining = None if deadline is None \
+                else max(0, deadline - monotonic())
+            # pylint: disable=protected-access
+            stage._wait_exit(timeout=remaining)
+
+    def _signal(self, signum):
+        """Send a signal to each stage (to its group if it has its own)."""
+        for stage in self._stages:
+            # pylint: disable=protected-access
+            stage._signal(signum)
+
+    def _close_pipes(self):
+        """Close the pipes of the stages."""
+        for stage in self._stages:
+            # pylint: disable=protected-access
+            stage._close_pipes()
+
+    def _make_stats(self):
+        """Return the stats of the stages combined (see CmdStats)."""
+        if self._start_time is None:
+            return None
+
+        return CmdStats.combine([stage.stats for stage in self._stages],
+                                spawn_time=self._spawn_time,
+                                wall_time=monotonic() - self._start_time)
+
+    def _finish(self):
+        """Store the output/returncode of each stage (pipefail)."""
+        for stage in self._stages:
+            try:
+                # pylint: disable=protected-access
+                stage._finish()
+            except CmdProcError:
+                pass
+
+        self._stderr_buffer = self._open_capture('stderr_capture')
+        for stage in self._stages:
+            self._stderr_buffer.write(stage.stderr)
+        super()._finish()
+
+    def _timeout_killed(self):
+        """Raise CmdProcTimeout with the stderr of the stages."""
+        self._stderr_buffer = self._open_capture('stderr_capture')
+        for stage in self._stages:
+            # pylint: disable=protected-access
+            self._stderr_buffer.write(stage._stderr_buffer.getvalue())
+        super()._timeout_killed()
+
+
+def main():
+    """Test the class CmdPipelineProc."""
+    import unittest
+    from cmdwrapper.cmdcapture import CmdCaptureFilter
+
+    class TestCmdPipelineProc(unittest.TestCase):
+        """Testing the class CmdPipelineProc."""
+
+        def test_cmdpipelineproc(self):
+            """Test: CmdPipelineProc()."""
+            pipeline = CmdPipelineProc([CmdProc('seq 1 100000'),
+                                        CmdProc('grep -v 0'),
+                                        CmdProc('wc -l')])
+            pipeline.wait()
+            self.assertEqual(pipeline.stdout, b'66429\n')
+            self.assertEqual(pipeline.returncodes, [0, 0, 0])
+            self.assertEqual(pipeline.returncode, 0)
+            self.assertEqual(pipeline.stages[0].stdout, b'')
+
+            pipeline = CmdPipelineProc([CmdProc('cat', input=b'hiworld'),
+                                        CmdProc('tr a-z A-Z')], timeout=5)
+            self.assertEqual(list(pipeline.iter_lines()), [b'HIWORLD'])
+
+            pipeline = CmdPipelineProc([
+                CmdProc(['bash', '-c', 'echo ERR1 >&2; exit 3']),
+                CmdProc(['bash', '-c', 'cat; echo ERR2 >&2'])])
+            with self.assertRaises(CmdProcError):
+                pipeline.wait()
+            self.assertEqual(pipeline.returncodes, [3, 0])
+            self.assertEqual(pipeline.returncode, 3)
+            self.assertIn(b'ERR1\n', pipeline.stderr)
+            self.assertIn(b'ERR2\n', pipeline.stderr)
+
+            # the capture policy of the last stage stops all the stages
+            pipeline = CmdPipelineProc([
+                CmdProc(['seq', '1', '1000000000']),
+                CmdProc(['cat'], stdout_capture=CmdCaptureFilter(
+                    until=b'^100000$'))])
+            pipeline.wait()
+            self.assertEqual(pipeline.stdout.count(b'\n'), 100000)
+            self.assertTrue(pipeline.stopped_early)
+
+            pipeline = CmdPipelineProc([CmdProc('sleep 10'), CmdProc('cat')],
+                                       timeout=1)
+            with self.assertRaises(TimeoutExpired):
+                pipeline.wait()
+            pipeline.kill()
+
+            pipeline = CmdPipelineProc([CmdProc('true'),
+                                        CmdProc('/xxx/rrr/cmdpipeline')])
+            with self.assertRaises(OSError):
+                pipeline.run()
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdPipelineProc)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Wait for many processes at the same time from one selector."""
+
+import sys
+import os
+import heapq
+import signal
+import selectors
+from time import monotonic
+from subprocess import TimeoutExpired
+from cmdwrapper.cmdproc import CmdProc, CmdProcError, CmdProcTimeout
+from cmdwrapper.cmdspawn import pidfd_open
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class CmdReactor(object):
+    """Drive the I/O of many CmdProc from one thread and one selector.
+
+    The pipes of the processes and their pidfd (os.pidfd_open(), Linux >=
+    5.3) are watched by the same selector (epoll) and the timeouts are kept
+    in a heap: one thread can supervise thousands of processes.
+
+    The reactor never blocks: when a timeout expires (or when the capture
+    policy stops the process early), SIGTERM is sent and the deadline of
+    the SIGKILL (kill_grace) is added to the heap. The CmdProcTimeout is
+    returned when the process is reaped.
+
+    >>> reactor = CmdReactor()
+    >>> for running in runnings:
+    ...     reactor.register(running)
+    >>> reactor.wait()   # the CmdRunning are completed
+
+    """
+
+    # How often the processes without pidfd are polled (seconds)
+    POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        """Init the reactor."""
+        self._selector = selectors.DefaultSelector()
+        self._procs = {}        # cmd_proc -> pidfd (or None)
+        self._deadlines = []    # heap of (deadline, number, cmd_proc)
+        self._count = 0
+        self._check = {}        # the processes that may be completed
+        self._polled = set()    # the processes polled every POLL_INTERVAL
+        self._killing = {}      # cmd_proc -> deadline of its SIGKILL
+
+    def __len__(self):
+        """Return the number of processes that are not completed."""
+        return len(self._procs)
+
+    @property
+    def procs(self):
+        """Return the processes that are not completed."""
+        return list(self._procs)
+
+    def register(self, cmd_proc):
+        """Run cmd_proc (if it is not running) and watch it.
+
+        cmd_proc can also be a CmdRunning (the CmdProc is cmd_proc.proc).
+
+        """
+        cmd_proc = getattr(cmd_proc, 'proc', cmd_proc)
+        assert isinstance(cmd_proc, CmdProc)
+        cmd_proc.run()
+
+        # pylint: disable=protected-access
+        for fileobj, events in cmd_proc._io_fileobjs():
+            self._selector.register(fileobj, events, (cmd_proc, False))
+
+        pidfd = pidfd_open(getattr(cmd_proc._proc, 'pid', None))
+        if pidfd is None:
+            self._polled.add(cmd_proc)
+        else:
+            self._selector.register(pidfd, selectors.EVENT_READ,
+                                    (cmd_proc, True))
+        self._procs[cmd_proc] = pidfd
+
+        if cmd_proc._deadline is not None:
+            self._count += 1
+            heapq.heappush(self._deadlines,
+                           (cmd_proc._deadline, self._count, cmd_proc))
+
+        self._check[cmd_proc] = None
+
+    def poll(self, timeout=None):
+        """Wait until at least one process is completed (or 'timeout').
+
+        Return a list of (cmd_proc, error). error is None, CmdProcError
+        (returncode != 0) or CmdProcTimeout (the process was killed).
+
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while self._procs:
+            self._expire()
+            completed = self._completed()
+            if completed:
+                return completed
+
+            wait = self._next_timeout(deadline)
+            if wait == 0 and deadline is not None and monotonic() >= deadline:
+                break
+
+            stopped = []
+            for key, _ in self._selector.select(wait):
+                cmd_proc, is_pidfd = key.data
+                self._check[cmd_proc] = None
+                if is_pidfd:
+                    # the process exited
+                    self._close_pidfd(cmd_proc)
+                    continue
+
+                # pylint: disable=protected-access
+                data, eof = cmd_proc._io_event(key.fileobj)
+                if eof:
+                    self._selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                if data:
+                    cmd_proc._stdout_buffer.write(data)
+                    if getattr(cmd_proc._stdout_buffer, 'done', False):
+                        stopped.append(cmd_proc)
+
+            # the capture policy does not need the rest of the output
+            for cmd_proc in set(stopped):
+                self._stop(cmd_proc)
+
+        return []
+
+    def wait(self, timeout=None):
+        """Wait until all the processes are completed (or 'timeout').
+
+        Return the list of (cmd_proc, error) (see poll()).
+
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        completed = []
+        while self._procs:
+            remaining = None if deadline is None \
+                else max(0, deadline - monotonic())
+            result = self.poll(remaining)
+            if not result and remaining == 0:
+                break
+            completed.extend(result)
+        return completed
+
+    def close(self):
+        """Kill the processes that are not completed and close the pipes."""
+        for cmd_proc in list(self._procs):
+            cmd_proc.kill()
+            self._unregister(cmd_proc, close=True)
+            # pylint: disable=protected-access
+            cmd_proc._proc.wait()
+
+        self._procs = {}
+        self._deadlines = []
+        self._check = {}
+        self._polled = set()
+        self._killing = {}
+        self._selector.close()
+
+    def _unregister(self, cmd_proc, close=False):
+        """Stop watching the pipes and the pidfd of cmd_proc."""
+        self._close_pidfd(cmd_proc)
+        self._unregister_pipes(cmd_proc, close)
+
+    def _unregister_pipes(self, cmd_proc, close):
+        """Stop watching the pipes of cmd_proc (close them if 'close')."""
+        # pylint: disable=protected-access
+        for fileobj, _ in cmd_proc._io_fileobjs():
+            self._selector.unregister(fileobj)
+            if close:
+                fileobj.close()
+
+    def _close_pidfd(self, cmd_proc):
+        """Stop watching the pidfd of cmd_proc."""
+        pidfd = self._procs.get(cmd_proc)
+        if pidfd is not None:
+            self._selector.unregister(pidfd)
+            os.close(pidfd)
+            self._procs[cmd_proc] = None
+
+    def _expire(self):
+        """Signal the processes whose timeout (or kill_grace) expired."""
+        now = monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, _, cmd_proc = heapq.heappop(self._deadlines)
+            if cmd_proc not in self._procs:
+                continue
+
+            # pylint: disable=protected-access
+            self._check[cmd_proc] = None
+            if cmd_proc in self._killing:
+                # kill_grace expired (the timeout of a process stopped early
+                # is ignored): the pidfd reports the exit
+                if deadline >= self._killing[cmd_proc]:
+                    cmd_proc._signal(signal.SIGKILL)
+                continue
+
+            cmd_proc._emit('on_timeout', timeout=cmd_proc._opts['timeout'])
+            self._kill(cmd_proc)
+
+    def _stop(self, cmd_proc):
+        """Stop a process whose output is not needed (CmdProc._stop_early).
+
+        The pipes are closed (the writers get EPIPE/SIGPIPE, like 'cmd |
+        head') and the process is killed without waiting (see _kill()).
+
+        """
+        cmd_proc.stopped_early = True
+        self._unregister_pipes(cmd_proc, close=True)
+        self._check[cmd_proc] = None
+        self._kill(cmd_proc)
+
+    def _kill(self, cmd_proc):
+        """Send SIGTERM now, SIGKILL after kill_grace (CmdProc._terminate)."""
+        # pylint: disable=protected-access
+        cmd_proc._deadline = None
+        cmd_proc._signal(signal.SIGTERM)
+        deadline = monotonic() + cmd_proc._opts['kill_grace']
+        self._killing[cmd_proc] = deadline
+        self._count += 1
+        heapq.heappush(self._deadlines, (deadline, self._count, cmd_proc))
+
+    def _completed(self):
+        """Return the (cmd_proc, error) of the completed processes."""
+        completed = []
+        for cmd_proc in self._check:
+            # pylint: disable=protected-access
+            if cmd_proc._poll_exit() is None:
+                if self._procs[cmd_proc] is None:
+                    # no pidfd or the status is not ready yet (CmdLauncher)
+                    self._polled.add(cmd_proc)
+                continue
+
+            if cmd_proc in self._killing:
+                # the processes of the group that ignored SIGTERM (they can
+                # keep the pipes open)
+                cmd_proc._signal(signal.SIGKILL)
+                self._unregister(cmd_proc, close=True)
+            elif cmd_proc._io_fileobjs():
+                continue
+
+            self._close_pidfd(cmd_proc)
+            self._polled.discard(cmd_proc)
+            del self._procs[cmd_proc]
+            error = None
+            try:
+                killed = self._killing.pop(cmd_proc, None) is not None
+                if killed and not cmd_proc.stopped_early:
+                    cmd_proc._timeout_killed()
+                else:
+                    cmd_proc._finish()
+            except CmdProcError as err:
+                error = err
+            completed.append((cmd_proc, error))
+
+        self._check = dict.fromkeys(self._polled)
+        return completed
+
+    def _next_timeout(self, deadline):
+        """Return how long the selector can wait (None = forever)."""
+        timeouts = [] if deadline is None else [deadline - monotonic()]
+        if self._deadlines:
+            timeouts.append(self._deadlines[0][0] - monotonic())
+
+        if self._polled:
+            timeouts.append(self.POLL_INTERVAL)
+
+        if not timeouts:
+            return None
+        return max(0, min(timeouts))
+
+
+# The old name of CmdReactor
+CmdPoller = CmdReactor
+
+
+def run_many(cmd_procs, max_workers=8, ordered=True, fail_fast=True):
+    """Run the CmdProc of an iterable, at most 'max_workers' at a time.
+
+    Yield the completed CmdProc: in the order of 'cmd_procs' (ordered=True)
+    or as soon as they are completed (ordered=False).
+
+    :fail_fast: True: the first error (CmdProcError or TimeoutExpired) kills
+                the other processes and is raised. False: the processes that
+                failed are yielded like the others (a process that timed out
+                is killed).
+
+    """
+    assert isinstance(max_workers, int) and max_workers > 0
+
+    poller = CmdReactor()
+    cmd_procs = iter(cmd_procs)
+    indexes = {}
+    done = {}
+    next_index = 0
+    count = 0
+    try:
+        while True:
+            # start the new processes
+            while len(poller) < max_workers:
+                cmd_proc = next(cmd_procs, None)
+                if cmd_proc is None:
+                    break
+                indexes[cmd_proc] = count
+                count += 1
+                poller.register(cmd_proc)
+
+            if not poller:
+                break
+
+            for cmd_proc, error in poller.poll():
+                if error is not None and fail_fast:
+                    raise error
+
+                index = indexes.pop(cmd_proc)
+                if not ordered:
+                    yield cmd_proc
+                    continue
+
+                done[index] = cmd_proc
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+    finally:
+        poller.close()
+
+
+def main():
+    """Test the class CmdReactor."""
+    import unittest
+    from cmdwrapper.cmdpipeline import CmdPipelineProc
+
+    class TestCmdReactor(unittest.TestCase):
+        """Testing the class CmdReactor."""
+
+        def test_cmdreactor(self):
+            """Test: CmdReactor()."""
+            poller = CmdReactor()
+            fast = CmdProc(['bash', '-c', 'echo FAST'])
+            slow = CmdProc(['bash', '-c', 'sleep 1; echo SLOW; exit 4'])
+            silent = CmdProc(['sleep', '0.5'], stdout=None, stderr=None)
+            for cmd_proc in (slow, fast, silent):
+                poller.register(cmd_proc)
+            self.assertEqual(len(poller), 3)
+
+            completed = []
+            while poller:
+                completed.extend(poller.poll())
+
+            self.assertEqual([proc for proc, _ in completed],
+                             [fast, silent, slow])
+            self.assertEqual(fast.stdout, b'FAST\n')
+            self.assertIsNone(completed[0][1])
+            self.assertIsInstance(completed[2][1], CmdProcError)
+            self.assertEqual(slow.returncode, 4)
+            self.assertEqual(poller.poll(), [])
+
+            poller.register(CmdProc(['sleep', '5']))
+            self.assertEqual(poller.poll(timeout=0.1), [])
+            poller.close()
+
+        def test_many(self):
+            """Test: many processes, timeouts and processes without pid."""
+            reactor = CmdReactor()
+            procs = [CmdProc(['sleep', '1']) for _ in range(300)]
+            timeouts = [CmdProc(['sleep', '10'], timeout=timeout)
+                        for timeout in (2, 1)]
+            pipeline = CmdPipelineProc([CmdProc('seq 1 1000'),
+                                        CmdProc('wc -l')])
+            start = monotonic()
+            for cmd_proc in procs + timeouts + [pipeline]:
+                reactor.register(cmd_proc)
+
+            completed = reactor.wait()
+            self.assertLess(monotonic() - start, 8)
+            self.assertEqual(len(completed), 303)
+            self.assertEqual(len(reactor), 0)
+            self.assertEqual(pipeline.stdout, b'1000\n')
+            self.assertEqual([proc for proc, error in completed
+                              if isinstance(error, TimeoutExpired)],
+                             [timeouts[1], timeouts[0]])
+            reactor.close()
+
+            reactor = CmdReactor()
+            reactor.register(CmdProc(['sleep', '5']))
+            self.assertEqual(reactor.wait(timeout=0.1), [])
+            reactor.close()
+
+        def test_kill_grace(self):
+            """Test: the processes that ignore SIGTERM do not block."""
+            reactor = CmdReactor()
+            stubborn = [CmdProc(['bash', '-c', 'trap "" TERM; sleep 10'],
+                                timeout=0.2, kill_grace=2)
+                        for _ in range(4)]
+            fast = CmdProc(['sleep', '0.5'])
+            start = monotonic()
+            for cmd_proc in stubborn + [fast]:
+                reactor.register(cmd_proc)
+
+            times = {}
+            while reactor:
+                for cmd_proc, error in reactor.poll():
+                    times[cmd_proc] = (monotonic() - start, error)
+
+            self.assertLess(times[fast][0], 1.5)
+            self.assertIsNone(times[fast][1])
+            for cmd_proc in stubborn:
+                elapsed, error = times[cmd_proc]
+                self.assertGreater(elapsed, 2)
+                self.assertLess(elapsed, 4)
+                self.assertIsInstance(error, CmdProcTimeout)
+                self.assertEqual(cmd_proc.returncode, -signal.SIGKILL)
+            reactor.close()
+
+        def test_filter(self):
+            """Test: the capture policy stops the process."""
+            from cmdwrapper.cmdcapture import CmdCaptureFilter
+            reactor = CmdReactor()
+            procs = [CmdProc(['seq', '1', '1000000000'],
+                             stdout_capture=CmdCaptureFilter(head=10))
+                     for _ in range(3)]
+            for cmd_proc in procs:
+                reactor.register(cmd_proc)
+            self.assertEqual([error for _, error in reactor.wait(timeout=10)],
+                             [None] * 3)
+            for cmd_proc in procs:
+                self.assertTrue(cmd_proc.stopped_early)
+                self.assertEqual(cmd_proc.stdout.count(b'\n'), 10)
+            reactor.close()
+
+            # stopping a process that ignores SIGTERM does not block (its
+            # timeout expires during kill_grace and is ignored)
+            reactor = CmdReactor()
+            stubborn = CmdProc(['bash', '-c',
+                                'trap "" TERM; echo 1; sleep 10'],
+                               stdout_capture=CmdCaptureFilter(head=1),
+                               timeout=1, kill_grace=2)
+            fast = CmdProc(['sleep', '0.5'])
+            start = monotonic()
+            reactor.register(stubborn)
+            reactor.register(fast)
+            times = {}
+            while reactor:
+                for cmd_proc, error in reactor.poll():
+                    times[cmd_proc] = (monotonic() - start, error)
+
+            self.assertLess(times[fast][0], 1.5)
+            self.assertGreater(times[stubborn][0], 1.5)
+            self.assertIsNone(times[stubborn][1])
+            self.assertTrue(stubborn.stopped_early)
+            self.assertEqual(stubborn.stdout, b'1\n')
+            self.assertEqual(stubborn.returncode, -signal.SIGKILL)
+            reactor.close()
+
+        def test_run_many(self):
+            """Test: run_many()."""
+            def procs(count):
+                """Return 'count' processes."""
+                for num in range(count):
+                    yield CmdProc(['bash', '-c',
+                                   'sleep 0.$((RANDOM % 3)); echo {}'
+                                   .format(num)])
+
+            start = monotonic()
+            stdouts = [proc.stdout for proc in run_many(procs(40),
+                                                        max_workers=40)]
+            self.assertLess(monotonic() - start, 5)
+            self.assertEqual(stdouts,
+                             [str(num).encode() + b'\n' for num in range(40)])
+
+            stdouts = [proc.stdout for proc in run_many(procs(10),
+                                                        max_workers=3,
+                                                        ordered=False)]
+            self.assertEqual(len(stdouts), 10)
+
+            failing = [CmdProc('true'), CmdProc('false'), CmdProc('true'),
+                       CmdProc('sleep 10', timeout=1)]
+            with self.assertRaises(CmdProcError):
+                list(run_many(failing))
+
+            failing = [CmdProc('false'), CmdProc('sleep 10', timeout=1),
+                       CmdProc('true')]
+            returncodes = [proc.returncode
+                           for proc in run_many(failing, fail_fast=False)]
+            self.assertEqual(returncodes, [1, -signal.SIGTERM, 0])
+
+            with self.assertRaises(TimeoutExpired):
+                list(run_many([CmdProc('sleep 10', timeout=1)]))
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdReactor)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -10,24 +10,160 @@
 #
 """Run a process."""
 
+import io
+import codecs
 import sys
 import os
 import shlex
+import signal
 import logging
+import select
+import selectors
 import subprocess
+from time import monotonic, sleep
 from subprocess import TimeoutExpired
+from cmdwrapper.cmdcapture import CmdCapture, CmdCaptureText, CmdRedirect
+from cmdwrapper.cmdoutput import find_encoding
+from cmdwrapper.cmdenv import CmdEnv
+from cmdwrapper.cmdwhich import which
+from cmdwrapper.cmdstats import CmdStats, read_proc_io
+from cmdwrapper.cmdspawn import CmdSpawnProcess, SPAWN_BACKENDS, \
+    can_posix_spawn, pidfd_open
 
-assert sys.version_info >= (3, 3), "The Python version need to be >= 3.3"
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
 
 # Used by CmdRunning in the constructor arguments stdout/stderr
 PIPE = subprocess.PIPE
 DEVNULL = subprocess.DEVNULL
 STDOUT = subprocess.STDOUT
 
+# The maximum size of a chunk read from stdout/stderr
+CHUNK_SIZE = 65536
+
+# The maximum size of stdout and stderr in the exception messages
+ERROR_OUTPUT_MAX = 4096
+
+# The seconds between SIGTERM and SIGKILL when a timeout expires
+KILL_GRACE = 2
+
+# The inputs written to stdin at once (converted to bytes, not iterated)
+BYTES_LIKE = (bytes, bytearray, memoryview)
+
+
+def split_chunk(pending, chunk):
+    """Split the lines completed by 'chunk'.
+
+    'pending' is the list of the pieces of the incomplete last line: it is
+    updated in place and the pieces are only joined once the line is
+    complete, so a long line split in many chunks is not copied again for
+    each chunk.  Return the complete lines without their line endings.
+
+    """
+    # The last piece ends with '\r', which may be followed by '\n'
+    after_cr = pending and pending[-1].endswith(b'\r')
+    if not after_cr and b'\n' not in chunk and b'\r' not in chunk:
+        if chunk:
+            pending.append(chunk)
+        return []
+
+    pending.append(chunk)
+    lines = b''.join(pending).splitlines(True)
+    del pending[:]
+
+    # The last line is not complete (or it ends with '\r', which may be
+    # followed by '\n' in the next chunk)
+    if lines and not lines[-1].endswith(b'\n'):
+        pending.append(lines.pop())
+
+    return [line.rstrip(b'\r\n') for line in lines]
+
+
+def join_pending(pending):
+    """Return the last line left in 'pending' by split_chunk()."""
+    return b''.join(pending).rstrip(b'\r\n')
+
+
+def _is_output(value):
+    """Return True if 'value' is a valid stdout/stderr."""
+    if value in (PIPE, DEVNULL, STDOUT, None):
+        return True
+    if isinstance(value, int):
+        return value >= 0   # a file descriptor
+    return isinstance(value, (str, os.PathLike, CmdRedirect)) or \
+        hasattr(value, 'fileno')
+
+
+def _is_encoding(value):
+    """Return True if 'value' is an encoding (see find_encoding())."""
+    try:
+        find_encoding(value)
+    except (LookupError, TypeError):
+        return False
+    return True
+
+
+def _is_errors(value):
+    """Return True if 'value' is a codec error handler ('ignore'...)."""
+    try:
+        codecs.lookup_error(value)
+    except (LookupError, TypeError):
+        return False
+    return True
+
+
+# The CmdProc options and how they are checked (see CmdProc.check_options())
+_OPTION_CHECKS = {
+    'cwd': lambda value: isinstance(value, (str, type(None))),
+    'env': lambda value: isinstance(value, (dict, CmdEnv, type(None))),
+    'stdout': lambda value: _is_output(value),
+    'stderr': lambda value: _is_output(value),
+    'input': lambda value: isinstance(value, BYTES_LIKE + (
+        int, str, os.PathLike, type(None)))
+    or hasattr(value, '__iter__') or hasattr(value, 'fileno'),
+    'timeout': lambda value: value is None or
+    (isinstance(value, (int, float)) and value >= 0),
+    'kill_grace': lambda value: isinstance(value, (int, float)) and
+    value >= 0,
+    'stdout_capture': lambda value: isinstance(value,
+                                               (CmdCapture, type(None))),
+    'stderr_capture': lambda value: isinstance(value,
+                                               (CmdCapture, type(None))),
+    'spawn': lambda value: value in SPAWN_BACKENDS or hasattr(value,
+                                                              'launch'),
+    'collector': lambda value: value is None or hasattr(value, 'add'),
+    'hooks': lambda value: value is None or hasattr(value, 'emit'),
+    'encoding': _is_encoding,
+    'errors': _is_errors,
+}
+
+
+class _CmdCompletedProcess(object):
+    """A process that is already terminated (see CmdProc.completed())."""
+
+    def __init__(self, returncode):
+        """Store the returncode."""
+        self.returncode = returncode
+        self.stdin = self.stdout = self.stderr = None
+
+    def poll(self):
+        """Return the returncode."""
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Return the returncode."""
+        # pylint: disable=unused-argument
+        return self.returncode
+
+    def kill(self):
+        """Nothing to kill."""
+
 
 class CmdProcError(Exception):
     """Exception raised when a process fails (returncode != 0)."""
 
+    # the number of times the command ran (see cmdwrapper.cmdretry)
+    attempts = 1
+
     def __init__(self, error_msg, cmd_proc=None):
         """Store the cmd_proc (which contains stdout, stderr, returncode).
 
@@ -43,6 +179,38 @@ class CmdProcError(Exception):
         self._cmd_proc = cmd_proc
         super().__init__(self._error_msg)
 
+    @property
+    def cmd_proc(self):
+        """Return the CmdProc that failed (None if it is unknown)."""
+        return self._cmd_proc
+
+
+class CmdProcTimeout(CmdProcError, TimeoutExpired):
+    """Exception raised when a process is killed by its timeout.
+
+    It is also a TimeoutExpired: 'output' and 'stderr' contain what the
+    process wrote before it was killed.
+
+    """
+
+    def __init__(self, error_msg, cmd_proc):
+        """Store the cmd_proc and its partial output."""
+        # pylint: disable=super-init-not-called,non-parent-init-called
+        assert isinstance(error_msg, str)
+        assert isinstance(cmd_proc, CmdProc)
+        # pylint: disable=protected-access
+        TimeoutExpired.__init__(self, cmd_proc._cmd_list,
+                                cmd_proc._opts['timeout'],
+                                output=cmd_proc.stdout,
+                                stderr=cmd_proc.stderr)
+        self._error_msg = error_msg
+        self._cmd_proc = cmd_proc
+        self.args = (error_msg,)
+
+    def __str__(self):
+        """Return the error message."""
+        return self._error_msg
+
 
 class CmdProc(object):
     """Low level process management (run process, wait until completed...)."""
@@ -50,7 +218,10 @@ class CmdProc(object):
     # pylint: disable=redefined-builtin
     # pylint: disable=too-many-arguments
     def __init__(self, cmd, cwd=None, env=None, stdout=PIPE, stderr=PIPE,
-                 input=None, timeout=None):
+                 input=None, timeout=None, stdout_capture=None,
+                 stderr_capture=None, spawn='popen', collector=None,
+                 hooks=None, kill_grace=KILL_GRACE, encoding='utf-8',
+                 errors='ignore', checked=False):
         """Init the process.
 
         :cmd: the command line arguments. Example: ['ls', '/'] or 'ls /'
@@ -58,27 +229,74 @@ class CmdProc(object):
         :cwd: the directory where the command is going to be executed
               (None = current directory)
 
-        :env: rewrite the environment variables (key/value)
+        :env: rewrite the environment variables (key/value). A CmdEnv
+              (os.environ + overrides) is encoded once for all the
+              processes.
 
         :stdout: could contain PIPE, DEVNULL and STDOUT. Behaves exactly like
-                 Popen's argument stdout.
+                 Popen's argument stdout. It can also be a file where the
+                 process writes directly (nothing is captured): a file
+                 descriptor (int), an open file, a path (truncated) or a
+                 CmdRedirect (append mode). See also CmdCaptureTee.
 
         :stderr: could contain PIPE, DEVNULL and STDOUT. Behaves exactly like
-                 Popen's argument stderr.
-
-        :input: the input content. Equivalent to 'input' in Popen.communicate.
+                 Popen's argument stderr. Same files as stdout.
+
+        :input: the stdin of the process. It can be:
+                - bytes: written to stdin (like 'input' in Popen.communicate)
+                  A bytearray or a memoryview is converted to bytes.
+                - an open file or a file descriptor (int): used as stdin by
+                  the process directly (no copy)
+                - a path (str or os.PathLike): the file is opened and used
+                  as stdin by the process directly
+                - an iterable of bytes (a generator, for example): the
+                  chunks are written incrementally, when the pipe is ready
 
         :timeout: SIGTERM will be sent to the process after 'timeout' seconds.
         To disable this feature: 'timeout=None'.
+        The process is started in its own session: the signals are sent to
+        its process group (its children are killed too). CmdProcTimeout is
+        raised.
+
+        :kill_grace: the seconds between SIGTERM and SIGKILL when the
+                     timeout expires.
+
+        :stdout_capture: how stdout is kept in memory (CmdCapture policy).
+                         Default: CmdCapture() (everything is kept).
+
+        :stderr_capture: same as stdout_capture, for stderr.
+
+        :spawn: 'popen' (subprocess.Popen) or 'posix_spawn' (faster, see
+                CmdSpawnProcess). Popen is used when posix_spawn cannot
+                handle the options (cwd).
+                It can also be a CmdLauncher (see cmdwrapper.cmdlauncher):
+                the process is started by the launcher process.
+
+        :collector: a CmdStatsCollector. The stats of the process are added
+                    to it when it is completed (see self.stats).
+
+        :hooks: a CmdHooks. Its callbacks are called during the life of the
+                process (see cmdwrapper.cmdhooks).
+
+        :encoding: the encoding of stdout/stderr ('utf-8', 'latin-1',
+                   'locale'...) used by CmdOutput and CmdCaptureText. None:
+                   the lines and the output are bytes.
+
+        :errors: how the invalid bytes are decoded: 'ignore', 'strict',
+                 'replace', 'surrogateescape'...
+
+        :checked: True if the options were already checked with
+                  check_options() (CmdWrapper checks its options once).
 
         """
-        assert isinstance(cmd, (list, str, type(None)))
-        assert isinstance(cwd, (str, type(None)))
-        assert isinstance(env, (dict, type(None)))
-        assert stdout in (PIPE, DEVNULL, STDOUT, None)
-        assert stderr in (PIPE, DEVNULL, STDOUT, None)
-        assert isinstance(input, (bytes, type(None)))
-        assert isinstance(timeout, (int, type(None)))
+        if not checked:
+            self.check_options(cwd=cwd, env=env, stdout=stdout, stderr=stderr,
+                               input=input, timeout=timeout,
+                               stdout_capture=stdout_capture,
+                               stderr_capture=stderr_capture, spawn=spawn,
+                               collector=collector, hooks=hooks,
+                               kill_grace=kill_grace, encoding=encoding,
+                               errors=errors)
 
         self._cmd_list, self._cmd_str = self._cmd_split_types(cmd)
 
@@ -88,14 +306,79 @@ class CmdProc(object):
                       'stdout': stdout,
                       'stderr': stderr,
                       'input': input,
-                      'timeout': timeout}
+                      'timeout': timeout,
+                      'stdout_capture': stdout_capture or CmdCapture(),
+                      'stderr_capture': stderr_capture or CmdCapture(),
+                      'spawn': spawn,
+                      'collector': collector,
+                      'hooks': hooks,
+                      'kill_grace': kill_grace,
+                      'encoding': find_encoding(encoding),
+                      'errors': errors}
 
         self._proc = None
+        self._deadline = None
+        self._done = False
+
+        # a process group that can be killed when the timeout expires
+        self._new_session = timeout is not None
+
+        # the I/O state (kept here to be able to resume an interrupted read)
+        self._input_chunks = None
+        self._input_pending = None
+        self._replay = None
+        self._stdout_buffer = self._open_capture('stdout_capture')
+        self._stderr_buffer = self._open_capture('stderr_capture')
+
+        # how the output is decoded (see CmdOutput)
+        self.encoding = self._opts['encoding']
+        self.errors = self._opts['errors']
 
         self.returncode = None
         self.stdout = b''
         self.stderr = b''
 
+        # the number of bytes dropped by the capture policies
+        self.stdout_skipped = 0
+        self.stderr_skipped = 0
+
+        # True if the capture policy stopped the process (see CmdCapture)
+        self.stopped_early = False
+
+        # the resource usage (see CmdStats), set when it is completed
+        self.stats = None
+        self._start_time = None
+        self._spawn_time = None
+        self._exit_time = None
+        self._rusage = None
+        self._proc_io = None
+
+    @classmethod
+    def completed(cls, cmd, stdout_data, stderr_data, returncode, **kwargs):
+        """Return a CmdProc of a command that already ran (a cached result).
+
+        It behaves like a process that wrote 'stdout_data' and 'stderr_data'
+        and exited with 'returncode': wait(), iter_lines() and CmdProcError
+        work the same way. kwargs are the options of __init__().
+
+        """
+        # pylint: disable=protected-access
+        cmd_proc = cls(cmd, **kwargs)
+        cmd_proc._proc = _CmdCompletedProcess(returncode)
+        cmd_proc._stderr_buffer.write(stderr_data)
+        cmd_proc._replay = stdout_data
+        return cmd_proc
+
+    @staticmethod
+    def check_options(**options):
+        """Check the options of CmdProc.__init__() (except 'cmd')."""
+        for name, value in options.items():
+            assert name in _OPTION_CHECKS, \
+                'unknown CmdProc option: {}'.format(name)
+            assert _OPTION_CHECKS[name](value), \
+                'invalid value for the CmdProc option {}: {!r}' \
+                .format(name, value)
+
     def run(self):
         """Run the command."""
         # Avoid running the process 2 times
@@ -109,70 +392,497 @@ class CmdProc(object):
         logging.debug('[RUN-CMD] %s', self._cmd_str)
 
         # manage the stdin
-        stdin = None
-        if self._opts['input']:
-            stdin = PIPE
+        stdin, stdin_file = self._open_input()
 
         # Run the process
-        self._proc = subprocess.Popen(args=self._cmd_list,
-                                      stdout=self._opts['stdout'],
-                                      stderr=self._opts['stderr'],
-                                      stdin=stdin,
-                                      cwd=self._opts['cwd'],
-                                      env=self._opts['env'])
+        self._emit('before_spawn')
+        self._start_time = monotonic()
+        opened = [stdin_file]
+        try:
+            stdout = self._open_output(self._opts['stdout'], opened)
+            stderr = self._open_output(self._opts['stderr'], opened)
+            self._proc = self._spawn(stdin, stdout, stderr)
+        except OSError as err:
+            self._emit('on_error', error=err)
+            raise
+        finally:
+            for fileobj in opened:
+                if fileobj is not None:
+                    fileobj.close()
+        self._spawn_time = monotonic() - self._start_time
+        self._emit('after_spawn', pid=self._proc.pid,
+                   spawn_time=self._spawn_time)
+
+        if self._proc.stdin is not None:
+            os.set_blocking(self._proc.stdin.fileno(), False)
+
+        if self._opts['timeout'] is not None:
+            self._deadline = monotonic() + self._opts['timeout']
 
         return True
 
+    def _spawn(self, stdin, stdout, stderr):
+        """Start the process with the 'spawn' backend (Popen, posix_spawn)."""
+        kwargs = {'stdout': stdout,
+                  'stderr': stderr,
+                  'stdin': stdin,
+                  'env': self._spawn_env(),
+                  'executable': self._executable()}
+
+        if self._opts['spawn'] not in SPAWN_BACKENDS:
+            # a CmdLauncher (the environment is sent as JSON)
+            if isinstance(self._opts['env'], CmdEnv):
+                kwargs['env'] = self._opts['env'].snapshot()
+            return self._opts['spawn'].launch(self._cmd_list,
+                                              cwd=self._opts['cwd'],
+                                              setsid=self._new_session,
+                                              **kwargs)
+
+        if self._opts['spawn'] == 'posix_spawn' and \
+                can_posix_spawn(cwd=self._opts['cwd']):
+            return CmdSpawnProcess(self._cmd_list, setsid=self._new_session,
+                                   **kwargs)
+
+        return subprocess.Popen(args=self._cmd_list, cwd=self._opts['cwd'],
+                                start_new_session=self._new_session,
+                                **kwargs)
+
+    def _spawn_env(self):
+        """Return the env given to Popen/posix_spawn.
+
+        The bytes of a CmdEnv are given as they are: they were encoded once
+        (Popen and posix_spawn encode the str of a dict on each call). The
+        envp array is still built from the mapping on each launch.
+
+        """
+        env = self._opts['env']
+        if isinstance(env, CmdEnv):
+            return env.encoded()
+        return env
+
+    def _executable(self):
+        """Return the absolute path of the executable (cached, see which()).
+
+        None is returned if it is not found (the error is raised by the
+        spawn).
+
+        """
+        if not self._cmd_list:
+            return None
+        return which(self._cmd_list[0], self._opts['env'])
+
     def wait(self):
         """Wait until the process is terminated."""
-        if self._proc is None:
-            self.run()
-
-        if self._proc.poll() is not None:
+        if self._done:
             # The process is stopped
             return False
 
-        self.returncode = None
-        self.stdout = b''
-        self.stderr = b''
+        self.run()
+
+        chunks = self._communicate()
+        for chunk in chunks:
+            self._stdout_buffer.write(chunk)
+            if getattr(self._stdout_buffer, 'done', False):
+                chunks.close()
+                self._stop_early()
+                break
+
+        self._finish()
+        return True
+
+    def kill(self):
+        """Kill the process (SIGKILL) if it is running."""
+        if self._proc is None or self._done or \
+                self._proc.returncode is not None:
+            return False
+
+        self._signal(signal.SIGKILL)
+        return True
+
+    def iter_chunks(self):
+        """Yield the stdout chunks as soon as the command writes them.
+
+        stderr is read at the same time (the child never blocks on a full
+        pipe) and stored in self.stderr. The yielded chunks are not stored:
+        self.stdout will only contain what was not consumed.
+
+        The timeout is honored and CmdProcError is raised at the end if the
+        returncode != 0.
+
+        """
+        if self._done:
+            return
+
+        self.run()
+
+        for chunk in self._communicate():
+            yield chunk
+
+        self._finish()
+
+    def iter_lines(self):
+        """Yield the stdout lines (bytes, without the line endings).
+
+        Same behavior as iter_chunks().
+
+        """
+        pending = []
+        for chunk in self.iter_chunks():
+            for line in split_chunk(pending, chunk):
+                yield line
+
+        if pending:
+            yield join_pending(pending)
+
+    def _remaining(self):
+        """Return the remaining seconds before the timeout (or None)."""
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - monotonic())
+
+    def _emit(self, event, **info):
+        """Call the hooks of 'event' (if there are hooks)."""
+        if self._opts['hooks'] is not None:
+            self._opts['hooks'].emit(event, self, **info)
+
+    def _timeout_expired(self):
+        """Kill the process, raise CmdProcTimeout with the partial output."""
+        self._emit('on_timeout', timeout=self._opts['timeout'])
+        self._terminate()
+        self._timeout_killed()
+
+    def _timeout_killed(self):
+        """Raise CmdProcTimeout (the process was killed and reaped).
+
+        CmdReactor kills the process without waiting (SIGTERM, SIGKILL
+        after kill_grace) and calls this method when it is reaped.
+
+        """
+        self._store_result()
+        err_msg = 'timeout ({} seconds) expired: {}'.format(
+            self._opts['timeout'], self._cmd_str)
+        error = CmdProcTimeout(self._cmd_error_msg(err_msg), self)
+        self._emit('on_error', error=error)
+        raise error
+
+    def _terminate(self):
+        """Kill the process group: SIGTERM, SIGKILL after kill_grace seconds.
+
+        The process is reaped and its pipes are closed.
+
+        """
+        self._signal(signal.SIGTERM)
         try:
-            self.stdout, self.stderr = \
-                self._proc.communicate(input=self._opts['input'],
-                                       timeout=self._opts['timeout'])
+            self._wait_exit(timeout=self._opts['kill_grace'])
+        except TimeoutExpired:
+            pass
+
+        # also the processes of the group that ignored SIGTERM
+        self._signal(signal.SIGKILL)
+        self._wait_exit()
+        self._close_pipes()
+
+    def _stop_early(self):
+        """Stop the process: the rest of its output is not needed."""
+        self.stopped_early = True
+        # the writers get EPIPE/SIGPIPE, like 'cmd | head'
+        self._close_pipes()
+        self._terminate()
+
+    def _signal(self, signum):
+        """Send a signal to the process (to its group if it has its own)."""
+        try:
+            if self._new_session:
+                os.killpg(self._proc.pid, signum)
+            elif self._proc.returncode is None:
+                self._proc.send_signal(signum)
+        except (ProcessLookupError, PermissionError):
+            pass    # the process (group) does not exist anymore
+
+    def _close_pipes(self):
+        """Close the pipes of the process."""
+        for fileobj in (self._proc.stdin, self._proc.stdout,
+                        self._proc.stderr):
+            if fileobj is not None and not fileobj.closed:
+                fileobj.close()
+
+    def _communicate(self):
+        """Write stdin, read stdout/stderr until EOF. Yield stdout chunks."""
+        if self._replay:
+            replay, self._replay = self._replay, None
+            yield replay
+
+        selector = selectors.DefaultSelector()
+        try:
+            for fileobj, events in self._io_fileobjs():
+                selector.register(fileobj, events)
+
+            while selector.get_map():
+                timeout = self._remaining()
+                if timeout == 0:
+                    self._timeout_expired()
+
+                for key, _ in selector.select(timeout):
+                    data, eof = self._io_event(key.fileobj)
+                    if eof:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    if data:
+                        yield data
+        finally:
+            selector.close()
 
-            if self.stdout is None:
-                self.stdout = b''
+        try:
+            self._wait_exit(timeout=self._remaining())
+        except TimeoutExpired:
+            self._timeout_expired()
 
-            if self.stderr is None:
-                self.stderr = b''
+    def _can_wait4(self):
+        """Return True if the process can be reaped with os.wait4()."""
+        return isinstance(self._proc, (subprocess.Popen, CmdSpawnProcess)) \
+            and hasattr(os, 'wait4') and hasattr(os, 'waitid')
 
-            self.returncode = self._proc.returncode
+    def _poll_exit(self):
+        """Return the returncode if the process exited (None otherwise).
 
-            if self.returncode != 0:
-                raise CmdProcError('exit-code {} return by: {}'
-                                   .format(self.returncode,
-                                           self._cmd_str), self)
-        except (subprocess.CalledProcessError, CmdProcError) as err:
-            raise CmdProcError(self._cmd_error_msg(str(err)), self)
+        The process is reaped with os.wait4() to get its resource usage.
 
-        return True
+        """
+        if self._proc.returncode is None and self._can_wait4():
+            try:
+                if os.waitid(os.P_PID, self._proc.pid,
+                             os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+                    return None
+                self._reap()
+            except ChildProcessError:
+                pass    # reaped by someone else
+
+        return self._proc.poll()
+
+    def _wait_exit(self, timeout=None):
+        """Wait until the process exits (raise TimeoutExpired).
+
+        Without a timeout, os.waitid() blocks until the exit. With a
+        timeout, the pidfd of the process is polled.
+
+        """
+        if self._proc.returncode is None and self._can_wait4():
+            if timeout is None:
+                try:
+                    os.waitid(os.P_PID, self._proc.pid,
+                              os.WEXITED | os.WNOWAIT)
+                except ChildProcessError:
+                    pass    # reaped by someone else
+                self._poll_exit()
+            else:
+                self._wait_pidfd(timeout)
+
+        self._proc.wait(timeout=timeout)
+
+    def _wait_pidfd(self, timeout):
+        """Wait until the process exits (raise TimeoutExpired).
+
+        Without pidfd_open() (Linux < 5.3), the exit is polled with
+        increasing delays.
+
+        """
+        deadline = monotonic() + timeout
+        pidfd = pidfd_open(self._proc.pid)
+        poller = None
+        if pidfd is not None:
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+        try:
+            delay = 0.0001
+            while self._poll_exit() is None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise TimeoutExpired(self._cmd_list, timeout)
+                if poller is None:
+                    delay = min(delay * 2, 0.05, remaining)
+                    sleep(delay)
+                else:
+                    poller.poll(remaining * 1000)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+
+    def _reap(self):
+        """Reap the process (it exited): store its resource usage."""
+        self._proc_io = read_proc_io(self._proc.pid)
+        _, status, self._rusage = os.wait4(self._proc.pid, 0)
+        self._exit_time = monotonic()
+        if os.WIFSIGNALED(status):
+            self._proc.returncode = -os.WTERMSIG(status)
+        else:
+            self._proc.returncode = os.WEXITSTATUS(status)
+
+    def _make_stats(self):
+        """Return the CmdStats of the process (None if it did not run)."""
+        if self._start_time is None:
+            return None
+
+        return CmdStats.from_rusage(
+            spawn_time=self._spawn_time,
+            wall_time=(self._exit_time or monotonic()) - self._start_time,
+            rusage=self._rusage or getattr(self._proc, 'rusage', None),
+            proc_io=self._proc_io)
+
+    def _io_fileobjs(self):
+        """Return the (fileobj, selector event) of the pipes still open."""
+        proc = self._proc
+        fileobjs = []
+        if proc.stdin and not proc.stdin.closed:
+            fileobjs.append((proc.stdin, selectors.EVENT_WRITE))
+        for fileobj in (proc.stdout, proc.stderr):
+            if fileobj and not fileobj.closed:
+                fileobjs.append((fileobj, selectors.EVENT_READ))
+        return fileobjs
+
+    def _io_event(self, fileobj):
+        """Handle a pipe that is ready (stdin, stdout or stderr).
+
+        Return (stdout_data, eof). When eof is True, the caller needs to
+        unregister and close fileobj.
+
+        """
+        if fileobj is self._proc.stdin:
+            return None, not self._write_input(fileobj.fileno())
+
+        data = os.read(fileobj.fileno(), CHUNK_SIZE)
+        if not data:
+            return None, True
+
+        if fileobj is self._proc.stdout:
+            if self._opts['hooks'] is not None:
+                self._emit('on_output_chunk', stream='stdout', data=data)
+            return data, False
+
+        if self._opts['hooks'] is not None:
+            self._emit('on_output_chunk', stream='stderr', data=data)
+        self._stderr_buffer.write(data)
+        return None, False
+
+    def _open_input(self):
+        """Return (stdin, file to close after the process is started)."""
+        content = self._opts['input']
+        if content is None or content == b'':
+            return None, None
+
+        if isinstance(content, BYTES_LIKE):
+            self._input_chunks = iter([bytes(content)])
+            return PIPE, None
+
+        if isinstance(content, int):
+            return content, None
+
+        if isinstance(content, (str, os.PathLike)):
+            # pylint: disable=consider-using-with
+            stdin_file = open(content, 'rb')
+            return stdin_file, stdin_file
+
+        try:
+            content.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            self._input_chunks = iter(content)
+            return PIPE, None
+
+        return content, None
+
+    def _open_capture(self, name):
+        """Return a new buffer of the capture policy 'name'."""
+        policy = self._opts[name]
+        if isinstance(policy, CmdCaptureText):
+            return policy.open(self._opts['encoding'], self._opts['errors'])
+        return policy.open()
+
+    @staticmethod
+    def _open_output(target, opened):
+        """Return the stdout/stderr of the process (a path is opened).
+
+        The opened files are added to 'opened' (to close them once the
+        process is started: the process has its own file descriptor).
+
+        """
+        if isinstance(target, (str, os.PathLike)):
+            target = CmdRedirect(target)
+
+        if isinstance(target, CmdRedirect):
+            target = target.open()
+            opened.append(target)
+
+        return target
+
+    def _write_input(self, fd):
+        """Write the input until the pipe is full. Return False when done."""
+        try:
+            while True:
+                if not self._input_pending:
+                    chunk = next(self._input_chunks, None)
+                    if chunk is None:
+                        return False
+                    self._input_pending = memoryview(chunk)
+                    continue
+
+                written = os.write(fd, self._input_pending[:CHUNK_SIZE])
+                self._input_pending = self._input_pending[written:]
+        except BlockingIOError:
+            return True
+        except BrokenPipeError:
+            return False
+
+    def _finish(self):
+        """Store the output/returncode. Raise CmdProcError if it failed."""
+        self._store_result()
+        if self.returncode != 0 and not self.stopped_early:
+            err_msg = 'exit-code {} return by: {}'.format(self.returncode,
+                                                          self._cmd_str)
+            error = CmdProcError(self._cmd_error_msg(err_msg), self)
+            self._emit('on_error', error=error)
+            raise error
+
+    def _store_result(self):
+        """Store the output/returncode/stats of the exited process."""
+        self._done = True
+        for name in ('stdout', 'stderr'):
+            buf = getattr(self, '_{}_buffer'.format(name))
+            setattr(self, name, buf.getvalue())
+            setattr(self, '{}_skipped'.format(name), buf.skipped)
+            buf.close()
+        self.returncode = self._proc.returncode
+
+        self.stats = self._make_stats()
+        if self._opts['collector'] is not None:
+            self._opts['collector'].add(os.path.basename(self._cmd_list[0]),
+                                        self.stats)
+
+        self._emit('on_exit', returncode=self.returncode,
+                   duration=None if self.stats is None
+                   else self.stats.wall_time)
 
     def _cmd_error_msg(self, err_msg):
         """Return a string you can use for the command's exception."""
-        output = self.stdout.rstrip()
+        output = self._error_output(self.stdout).rstrip()
         output += (b'' if output == b'' else os.linesep.encode())
-        output += self.stderr
+        output += self._error_output(self.stderr)
         error_msg = '{}\n\nCOMMAND: {}\n\nOUTPUT: {}\n' \
                     .format(err_msg,
                             self._cmd_str,
                             output)
         return error_msg
 
+    @staticmethod
+    def _error_output(output):
+        """Return the end of the output (ERROR_OUTPUT_MAX bytes)."""
+        if isinstance(output, str):
+            output = output.encode('utf-8', errors='surrogateescape')
+        if len(output) <= ERROR_OUTPUT_MAX:
+            return bytes(output)
+        return b'[...]' + bytes(output[-ERROR_OUTPUT_MAX:])
+
     @staticmethod
     def _cmd_split_types(cmd):
         """Convert a command 'cmd' to list + str."""
-        assert isinstance(cmd, (list, str))
-
         assert isinstance(cmd, (str, list))
         if isinstance(cmd, str):
             cmd_list = shlex.split(cmd)
@@ -263,6 +973,342 @@ def main():
                 pass
             self.assertEqual(self._proc.stderr, b'')
 
+        def test_iter_lines(self):
+            """Test: CmdProc.iter_lines() while the process is running."""
+            proc = CmdProc(['bash', '-c',
+                            'echo FIRST; echo ERR >&2; sleep 5; echo LAST'],
+                           timeout=10)
+            start = monotonic()
+            lines = proc.iter_lines()
+            self.assertEqual(next(lines), b'FIRST')
+            self.assertLess(monotonic() - start, 4)
+            self.assertEqual(list(lines), [b'LAST'])
+            self.assertEqual(proc.returncode, 0)
+            self.assertEqual(proc.stdout, b'')
+            self.assertEqual(proc.stderr, b'ERR\n')
+
+            proc = CmdProc(['printf', 'a\\r\\nb\\nc'])
+            self.assertEqual(list(proc.iter_lines()), [b'a', b'b', b'c'])
+            self.assertEqual(list(proc.iter_lines()), [])
+
+            proc = CmdProc(['cat'], input=b'x' * (CHUNK_SIZE * 4))
+            self.assertEqual(len(b''.join(proc.iter_chunks())),
+                             CHUNK_SIZE * 4)
+
+        def test_split_chunk(self):
+            """Test: split_chunk() and join_pending()."""
+            pending = []
+            self.assertEqual(split_chunk(pending, b'a\r'), [])
+            self.assertEqual(split_chunk(pending, b'\nb\rc'), [b'a', b'b'])
+            self.assertEqual(split_chunk(pending, b'x' * 10), [])
+            self.assertEqual(split_chunk(pending, b''), [])
+            self.assertEqual(split_chunk(pending, b'y\r'), [])
+            self.assertEqual(split_chunk(pending, b'z'),
+                             [b'c' + b'x' * 10 + b'y'])
+            self.assertEqual(join_pending(pending), b'z')
+
+            # A long line in many chunks is only joined once it's complete
+            pending = []
+            for _ in range(1000):
+                self.assertEqual(split_chunk(pending, b'x' * 100), [])
+            self.assertEqual(len(pending), 1000)
+            self.assertEqual(split_chunk(pending, b'\nEND'),
+                             [b'x' * 100000])
+            self.assertEqual(pending, [b'END'])
+
+        def test_spawn(self):
+            """Test: CmdProc(spawn='posix_spawn')."""
+            proc = CmdProc(['bash', '-c', 'cat; echo $TEST >&2'],
+                           input=b'HIWORLD', env={'TEST': 'ERR'},
+                           spawn='posix_spawn')
+            proc.wait()
+            self.assertIsInstance(proc._proc, CmdSpawnProcess)
+            self.assertEqual(proc.stdout, b'HIWORLD')
+            self.assertIn(b'ERR\n', proc.stderr)
+
+            # posix_spawn cannot change the directory
+            proc = CmdProc('pwd', cwd='/', spawn='posix_spawn')
+            proc.wait()
+            self.assertIsInstance(proc._proc, subprocess.Popen)
+            self.assertEqual(proc.stdout, b'/\n')
+
+            with self.assertRaises(CmdProcError):
+                CmdProc('false', spawn='posix_spawn').wait()
+
+            with self.assertRaises(TimeoutExpired):
+                CmdProc('sleep 10', timeout=1, spawn='posix_spawn').wait()
+
+        def test_input(self):
+            """Test: CmdProc(input=file, fd, path or iterator)."""
+            import tempfile
+            with tempfile.NamedTemporaryFile() as fhandler:
+                fhandler.write(b'line1\nline2\n')
+                fhandler.flush()
+
+                for content in (fhandler.name,
+                                __import__('pathlib').Path(fhandler.name),
+                                open(fhandler.name, 'rb'),
+                                os.open(fhandler.name, os.O_RDONLY)):
+                    proc = CmdProc('wc -l', input=content)
+                    proc.wait()
+                    self.assertEqual(proc.stdout, b'2\n')
+                    if isinstance(content, int):
+                        os.close(content)
+                    elif not isinstance(content, (str, os.PathLike)):
+                        content.close()
+
+            # a generator of 20 MB (more than the pipe and the chunk sizes)
+            def chunks():
+                """Generate the chunks."""
+                for _ in range(20):
+                    yield b'x' * (1024 ** 2 - 1) + b'\n'
+                yield b''
+
+            proc = CmdProc('wc -lc', input=chunks())
+            proc.wait()
+            self.assertEqual(proc.stdout.split(), [b'20', b'20971520'])
+
+            for content in (bytearray(b'1\n2\n'), memoryview(b'1\n2\n')):
+                proc = CmdProc('wc -l', input=content)
+                proc.wait()
+                self.assertEqual(proc.stdout, b'2\n')
+
+            proc = CmdProc('wc -l', input=io.BytesIO(b'1\n2\n3\n'))
+            proc.wait()
+            self.assertEqual(proc.stdout, b'3\n')
+
+            proc = CmdProc('true', input=chunks())
+            proc.wait()
+            self.assertEqual(proc.returncode, 0)
+
+            with self.assertRaises(CmdProcError):
+                list(CmdProc('bash -c "echo OUT; exit 3"').iter_lines())
+
+            with self.assertRaises(TimeoutExpired):
+                list(CmdProc('bash -c "echo OUT; sleep 10"',
+                             timeout=1).iter_lines())
+
+        def test_capture(self):
+            """Test: CmdProc(stdout_capture=..., stderr_capture=...)."""
+            from cmdwrapper.cmdcapture import CmdCaptureTail, CmdCaptureSpill
+            proc = CmdProc(['bash', '-c', 'seq 1 100000; seq 1 100000 >&2; '
+                            'exit 1'],
+                           stdout_capture=CmdCaptureTail(max_lines=2),
+                           stderr_capture=CmdCaptureSpill(1024))
+            with self.assertRaises(CmdProcError) as context:
+                proc.wait()
+            self.assertEqual(proc.stdout, b'99999\n100000\n')
+            self.assertEqual(proc.stdout_skipped, 588882)
+            self.assertEqual(len(proc.stderr), 588895)
+            self.assertEqual(proc.stderr[-7:], b'100000\n')
+            self.assertLess(len(str(context.exception)), ERROR_OUTPUT_MAX * 5)
+
+        def test_filter(self):
+            """Test: CmdProc(stdout_capture=CmdCaptureFilter(...))."""
+            from cmdwrapper.cmdcapture import CmdCaptureFilter
+            start = monotonic()
+            proc = CmdProc(['seq', '1', '1000000000'],
+                           stdout_capture=CmdCaptureFilter(r'^5', head=3))
+            self.assertTrue(proc.wait())
+            self.assertEqual(proc.stdout, b'5\n50\n51\n')
+            self.assertTrue(proc.stopped_early)
+            self.assertLess(monotonic() - start, 5)
+
+            proc = CmdProc(['seq', '1', '100'],
+                           stdout_capture=CmdCaptureFilter(r'0$', tail=2))
+            proc.wait()
+            self.assertEqual(proc.stdout, b'90\n100\n')
+            self.assertFalse(proc.stopped_early)
+
+        def test_redirect(self):
+            """Test: CmdProc(stdout=path/CmdRedirect/file/fd)."""
+            import tempfile
+            from cmdwrapper.cmdcapture import CmdCaptureTee
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'out.log')
+
+                def content():
+                    """Return the content of the file."""
+                    with open(path, 'rb') as fhandle:
+                        return fhandle.read()
+
+                for spawn in ('popen', 'posix_spawn'):
+                    proc = CmdProc(['echo', 'A'], stdout=path, spawn=spawn)
+                    proc.wait()
+                    self.assertEqual(proc.stdout, b'')
+                    self.assertEqual(content(), b'A\n')
+
+                    CmdProc(['echo', 'B'], stdout=CmdRedirect(path, True),
+                            spawn=spawn).wait()
+                    self.assertEqual(content(), b'A\nB\n')
+
+                    with open(path, 'ab') as fhandle:
+                        CmdProc('bash -c "echo C >&2"', stderr=fhandle,
+                                spawn=spawn).wait()
+                        CmdProc(['echo', 'D'], stdout=fhandle.fileno(),
+                                spawn=spawn).wait()
+                    self.assertEqual(content(), b'A\nB\nC\nD\n')
+
+                proc = CmdProc(['seq', '1', '1000'],
+                               stdout_capture=CmdCaptureTee(path,
+                                                            max_lines=2))
+                proc.wait()
+                self.assertEqual(proc.stdout, b'999\n1000\n')
+                self.assertEqual(content().count(b'\n'), 1000)
+
+            with self.assertRaises(OSError):
+                CmdProc(['true'], stdout='/nonexistent/out.log').wait()
+            with self.assertRaises(AssertionError):
+                CmdProc(['true'], stdout=-5)
+
+        def test_cmdenv(self):
+            """Test: CmdProc(env=CmdEnv())."""
+            env = CmdEnv(overrides={'CMDENV_TEST': 'HIWORLD'})
+            for spawn in ('popen', 'posix_spawn'):
+                proc = CmdProc('bash -c "echo $CMDENV_TEST"', env=env,
+                               spawn=spawn)
+                proc.wait()
+                self.assertEqual(proc.stdout, b'HIWORLD\n')
+
+            env.unset('CMDENV_TEST')
+            proc = CmdProc('bash -c "echo ${CMDENV_TEST-UNSET}"', env=env)
+            proc.wait()
+            self.assertEqual(proc.stdout, b'UNSET\n')
+
+        def test_stats(self):
+            """Test: CmdProc.stats."""
+            proc = CmdProc(['bash', '-c', 'for i in {1..30000}; do :; done; '
+                            'exit 3'])
+            with self.assertRaises(CmdProcError):
+                proc.wait()
+            self.assertEqual(proc.returncode, 3)
+            self.assertGreater(proc.stats.user_time, 0)
+            self.assertGreater(proc.stats.max_rss, 0)
+            self.assertGreater(proc.stats.wall_time, proc.stats.spawn_time)
+            self.assertIsNotNone(proc.stats.write_bytes)
+
+            proc = CmdProc('sleep 10', timeout=1)
+            with self.assertRaises(TimeoutExpired):
+                proc.wait()
+            proc.kill()
+
+            proc = CmdProc('true', spawn='posix_spawn')
+            proc.wait()
+            self.assertIsNotNone(proc.stats.user_time)
+
+            self.assertIsNone(CmdProc.completed(['ls'], b'', b'', 0).stats)
+
+        def test_completed(self):
+            """Test: CmdProc.completed()."""
+            proc = CmdProc.completed(['ls'], b'1\n2\n', b'ERR', 0)
+            self.assertFalse(proc.run())
+            self.assertEqual(list(proc.iter_lines()), [b'1', b'2'])
+            self.assertEqual(proc.stdout, b'')
+            self.assertEqual(proc.stderr, b'ERR')
+            self.assertFalse(proc.kill())
+
+            proc = CmdProc.completed(['ls'], b'OUT', b'', 2)
+            with self.assertRaises(CmdProcError):
+                proc.wait()
+            self.assertEqual(proc.stdout, b'OUT')
+            self.assertEqual(proc.returncode, 2)
+
+        def test_hooks(self):
+            """Test: CmdProc(hooks=...)."""
+            from cmdwrapper.cmdhooks import CmdHooks
+            events = []
+            hooks = CmdHooks()
+            for event in CmdHooks.EVENTS:
+                hooks.register(event, lambda cmd_proc, event=event, **info:
+                               events.append((event, sorted(info))))
+
+            CmdProc(['bash', '-c', 'echo OUT; echo ERR >&2'],
+                    hooks=hooks).wait()
+            self.assertEqual(events[:2],
+                             [('before_spawn', []),
+                              ('after_spawn', ['pid', 'spawn_time'])])
+            self.assertEqual(events[-1], ('on_exit',
+                                          ['duration', 'returncode']))
+            self.assertEqual(events.count(('on_output_chunk',
+                                           ['data', 'stream'])), 2)
+
+            del events[:]
+            with self.assertRaises(CmdProcError):
+                CmdProc('false', hooks=hooks).wait()
+            self.assertEqual(events[-1], ('on_error', ['error']))
+
+            del events[:]
+            with self.assertRaises(OSError):
+                CmdProc('/xxx/rrr/cmdproc', hooks=hooks).wait()
+            self.assertEqual(events, [('before_spawn', []),
+                                      ('on_error', ['error'])])
+
+            del events[:]
+            proc = CmdProc('sleep 10', timeout=1, hooks=hooks)
+            with self.assertRaises(TimeoutExpired):
+                proc.wait()
+            proc.kill()
+            self.assertEqual(events[-3:], [('on_timeout', ['timeout']),
+                                           ('on_exit',
+                                            ['duration', 'returncode']),
+                                           ('on_error', ['error'])])
+
+        def test_wait_exit(self):
+            """Test: _wait_exit() (os.waitid() or the pidfd)."""
+            # pylint: disable=protected-access
+            for timeout in (None, 5):
+                proc = CmdProc(['sleep', '0.2'], stdout=DEVNULL)
+                proc.run()
+                start = monotonic()
+                proc._wait_exit(timeout=timeout)
+                self.assertLess(monotonic() - start, 1)
+                self.assertEqual(proc._proc.returncode, 0)
+                self.assertIsNotNone(proc._rusage)
+                proc.wait()
+
+            proc = CmdProc(['sleep', '10'], stdout=DEVNULL)
+            proc.run()
+            with self.assertRaises(TimeoutExpired):
+                proc._wait_exit(timeout=0.1)
+            proc.kill()
+
+        def test_timeout(self):
+            """Test: the timeout kills the process group."""
+            for spawn in ('popen', 'posix_spawn'):
+                proc = CmdProc(['bash', '-c', 'sleep 30 & echo $!; '
+                                'echo PARTIAL >&2; wait'],
+                               timeout=0.5, spawn=spawn)
+                with self.assertRaises(CmdProcTimeout) as context:
+                    proc.wait()
+                self.assertIsInstance(context.exception, TimeoutExpired)
+                self.assertEqual(context.exception.stderr, b'PARTIAL\n')
+                self.assertIn('timeout (0.5 seconds) expired',
+                              str(context.exception))
+                self.assertEqual(proc.returncode, -signal.SIGTERM)
+                self.assertTrue(proc._proc.stdout.closed)
+
+                # the grandchild was killed too (and reaped by init)
+                grandchild = int(context.exception.output)
+                for _ in range(50):
+                    if not os.path.exists('/proc/{}'.format(grandchild)):
+                        break
+                    sleep(0.1)
+                else:
+                    self.fail('the grandchild is still running')
+
+            # SIGTERM is ignored: SIGKILL after kill_grace
+            start = monotonic()
+            proc = CmdProc(['bash', '-c', 'trap "" TERM; sleep 30'],
+                           timeout=0.2, kill_grace=0.3)
+            with self.assertRaises(CmdProcTimeout):
+                proc.wait()
+            self.assertLess(monotonic() - start, 3)
+            self.assertEqual(proc.returncode, -signal.SIGKILL)
+            self.assertFalse(proc.kill())
+
+            with self.assertRaises(AssertionError):
+                CmdProc('true', timeout=-1)
+
     tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdProc)
     ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
     sys.exit(int(not ret))
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Retry the commands that fail (backoff + jitter) and circuit breakers."""
+
+import re
+import sys
+import random
+import threading
+from time import monotonic
+from cmdwrapper.cmdproc import CmdProcError, CmdProcTimeout
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class CmdCircuitOpen(CmdProcError):
+    """Raised when a circuit breaker does not allow to start the command."""
+
+
+class CmdRetry(object):
+    """A retry policy: which failures are retried and when.
+
+    The delay before the attempt N+1 is backoff * factor ** (N - 1), at
+    most max_backoff. With jitter, a random delay between 0 and this value
+    is used (full jitter): the clients that fail at the same time do not
+    retry at the same time.
+
+    >>> apt = CmdWrapper('apt-get', retry=CmdRetry(
+    ...     attempts=5, stderr=r'Could not get lock'))
+
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+    def __init__(self, attempts=3, backoff=0.5, factor=2, max_backoff=30,
+                 jitter=True, deadline=None, returncodes=None, stderr=None,
+                 predicate=None, timeouts=False):
+        """Init the policy.
+
+        :attempts: the maximum number of attempts (the first one included).
+        :backoff: the delay before the second attempt (seconds).
+        :factor: the delay is multiplied by 'factor' after each attempt.
+        :max_backoff: the maximum delay.
+        :jitter: True: random delay between 0 and the computed delay.
+        :deadline: no new attempt after 'deadline' seconds (from the start
+                   of the first attempt).
+        :returncodes: retry only these returncodes (a list).
+        :stderr: retry only if this regex is found in stderr (str or bytes).
+        :predicate: retry only if predicate(cmd_proc_error) is True.
+        :timeouts: retry the CmdProcTimeout too.
+
+        Without returncodes, stderr and predicate, all the failures are
+        retried.
+
+        """
+        assert isinstance(attempts, int) and attempts >= 1
+        assert isinstance(returncodes, (list, tuple, set, type(None)))
+        assert predicate is None or callable(predicate)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.returncodes = None if returncodes is None else set(returncodes)
+        self.stderr = None if stderr is None else re.compile(
+            stderr.encode('utf-8') if isinstance(stderr, str) else stderr)
+        self.predicate = predicate
+        self.timeouts = timeouts
+
+    def retryable(self, error):
+        """Return True if the failure 'error' (CmdProcError) is retried."""
+        if isinstance(error, CmdProcTimeout):
+            return self.timeouts
+
+        if not isinstance(error, CmdProcError) or \
+                isinstance(error, CmdCircuitOpen):
+            return False
+
+        cmd_proc = error.cmd_proc
+        if self.returncodes is not None and \
+                (cmd_proc is None or cmd_proc.returncode not in
+                 self.returncodes):
+            return False
+
+        if self.stderr is not None:
+            stderr = b'' if cmd_proc is None else cmd_proc.stderr
+            if isinstance(stderr, str):
+                stderr = stderr.encode('utf-8', errors='surrogateescape')
+            if not self.stderr.search(stderr):
+                return False
+
+        return self.predicate is None or bool(self.predicate(error))
+
+    def delay(self, attempt):
+        """Return the delay after the failed attempt 'attempt' (1, 2...)."""
+        delay = min(self.max_backoff,
+                    self.backoff * self.factor ** (attempt - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def next_delay(self, error, attempt, elapsed):
+        """Return the delay before the next attempt (None: give up).
+
+        :error: the failure of the attempt 'attempt'.
+        :elapsed: the seconds since the start of the first attempt.
+
+        """
+        if attempt >= self.attempts or not self.retryable(error):
+            return None
+
+        delay = self.delay(attempt)
+        if self.deadline is not None and elapsed + delay >= self.deadline:
+            return None
+        return delay
+
+    def __repr__(self):
+        """Return the repr."""
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(key, value)
+                                         for key, value
+                                         in sorted(vars(self).items())))
+
+
+class CmdCircuitBreaker(object):
+    """Stop starting a command after repeated failures (shared by threads).
+
+    After 'failures' consecutive failures, the circuit is open: the calls
+    raise CmdCircuitOpen without starting a process. After 'reset_after'
+    seconds, one call is allowed (half-open): the circuit is closed if it
+    succeeds, open again if it fails.
+
+    >>> ssh = CmdWrapper('ssh', breaker=CmdCircuitBreaker(failures=5))
+
+    """
+
+    def __init__(self, failures=5, reset_after=30):
+        """Init the circuit breaker (closed)."""
+        assert isinstance(failures, int) and failures >= 1
+        self.failures = failures
+        self.reset_after = reset_after
+        self._count = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Return 'closed', 'open' or 'half-open'."""
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._trial or \
+                    monotonic() - self._opened_at >= self.reset_after:
+                return 'half-open'
+            return 'open'
+
+    def allow(self, cmd_str=''):
+        """Raise CmdCircuitOpen if the command cannot be started now.
+
+        Return True if the call is the trial of the half-open circuit: its
+        outcome must be given to success(), failure() or release().
+
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+
+            if not self._trial and \
+                    monotonic() - self._opened_at >= self.reset_after:
+                self._trial = True  # only one call tries (half-open)
+                return True
+
+        raise CmdCircuitOpen('circuit open after {} failures: {}'
+                             .format(self._count, cmd_str))
+
+    def success(self):
+        """Close the circuit."""
+        with self._lock:
+            self._count = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """Count a failure: the circuit is opened after 'failures' of them."""
+        with self._lock:
+            self._count += 1
+            if self._trial or self._count >= self.failures:
+                self._opened_at = monotonic()
+                self._trial = False
+
+    def release(self):
+        """End the trial without an outcome (the call was interrupted).
+
+        The circuit stays half-open: the next call is the trial.
+
+        """
+        with self._lock:
+            self._trial = False
+
+
+def main():
+    """Test the retry policies and the circuit breakers."""
+    import unittest
+    from time import sleep
+    from cmdwrapper.cmdproc import CmdProc
+
+    def failure(cmd):
+        """Return the CmdProcError of 'cmd'."""
+        try:
+            CmdProc(cmd).wait()
+        except CmdProcError as err:
+            return err
+        return None
+
+    class TestCmdRetry(unittest.TestCase):
+        """Testing CmdRetry and CmdCircuitBreaker."""
+
+        def test_retry(self):
+            """Test: CmdRetry()."""
+            lock = failure(['bash', '-c', 'echo "index.lock: File exists" '
+                            '>&2; exit 128'])
+            other = failure(['bash', '-c', 'exit 1'])
+
+            retry = CmdRetry()
+            self.assertTrue(retry.retryable(lock))
+            self.assertTrue(retry.retryable(other))
+            self.assertFalse(retry.retryable(CmdCircuitOpen('open')))
+            self.assertFalse(retry.retryable(ValueError()))
+
+            retry = CmdRetry(stderr=r'index\.lock')
+            self.assertTrue(retry.retryable(lock))
+            self.assertFalse(retry.retryable(other))
+            self.assertFalse(CmdRetry(returncodes=[1]).retryable(lock))
+            self.assertTrue(CmdRetry(returncodes=[1]).retryable(other))
+            self.assertFalse(CmdRetry(predicate=lambda error: False)
+                             .retryable(lock))
+
+            timeout = CmdProc(['sleep', '10'], timeout=0.1)
+            with self.assertRaises(CmdProcTimeout) as context:
+                timeout.wait()
+            self.assertFalse(CmdRetry().retryable(context.exception))
+            self.assertTrue(CmdRetry(timeouts=True)
+                            .retryable(context.exception))
+
+        def test_delay(self):
+            """Test: CmdRetry.next_delay()."""
+            err = CmdProcError('failed')
+            retry = CmdRetry(attempts=4, backoff=1, factor=3, max_backoff=5,
+                             jitter=False)
+            self.assertEqual([retry.next_delay(err, num, 0)
+                              for num in range(1, 5)], [1, 3, 5, None])
+            retry.deadline = 4
+            self.assertEqual(retry.next_delay(err, 2, 0), 3)
+            self.assertIsNone(retry.next_delay(err, 2, 1))
+
+            retry.jitter = True
+            for _ in range(100):
+                self.assertLessEqual(0, retry.delay(3))
+                self.assertLessEqual(retry.delay(3), 5)
+            self.assertIn('attempts=4', repr(retry))
+
+        def test_breaker(self):
+            """Test: CmdCircuitBreaker()."""
+            breaker = CmdCircuitBreaker(failures=2, reset_after=0.2)
+            breaker.allow()
+            breaker.failure()
+            breaker.allow()
+            breaker.failure()
+            self.assertEqual(breaker.state, 'open')
+            with self.assertRaises(CmdCircuitOpen):
+                breaker.allow('ssh host')
+
+            # half-open: one call is allowed
+            sleep(0.2)
+            self.assertEqual(breaker.state, 'half-open')
+            self.assertTrue(breaker.allow())
+            with self.assertRaises(CmdCircuitOpen):
+                breaker.allow()
+            breaker.release()
+            self.assertTrue(breaker.allow())
+            breaker.failure()
+            self.assertEqual(breaker.state, 'open')
+
+            sleep(0.2)
+            breaker.allow()
+            breaker.success()
+            self.assertEqual(breaker.state, 'closed')
+            self.assertFalse(breaker.allow())
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdRetry)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
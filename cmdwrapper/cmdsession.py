@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Run many shell commands in one long-lived shell (a coprocess)."""
+
+import sys
+import os
+import uuid
+import queue
+import shlex
+import signal
+import logging
+import selectors
+import threading
+import subprocess
+from time import monotonic
+from subprocess import PIPE, TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor
+from cmdwrapper import CmdResult
+from cmdwrapper.cmdproc import CmdProc, CmdProcError, CmdProcTimeout, \
+    CHUNK_SIZE, KILL_GRACE
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class CmdSession(object):
+    """One shell process that runs the commands one after the other.
+
+    Starting a shell for each command is slow. The commands are written to
+    the stdin of the same shell and their stdout/stderr/exit status are
+    delimited by unique sentinels. The state of the shell (current
+    directory, variables...) is kept between the commands.
+
+    >>> with CmdSession() as session:
+    ...     session.run('cd /etc')
+    ...     session.run('ls').stdout.lines
+
+    The stdin of the commands is /dev/null.
+
+    """
+
+    def __init__(self, shell='bash', cwd=None, env=None,
+                 kill_grace=KILL_GRACE):
+        """Init the session (the shell starts with the first command).
+
+        :shell: 'bash', 'sh' or any POSIX shell.
+        :cwd: the directory where the shell starts.
+        :env: the environment variables of the shell.
+        :kill_grace: the seconds given to a command interrupted by its
+                     timeout before the shell is killed (see run()).
+
+        """
+        assert isinstance(shell, str)
+        assert isinstance(cwd, (str, type(None)))
+        assert isinstance(env, (dict, type(None)))
+        assert isinstance(kill_grace, (int, float)) and kill_grace >= 0
+        self._shell = shell
+        self._cwd = cwd
+        self._env = env
+        self._kill_grace = kill_grace
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        """Return the session."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the session."""
+        self.close()
+
+    @property
+    def pid(self):
+        """Return the pid of the shell (None if it is not started)."""
+        return None if self._proc is None else self._proc.pid
+
+    def run(self, command, timeout=None):
+        """Run a shell command. Return a CmdResult.
+
+        CmdProcError is raised if the exit status != 0.
+
+        If the command takes more than 'timeout' seconds, SIGINT is sent to
+        the processes started by the shell and CmdProcTimeout is raised
+        when the shell is ready again: the session (current directory,
+        variables...) is kept. If the command is still running after
+        'kill_grace' seconds, the shell is killed (a new one is started by
+        the next command).
+
+        """
+        assert isinstance(command, str)
+        assert isinstance(timeout, (int, float, type(None)))
+        with self._lock:
+            stdout, stderr, returncode, timed_out = self._run(command,
+                                                              timeout)
+
+        if timed_out:
+            cmd_proc = CmdProc.completed([command], stdout, stderr,
+                                         returncode, timeout=timeout)
+            try:
+                cmd_proc.wait()
+            except CmdProcError:
+                pass
+            raise CmdProcTimeout('timeout ({} seconds) expired: {}'
+                                 .format(timeout, command), cmd_proc)
+
+        if returncode != 0:
+            # raise the same CmdProcError as the other commands
+            CmdProc.completed([command], stdout, stderr, returncode).wait()
+
+        return CmdResult(stdout=stdout, stderr=stderr, returncode=returncode)
+
+    def close(self):
+        """Stop the shell."""
+        with self._lock:
+            if self._proc is None:
+                return
+
+            self._proc.stdin.close()
+            try:
+                self._proc.wait(timeout=1)
+            except TimeoutExpired:
+                self._kill()
+            else:
+                self._close_pipes()
+
+    def _start(self):
+        """Start the shell."""
+        logging.debug('[RUN-SESSION] %s', self._shell)
+        self._proc = subprocess.Popen([self._shell], stdin=PIPE, stdout=PIPE,
+                                      stderr=PIPE, cwd=self._cwd,
+                                      env=self._env, bufsize=0,
+                                      start_new_session=True)
+
+    def _kill(self):
+        """Kill the shell and the commands it started."""
+        try:
+            os.killpg(self._proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self._proc.wait()
+        self._close_pipes()
+
+    def _close_pipes(self):
+        """Close the pipes of the shell, forget it."""
+        for fileobj in (self._proc.stdin, self._proc.stdout,
+                        self._proc.stderr):
+            fileobj.close()
+        self._proc = None
+
+    def _interrupt(self):
+        """Send SIGINT to the processes started by the shell.
+
+        Return False if there are none (a loop of shell builtins) or if they
+        cannot be found (/proc/PID/task/TID/children is missing).
+
+        """
+        pids = _descendants(self._proc.pid)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        return bool(pids)
+
+    def _run(self, command, timeout):
+        """Send the command, read until the sentinels. Return the output."""
+        if self._proc is None:
+            self._start()
+
+        sentinel = uuid.uuid4().hex.encode()
+        script = ('eval {} </dev/null\n'
+                  'printf "%s %d\\n" {sentinel} $?\n'
+                  'printf "%s\\n" {sentinel} >&2\n'
+                  .format(shlex.quote(command),
+                          sentinel=sentinel.decode())).encode('utf-8')
+
+        try:
+            self._proc.stdin.write(script)
+        except BrokenPipeError:
+            pass  # the shell exited: handled below
+
+        deadline = None if timeout is None else monotonic() + timeout
+        interrupted = False
+        buffers = {self._proc.stdout: bytearray(),
+                   self._proc.stderr: bytearray()}
+        positions = {}
+        with selectors.DefaultSelector() as selector:
+            for fileobj in buffers:
+                selector.register(fileobj, selectors.EVENT_READ)
+
+            while selector.get_map():
+                remaining = None if deadline is None \
+                    else max(0, deadline - monotonic())
+                events = selector.select(remaining)
+                if not events and remaining == 0:
+                    if interrupted or not self._interrupt():
+                        # the command does not stop: kill the shell
+                        proc = self._proc
+                        self._kill()
+                        return (bytes(buffers[proc.stdout]),
+                                bytes(buffers[proc.stderr]),
+                                proc.returncode, True)
+
+                    # wait for the sentinels (the shell is kept)
+                    interrupted = True
+                    deadline = monotonic() + self._kill_grace
+                    continue
+
+                for key, _ in events:
+                    data = os.read(key.fileobj.fileno(), CHUNK_SIZE)
+                    if not data:
+                        # the shell exited ('exit' in the command)
+                        proc = self._proc
+                        self._kill()
+                        return (bytes(buffers[proc.stdout]),
+                                bytes(buffers[proc.stderr]),
+                                proc.returncode, interrupted)
+
+                    buf = buffers[key.fileobj]
+                    search_from = max(0, len(buf) - len(sentinel))
+                    buf += data
+                    if key.fileobj not in positions:
+                        pos = buf.find(sentinel, search_from)
+                        if pos >= 0:
+                            positions[key.fileobj] = pos
+
+                    # the sentinel line is the last one
+                    if key.fileobj in positions and buf.endswith(b'\n'):
+                        selector.unregister(key.fileobj)
+
+        stdout_buf = buffers[self._proc.stdout]
+        stderr_buf = buffers[self._proc.stderr]
+        stdout_pos = positions[self._proc.stdout]
+        returncode = int(stdout_buf[stdout_pos + len(sentinel):])
+        return (bytes(stdout_buf[:stdout_pos]),
+                bytes(stderr_buf[:positions[self._proc.stderr]]),
+                returncode, interrupted)
+
+
+def _descendants(pid):
+    """Return the pids of the descendants of the process 'pid'."""
+    pids = []
+    parents = [pid]
+    while parents:
+        parent = parents.pop()
+        task_dir = '/proc/{}/task'.format(parent)
+        try:
+            tids = os.listdir(task_dir)
+        except OSError:
+            continue    # it exited
+
+        for tid in tids:
+            try:
+                with open(os.path.join(task_dir, tid, 'children')) as fhandle:
+                    children = [int(child) for child in fhandle.read().split()]
+            except OSError:
+                continue
+            pids.extend(children)
+            parents.extend(children)
+    return pids
+
+
+class CmdSessionPool(object):
+    """A pool of CmdSession: the commands run in parallel.
+
+    >>> with CmdSessionPool(size=4) as pool:
+    ...     results = list(pool.map(['hostname', 'uptime', 'uname -a']))
+
+    """
+
+    def __init__(self, size=4, **session_kwargs):
+        """Init 'size' sessions (CmdSession kwargs: shell, cwd, env)."""
+        assert isinstance(size, int) and size > 0
+        self._sessions = [CmdSession(**session_kwargs) for _ in range(size)]
+        self._free = queue.Queue()
+        for session in self._sessions:
+            self._free.put(session)
+
+    def __enter__(self):
+        """Return the pool."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the pool."""
+        self.close()
+
+    def __len__(self):
+        """Return the number of sessions."""
+        return len(self._sessions)
+
+    def run(self, command, timeout=None):
+        """Run a command in a free session (see CmdSession.run)."""
+        session = self._free.get()
+        try:
+            return session.run(command, timeout=timeout)
+        finally:
+            self._free.put(session)
+
+    def map(self, commands, timeout=None):
+        """Run the commands in parallel. Yield the CmdResult in order.
+
+        The first CmdProcError/TimeoutExpired is raised.
+
+        """
+        with ThreadPoolExecutor(max_workers=len(self)) as executor:
+            futures = [executor.submit(self.run, command, timeout)
+                       for command in commands]
+            for future in futures:
+                yield future.result()
+
+    def close(self):
+        """Stop all the shells."""
+        for session in self._sessions:
+            session.close()
+
+
+def main():
+    """Test the class CmdSession."""
+    import unittest
+
+    class TestCmdSession(unittest.TestCase):
+        """Testing the class CmdSession."""
+
+        def test_cmdsession(self):
+            """Test: CmdSession()."""
+            with CmdSession(env={'TEST': 'HIWORLD', 'PATH': os.defpath},
+                            cwd='/') as session:
+                result = session.run('echo $TEST; pwd; echo ERR >&2')
+                self.assertEqual(result.stdout.lines, ['HIWORLD', '/'])
+                self.assertEqual(result.stderr.lines, ['ERR'])
+                self.assertEqual(result.returncode, 0)
+                pid = session.pid
+
+                # the state is kept and the output can end without '\n'
+                session.run('cd /tmp; VAR=1')
+                result = session.run('printf "$VAR"; pwd >&2; printf X >&2')
+                self.assertEqual(result.stdout.bytes, b'1')
+                self.assertEqual(result.stderr.bytes, b'/tmp\nX')
+
+                self.assertEqual(session.run('cat').stdout.bytes, b'')
+
+                with self.assertRaises(CmdProcError) as context:
+                    session.run('echo FAILED >&2; false')
+                self.assertIn('FAILED', str(context.exception))
+
+                with self.assertRaises(CmdProcError):
+                    session.run('if')   # syntax error
+                self.assertEqual(session.pid, pid)
+
+                # the command is interrupted, the session is kept
+                session.run('cd /; VAR=2')
+                start = monotonic()
+                with self.assertRaises(CmdProcTimeout) as context:
+                    session.run('echo START; sleep 10', timeout=0.5)
+                self.assertLess(monotonic() - start, 2)
+                self.assertIsInstance(context.exception, TimeoutExpired)
+                self.assertEqual(context.exception.output, b'START\n')
+                self.assertEqual(session.pid, pid)
+                self.assertEqual(session.run('pwd; echo $VAR').stdout.lines,
+                                 ['/', '2'])
+
+                # the command ignores SIGINT: the shell is killed, a new
+                # one is started
+                session._kill_grace = 0.5  # pylint: disable=protected-access
+                with self.assertRaises(CmdProcTimeout):
+                    session.run('trap "" INT; sleep 10', timeout=0.5)
+                self.assertIsNone(session.pid)
+                with self.assertRaises(CmdProcTimeout):
+                    session.run('while :; do :; done', timeout=0.5)
+                self.assertIsNone(session.pid)
+                self.assertEqual(session.run('pwd').stdout.firstline, '/')
+
+                with self.assertRaises(CmdProcError):
+                    session.run('exit 3')
+                self.assertEqual(session.run('echo 1').stdout.firstline, '1')
+
+                start = monotonic()
+                for _ in range(200):
+                    session.run('true')
+                self.assertLess(monotonic() - start, 5)
+
+        def test_cmdsessionpool(self):
+            """Test: CmdSessionPool()."""
+            with CmdSessionPool(size=5) as pool:
+                start = monotonic()
+                results = list(pool.map(['sleep 0.5; echo {}'.format(num)
+                                         for num in range(10)]))
+                self.assertLess(monotonic() - start, 5)
+                self.assertEqual([result.stdout.firstline
+                                  for result in results],
+                                 [str(num) for num in range(10)])
+
+                with self.assertRaises(CmdProcError):
+                    list(pool.map(['true', 'false']))
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdSession)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Start processes with os.posix_spawnp() (no fork of the parent)."""
+
+import sys
+import os
+import signal
+from time import monotonic, sleep
+from subprocess import PIPE, DEVNULL, STDOUT, TimeoutExpired
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+# The spawn backends accepted by CmdProc(spawn=...)
+SPAWN_BACKENDS = ('popen', 'posix_spawn')
+
+# The signals ignored by Python that are restored to SIG_DFL in the child
+# (like Popen's restore_signals=True)
+RESTORED_SIGNALS = tuple(getattr(signal, name)
+                         for name in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ')
+                         if hasattr(signal, name))
+
+
+def can_posix_spawn(cwd=None):
+    """Return True if a process with these options can use posix_spawn.
+
+    os.posix_spawn() has no 'cwd' argument: Popen is used in this case.
+
+    """
+    return hasattr(os, 'posix_spawnp') and cwd is None
+
+
+def pidfd_open(pid):
+    """Return a pidfd of the process (None if it is not supported)."""
+    if pid is None or not hasattr(os, 'pidfd_open'):
+        return None
+
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def std_fds(stdin, stdout, stderr):
+    """Open the pipes of a new process (same arguments as Popen).
+
+    Return ({target fd: child fd}, {target fd: parent file}, [fds to close
+    once the child is started]). The parent files are unbuffered.
+
+    The child fds are duplicated in the order 0, 1, 2: stderr=STDOUT and
+    stderr=1 are the new stdout of the child (the pipe if stdout=PIPE).
+
+    """
+    child_fds = {}
+    parent_files = {}
+    close_fds = []
+    try:
+        for target, spec in ((0, stdin), (1, stdout), (2, stderr)):
+            if spec is None:
+                continue
+
+            if spec == PIPE:
+                read_fd, write_fd = os.pipe()
+                child_fd, parent_fd = (read_fd, write_fd) if target == 0 \
+                    else (write_fd, read_fd)
+                close_fds.append(child_fd)
+                parent_files[target] = open(parent_fd,
+                                            'wb' if target == 0 else 'rb',
+                                            buffering=0)
+            elif spec == DEVNULL:
+                child_fd = os.open(os.devnull, os.O_RDWR)
+                close_fds.append(child_fd)
+            elif spec == STDOUT or (target == 2 and spec == 1):
+                child_fd = child_fds.get(1, 1)
+            elif isinstance(spec, int):
+                child_fd = spec
+            else:
+                child_fd = spec.fileno()
+
+            child_fds[target] = child_fd
+    except Exception:
+        for fileobj in parent_files.values():
+            fileobj.close()
+        for fd in close_fds:
+            os.close(fd)
+        raise
+
+    return child_fds, parent_files, close_fds
+
+
+class CmdSpawnProcess(object):
+    """A process started with os.posix_spawnp() (subset of Popen's API).
+
+    posix_spawn is implemented with vfork() + exec() by the libc: the page
+    tables of the parent are never copied, the cost of a spawn does not
+    depend on the size of the parent process.
+
+    Differences with Popen: the 'cwd' argument is not supported and the file
+    descriptors that are inheritable (os.set_inheritable()) are inherited.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, args, stdin=None, stdout=None, stderr=None, env=None,
+                 setsid=False, executable=None):
+        """Start the process (same arguments as subprocess.Popen)."""
+        self.args = args
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+
+        child_fds, parent_files, close_fds = std_fds(stdin, stdout, stderr)
+        try:
+            file_actions = [(os.POSIX_SPAWN_DUP2, child_fd, target)
+                            for target, child_fd in sorted(child_fds.items())]
+            self.pid = os.posix_spawnp(executable or args[0], args,
+                                       os.environ if env is None else env,
+                                       file_actions=file_actions,
+                                       setsid=setsid,
+                                       setsigdef=RESTORED_SIGNALS)
+        except Exception:
+            for fileobj in parent_files.values():
+                fileobj.close()
+            raise
+        finally:
+            for fd in close_fds:
+                os.close(fd)
+
+        self.stdin = parent_files.get(0)
+        self.stdout = parent_files.get(1)
+        self.stderr = parent_files.get(2)
+
+    def _handle_status(self, status):
+        """Set the returncode from a waitpid() status."""
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def poll(self):
+        """Check if the process is terminated. Return the returncode."""
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                self._handle_status(status)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait until the process is terminated. Return the returncode."""
+        if self.returncode is not None:
+            return self.returncode
+
+        if timeout is None:
+            _, status = os.waitpid(self.pid, 0)
+            self._handle_status(status)
+            return self.returncode
+
+        deadline = monotonic() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise TimeoutExpired(self.args, timeout)
+            delay = min(delay * 2, remaining, 0.05)
+            sleep(delay)
+        return self.returncode
+
+    def send_signal(self, sig):
+        """Send a signal to the process (if it is running)."""
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        """Send SIGTERM."""
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        """Send SIGKILL."""
+        self.send_signal(signal.SIGKILL)
+
+
+def main():
+    """Test the class CmdSpawnProcess."""
+    import unittest
+    import subprocess
+
+    class TestCmdSpawnProcess(unittest.TestCase):
+        """Testing the class CmdSpawnProcess."""
+
+        def test_cmdspawnprocess(self):
+            """Test: CmdSpawnProcess()."""
+            proc = CmdSpawnProcess(['bash', '-c', 'cat; echo $TEST >&2; '
+                                    'exit 3'],
+                                   stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                                   env={'TEST': 'HIWORLD'})
+            proc.stdin.write(b'INPUT\n')
+            proc.stdin.close()
+            self.assertEqual(proc.stdout.read(), b'INPUT\nHIWORLD\n')
+            self.assertEqual(proc.wait(), 3)
+            self.assertEqual(proc.poll(), 3)
+            proc.kill()   # already terminated
+            proc.stdout.close()
+
+            proc = CmdSpawnProcess(['pwd'], stdout=DEVNULL)
+            self.assertEqual(proc.wait(timeout=5), 0)
+
+            proc = CmdSpawnProcess(['sleep', '10'])
+            with self.assertRaises(TimeoutExpired):
+                proc.wait(timeout=0.1)
+            proc.terminate()
+            self.assertEqual(proc.wait(), -signal.SIGTERM)
+
+            with self.assertRaises(OSError):
+                CmdSpawnProcess(['/xxx/rrr/cmdspawn'], stdout=PIPE)
+
+            pidfd = pidfd_open(os.getpid())
+            if pidfd is not None:
+                os.close(pidfd)
+            self.assertIsNone(pidfd_open(None))
+
+            # stderr=1: the new stdout of the child
+            proc = CmdSpawnProcess(['bash', '-c', 'echo OUT; echo ERR >&2'],
+                                   stdout=PIPE, stderr=1)
+            self.assertEqual(proc.stdout.read(), b'OUT\nERR\n')
+            self.assertEqual(proc.wait(), 0)
+            proc.stdout.close()
+
+            # the signals ignored by Python are restored (like Popen)
+            def sig_ign(spawn):
+                """Return the ignored signals of a child (bit mask)."""
+                proc = spawn(['grep', 'SigIgn', '/proc/self/status'],
+                             stdout=PIPE)
+                output = proc.stdout.read()
+                proc.wait()
+                proc.stdout.close()
+                return int(output.split()[1], 16)
+
+            mask = sum(1 << (signum - 1) for signum in RESTORED_SIGNALS)
+            self.assertEqual(sig_ign(CmdSpawnProcess) & mask, 0)
+            self.assertEqual(sig_ign(subprocess.Popen) & mask, 0)
+
+            proc = CmdSpawnProcess(['bash', '-c', 'yes | head -1'],
+                                   stdout=PIPE, stderr=PIPE)
+            self.assertEqual(proc.stdout.read(), b'y\n')
+            self.assertEqual(proc.stderr.read(), b'')
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+            self.assertTrue(can_posix_spawn())
+            self.assertFalse(can_posix_spawn(cwd='/'))
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdSpawnProcess)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
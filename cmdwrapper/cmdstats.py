@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Resource usage of the processes (CPU, memory, I/O) and their summary."""
+
+import sys
+import os
+import threading
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+
+class CmdStats(object):
+    """The resource usage of a process.
+
+    :spawn_time: seconds spent starting the process (fork/exec).
+    :wall_time: seconds between the start and the exit of the process.
+    :user_time: user CPU seconds (the process and its children).
+    :system_time: system CPU seconds.
+    :max_rss: maximum resident memory (bytes).
+    :read_bytes: bytes read from the block devices.
+    :write_bytes: bytes written to the block devices.
+
+    A value is None when it is not available.
+
+    """
+
+    FIELDS = ('spawn_time', 'wall_time', 'user_time', 'system_time',
+              'max_rss', 'read_bytes', 'write_bytes')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, spawn_time=None, wall_time=None, user_time=None,
+                 system_time=None, max_rss=None, read_bytes=None,
+                 write_bytes=None):
+        """Init the stats (FIELDS)."""
+        self.spawn_time = spawn_time
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    @classmethod
+    def from_rusage(cls, spawn_time, wall_time, rusage=None, proc_io=None):
+        """Return the stats of a process.
+
+        :rusage: the resource.struct_rusage of os.wait4() (or a dict with
+                 some of its fields).
+        :proc_io: the content of /proc/<pid>/io (see read_proc_io()).
+
+        """
+        def value(name):
+            """Return a field of rusage."""
+            if isinstance(rusage, dict):
+                return rusage.get(name)
+            return getattr(rusage, name, None)
+
+        stats = cls(spawn_time=spawn_time, wall_time=wall_time,
+                    user_time=value('ru_utime'),
+                    system_time=value('ru_stime'))
+
+        if value('ru_maxrss') is not None:
+            # kilobytes on Linux
+            stats.max_rss = value('ru_maxrss') * 1024
+
+        if proc_io:
+            stats.read_bytes = proc_io.get('read_bytes')
+            stats.write_bytes = proc_io.get('write_bytes')
+        elif value('ru_inblock') is not None:
+            # blocks of 512 bytes
+            stats.read_bytes = value('ru_inblock') * 512
+            stats.write_bytes = value('ru_oublock') * 512
+
+        return stats
+
+    @classmethod
+    def combine(cls, stats_list, spawn_time=None, wall_time=None):
+        """Return the stats of several processes (a pipeline).
+
+        The times and the I/O are added, max_rss is the maximum.
+
+        """
+        stats = cls(spawn_time=spawn_time, wall_time=wall_time)
+        for name in ('user_time', 'system_time', 'read_bytes', 'write_bytes',
+                     'max_rss'):
+            values = [getattr(item, name) for item in stats_list
+                      if item is not None and getattr(item, name) is not None]
+            if values:
+                setattr(stats, name, max(values) if name == 'max_rss'
+                        else sum(values))
+        return stats
+
+    def as_dict(self):
+        """Return the stats as a dict."""
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __repr__(self):
+        """Return the repr."""
+        return 'CmdStats({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.FIELDS if getattr(self, name) is not None))
+
+
+def read_proc_io(pid):
+    """Return the I/O counters of /proc/<pid>/io (None if not available)."""
+    try:
+        with open('/proc/{}/io'.format(pid)) as fhandle:
+            content = fhandle.read()
+    except OSError:
+        return None
+
+    proc_io = {}
+    for line in content.splitlines():
+        name, _, value = line.partition(':')
+        proc_io[name.strip()] = int(value)
+    return proc_io
+
+
+class CmdStatsCollector(object):
+    """Collect the stats of many commands, summarize them per command name.
+
+    >>> collector = CmdStatsCollector()
+    >>> git = CmdWrapper('git', collector=collector)
+    >>> ...
+    >>> collector.summary()['git']['user_time']['p90']
+
+    """
+
+    def __init__(self, max_samples=10000):
+        """Keep at most 'max_samples' stats per command name (the last)."""
+        assert isinstance(max_samples, int) and max_samples > 0
+        self.max_samples = max_samples
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, stats):
+        """Add the stats of a command."""
+        if stats is None:
+            return
+
+        with self._lock:
+            samples = self._samples.setdefault(name, [])
+            samples.append(stats)
+            if len(samples) > self.max_samples:
+                del samples[0]
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def clear(self):
+        """Forget everything."""
+        with self._lock:
+            self._samples = {}
+            self._counts = {}
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Return {name: {'count': n, field: {'p50': ..., 'total': ...}}}.
+
+        The percentiles are computed from the last 'max_samples' stats.
+
+        """
+        with self._lock:
+            samples = {name: list(items)
+                       for name, items in self._samples.items()}
+            counts = dict(self._counts)
+
+        summary = {}
+        for name, items in samples.items():
+            summary[name] = {'count': counts[name]}
+            for field in CmdStats.FIELDS:
+                values = sorted(getattr(item, field) for item in items
+                                if getattr(item, field) is not None)
+                if not values:
+                    continue
+
+                summary[name][field] = {
+                    'p{}'.format(percent): _percentile(values, percent)
+                    for percent in percentiles}
+                summary[name][field]['max'] = values[-1]
+                summary[name][field]['total'] = sum(values)
+
+        return summary
+
+
+def _percentile(values, percent):
+    """Return a percentile of the sorted values (nearest rank)."""
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def main():
+    """Test the class CmdStats."""
+    import unittest
+
+    class TestCmdStats(unittest.TestCase):
+        """Testing the classes CmdStats and CmdStatsCollector."""
+
+        def test_cmdstats(self):
+            """Test: CmdStats()."""
+            stats = CmdStats.from_rusage(0.001, 0.5,
+                                         {'ru_utime': 0.1, 'ru_stime': 0.2,
+                                          'ru_maxrss': 10},
+                                         {'read_bytes': 4096,
+                                          'write_bytes': 0})
+            self.assertEqual(stats.max_rss, 10240)
+            self.assertEqual(stats.read_bytes, 4096)
+            self.assertIn('user_time=0.1', repr(stats))
+
+            stats = CmdStats.combine([stats, None, CmdStats(user_time=0.2,
+                                                            max_rss=1)],
+                                     wall_time=1)
+            self.assertAlmostEqual(stats.user_time, 0.3)
+            self.assertEqual(stats.as_dict(),
+                             {'spawn_time': None, 'wall_time': 1,
+                              'user_time': stats.user_time,
+                              'system_time': 0.2, 'max_rss': 10240,
+                              'read_bytes': 4096, 'write_bytes': 0})
+
+            proc_io = read_proc_io(os.getpid())
+            if os.path.exists('/proc/self/io'):
+                self.assertIn('read_bytes', proc_io)
+            self.assertIsNone(read_proc_io(-1))
+
+        def test_collector(self):
+            """Test: CmdStatsCollector()."""
+            collector = CmdStatsCollector(max_samples=100)
+            for num in range(1, 201):
+                collector.add('ls', CmdStats(wall_time=num))
+            collector.add('ls', None)
+            collector.add('git', CmdStats(user_time=2))
+
+            summary = collector.summary(percentiles=(50, 99))
+            self.assertEqual(summary['ls']['count'], 200)
+            self.assertEqual(summary['ls']['wall_time'],
+                             {'p50': 150, 'p99': 199, 'max': 200,
+                              'total': sum(range(101, 201))})
+            self.assertNotIn('user_time', summary['ls'])
+            self.assertEqual(summary['git']['user_time']['p50'], 2)
+
+            collector.clear()
+            self.assertEqual(collector.summary(), {})
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestCmdStats)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Author: Achraf Cherti (Asher256) <asher256@gmail.com>
+# Github: https://github.com/Asher256/python-cmdwrapper
+# License: LGPL 2.1
+#
+# This source code follows the PEP-8 style guide:
+# https://www.python.org/dev/peps/pep-0008/
+#
+"""Find the absolute path of the executables (cached)."""
+
+import sys
+import os
+
+assert sys.version_info >= (3, 6), "The Python version need to be >= 3.6"
+
+# (name, PATH directories) -> (path, stat key of the executable,
+#                              [(directory, mtime)] searched before it)
+_CACHE = {}
+
+
+def which(name, env=None):
+    """Return the absolute path of the executable 'name' (or None).
+
+    The directories come from the PATH of 'env' (os.environ if env is None),
+    the way subprocess.Popen() finds the executables. A name that contains a
+    '/' is returned unchanged.
+
+    The result is cached: it is used again while PATH, the inode/mtime of the
+    executable and the mtime of the directories searched before it did not
+    change (an executable added to one of these directories is found).
+
+    """
+    if os.sep in name:
+        return name
+
+    path = tuple(os.get_exec_path(env))
+    key = (name, path)
+    entry = _CACHE.get(key)
+    if entry is not None and _is_valid(entry):
+        return entry[0]
+
+    entry = _search(name, path)
+    if entry is None:
+        _CACHE.pop(key, None)
+        return None
+
+    _CACHE[key] = entry
+    return entry[0]
+
+
+def clear_cache():
+    """Forget all the executables."""
+    _CACHE.clear()
+
+
+def _stat_key(stat):
+    """Return what identifies a version of a file."""
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+
+def _is_valid(entry):
+    """Return True if the cache entry is still valid."""
+    exe_path, exe_key, dirs = entry
+    try:
+        if _stat_key(os.stat(exe_path)) != exe_key:
+            return False
+
+        for directory, mtime_ns in dirs:
+            if os.stat(directory).st_mtime_ns != mtime_ns:
+                return False
+    except OSError:
+        return False
+
+    return True
+
+
+def _search(name, path):
+    """Search 'name' in the directories. Return a cache entry (or None)."""
+    dirs = []
+    for directory in path:
+        if not os.path.isabs(directory):
+            # depends on the current directory of the process: not cached
+            return None
+
+        try:
+            dirs.append((directory, os.stat(directory).st_mtime_ns))
+            exe_path = os.path.join(directory, name)
+            stat = os.stat(exe_path)
+        except OSError:
+            continue
+
+        if os.path.isfile(exe_path) and os.access(exe_path, os.X_OK):
+            return (exe_path, _stat_key(stat), dirs[:-1])
+
+    return None
+
+
+def main():
+    """Test the function which()."""
+    import unittest
+    import tempfile
+
+    class TestWhich(unittest.TestCase):
+        """Testing the function which()."""
+
+        def setUp(self):
+            """Create two PATH directories."""
+            # pylint: disable=consider-using-with
+            self._tmpdir = tempfile.TemporaryDirectory()
+            self._dirs = [os.path.join(self._tmpdir.name, name)
+                          for name in ('bin1', 'bin2')]
+            for directory in self._dirs:
+                os.mkdir(directory)
+            self._env = {'PATH': os.pathsep.join(self._dirs)}
+
+        def tearDown(self):
+            """Remove the directories."""
+            self._tmpdir.cleanup()
+
+        def _create(self, directory, name, mode=0o755):
+            """Create an executable."""
+            exe_path = os.path.join(directory, name)
+            with open(exe_path, 'w') as fhandle:
+                fhandle.write('#!/bin/sh\n')
+            os.chmod(exe_path, mode)
+            return exe_path
+
+        def test_which(self):
+            """Test: which()."""
+            self.assertEqual(which('/bin/ls'), '/bin/ls')
+            self.assertTrue(os.path.isabs(which('ls')))
+            self.assertIsNone(which('xxx-rrr-cmdwhich', self._env))
+            self.assertIsNone(which('ls', {'PATH': 'bin:/bin'}))
+
+            self._create(self._dirs[0], 'noexec', mode=0o644)
+            self.assertIsNone(which('noexec', self._env))
+
+            exe2 = self._create(self._dirs[1], 'tool')
+            self.assertEqual(which('tool', self._env), exe2)
+            self.assertIn(('tool', tuple(self._dirs)), _CACHE)
+
+            # the PATH is part of the key
+            self.assertIsNone(which('tool', {'PATH': self._dirs[0]}))
+
+            # a new executable shadows the cached one
+            exe1 = self._create(self._dirs[0], 'tool')
+            os.utime(self._dirs[0], ns=(0, 0))
+            self.assertEqual(which('tool', self._env), exe1)
+
+            # the executable was removed
+            os.unlink(exe1)
+            self.assertEqual(which('tool', self._env), exe2)
+            os.unlink(exe2)
+            self.assertIsNone(which('tool', self._env))
+
+            clear_cache()
+            self.assertEqual(_CACHE, {})
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestWhich)
+    ret = unittest.TextTestRunner(verbosity=5).run(tests).wasSuccessful()
+    sys.exit(int(not ret))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ai:et:sw=4:ts=4:sts=4:tw=78:fenc=utf-8
@@ -59,18 +59,23 @@ setup(
 
         # Pick your license as you wish (should match "license" above)
         'License :: OSI Approved :: GNU Lesser General '
-        'Public License v2 (LGPLv2)'
+        'Public License v2 (LGPLv2)',
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6'
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11'
     ],
 
+    # cmdwrapper.cmdlauncher needs Python >= 3.9 (it cannot be imported
+    # with the older versions)
+    python_requires='>=3.6',
+
     # What does your project relate to?
     keywords='cmdwrapper command cmd wrapper run process',
 